@@ -1,4 +1,5 @@
-from typing import Union, Optional, TypeVar, Type
+import attrs
+from typing import Iterator, Union, Optional, TypeVar, Type
 from abc import ABC, abstractmethod
 
 
@@ -56,6 +57,22 @@ class ServiceIP(Resource):
         return NotImplemented
 
 
+@attrs.define
+class BindResult:
+    """
+    Outcome of binding endpoints to a service, or unbinding them from it,
+    for every endpoint of the request.
+    """
+    sip: ServiceIP
+    succeeded: [EndpointIP] = attrs.Factory(list)
+    # Endpoints that could not be bound or unbound, with the reason
+    failed: [(EndpointIP, str)] = attrs.Factory(list)
+
+    @property
+    def ok(self) -> bool:
+        return len(self.failed) == 0
+
+
 TInvisinet = TypeVar('TInvisinet', bound='Invisinet')
 
 
@@ -80,7 +97,7 @@ class Invisinet(ABC):
 
     @property
     @abstractmethod
-    def active_eip(self) -> [EndpointIP]:
+    def active_eip(self) -> Iterator[EndpointIP]:
         return NotImplemented
 
     @abstractmethod
@@ -89,11 +106,15 @@ class Invisinet(ABC):
 
     @property
     @abstractmethod
-    def active_sip(self) -> [ServiceIP]:
+    def active_sip(self) -> Iterator[ServiceIP]:
+        return NotImplemented
+
+    @abstractmethod
+    def bind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
         return NotImplemented
 
     @abstractmethod
-    def bind(self, sip: ServiceIP, eip: EndpointIP):
+    def unbind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
         return NotImplemented
 
     @abstractmethod
@@ -102,3 +123,67 @@ class Invisinet(ABC):
                  middlebox: EndpointIP):
         return NotImplemented
 
+    @abstractmethod
+    def annotate_many(self, pairs: [(EndpointIP, EndpointIP)], middlebox: EndpointIP,
+                      prune: bool = False):
+        return NotImplemented
+
+
+
+TAsyncInvisinet = TypeVar('TAsyncInvisinet', bound='AsyncInvisinet')
+
+
+class AsyncInvisinet(ABC):
+    """
+    Asyncio flavour of the Invisinet API. Implementations must not block the
+    event loop, and long-running provider operations are awaited without
+    holding a thread for their whole duration.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @property
+    @abstractmethod
+    def deployment_id(self) -> str:
+        return NotImplemented
+
+    @abstractmethod
+    async def request_eip(self, name: Optional[str] = None,
+                          use_existing_vm_id: Optional[str] = None) -> EndpointIP:
+        return NotImplemented
+
+    @abstractmethod
+    async def request_sip(self, name: Optional[str] = None) -> ServiceIP:
+        return NotImplemented
+
+    @abstractmethod
+    async def bind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        return NotImplemented
+
+    @abstractmethod
+    async def unbind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        return NotImplemented
+
+    @abstractmethod
+    async def annotate(self,
+                       endpoints: (EndpointIP, EndpointIP),
+                       middlebox: EndpointIP):
+        return NotImplemented
+
+    @abstractmethod
+    async def set_permit_list(self, eip: EndpointIP, permit_list: list, directions: Optional[set[str]] = None):
+        return NotImplemented
+
+    @abstractmethod
+    async def set_tag(self, resource: Resource, tags: dict[str, str]):
+        return NotImplemented
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self: TAsyncInvisinet) -> TAsyncInvisinet:
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -1 +1,4 @@
 from aws.main import InvisinetAWS
+from aws.aio import AsyncInvisinetAWS
+import aws.plan
+import aws.reconcile
@@ -0,0 +1,130 @@
+import metrics
+import permits
+import aws.waiter
+import asyncio
+import logging
+import functools
+from _api import *
+from utils import *
+from aws.main import *
+from typing import Any, Callable, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_WORKERS = 64
+logger = logging.getLogger(__name__)
+__all__ = ["AsyncInvisinetAWS"]
+
+
+class AsyncInvisinetAWS(AsyncInvisinet):
+    """
+    Asyncio flavour of InvisinetAWS. Individual boto3 requests run on a
+    bounded thread pool, while waits on resource state are handed to the
+    shared waiter service so that no thread is held while a resource
+    converges.
+    """
+
+    def __init__(self, deployment: InvisinetAWS, executor: ThreadPoolExecutor):
+        super().__init__()
+        self._deployment = deployment
+        self._executor = executor
+
+    @classmethod
+    async def create(cls, deployment_id: Optional[str] = None,
+                     max_workers: int = DEFAULT_MAX_WORKERS) -> "AsyncInvisinetAWS":
+        """
+        Create a new deployment, or load an existing one if a deployment id is given.
+        """
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="invisinet-aws")
+        loop = asyncio.get_running_loop()
+        deployment = await loop.run_in_executor(executor, InvisinetAWS, deployment_id)
+        return cls(deployment, executor)
+
+    def __repr__(self):
+        return f"async {self._deployment!r}"
+
+    @property
+    def deployment_id(self) -> str:
+        return self._deployment.deployment_id
+
+    async def _call(self, f: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, metrics.propagate(functools.partial(f, *args, **kwargs)))
+
+    async def _create_subnet(self, name: str) -> Subnet:
+        return await self._call(Subnet.create, name, self._deployment._vpc)
+
+    async def wait_until_running(self, instance: Instance):
+        instance.instance.meta.data = await asyncio.wrap_future(
+            aws.waiter.service.submit("instance", instance.endpoint_id, "running")
+        )
+
+    @metrics.instrument("aws")
+    async def request_eip(self, name: Optional[str] = None,
+                          use_existing_vm_id: Optional[str] = None) -> EndpointIP:
+        name = name or f"invisinet-eip-{random_hex(5)}"
+        image, subnet, key = await asyncio.gather(
+            self._call(lambda: self._deployment._image),
+            self._create_subnet(f"invisinet-eip-subnet-{random_hex(5)}"),
+            self._call(lambda: self._deployment._key_pair),
+        )
+        instance = await self._call(
+            Instance.create,
+            name=name,
+            image=image,
+            instance_type=instance_type,
+            key_pair=key,
+            subnet_id=subnet.subnet_id,
+            wait=False,
+            deployment_id=self.deployment_id,
+        )
+        await self.wait_until_running(instance)
+        logger.info(f"Instance {instance.endpoint_id} is running.")
+        return instance
+
+    @metrics.instrument("aws")
+    async def request_sip(self, name: Optional[str] = None) -> ServiceIP:
+        subnet = await self._create_subnet(f"invisinet-sip-subnet-{random_hex(5)}")
+        name = name or f"invisinet-sip-{random_hex(5)}"
+        return await self._call(LoadBalancer.create, name, subnet=subnet, vpc=self._deployment._vpc)
+
+    @metrics.instrument("aws")
+    async def bind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        return await self._call(InvisinetAWS.bind.__wrapped__, self._deployment, sip, eips)
+
+    @metrics.instrument("aws")
+    async def unbind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        return await self._call(InvisinetAWS.unbind.__wrapped__, self._deployment, sip, eips)
+
+    @metrics.instrument("aws")
+    async def annotate(self,
+                       endpoints: (EndpointIP, EndpointIP),
+                       middlebox: EndpointIP):
+        return await self._call(InvisinetAWS.annotate.__wrapped__, self._deployment,
+                                endpoints, middlebox)
+
+    @metrics.instrument("aws")
+    async def annotate_many(self, pairs: [(EndpointIP, EndpointIP)], middlebox: EndpointIP,
+                            prune: bool = False):
+        return await self._call(InvisinetAWS.annotate_many.__wrapped__, self._deployment,
+                                pairs, middlebox, prune)
+
+    @metrics.instrument("aws")
+    async def set_permit_list(self, eip: Instance, permit_list: [permits.Permit],
+                              directions: Optional[set[str]] = None):
+        """
+        Make the security groups attached to the instance allow exactly the permit list.
+        """
+        for group in eip.instance.security_groups:
+            await self._call(self._deployment.set_permit_list, group["GroupId"], permit_list, directions,
+                             eip.region)
+
+    @metrics.instrument("aws")
+    async def set_tag(self, resource: Resource, tags: dict[str, str]):
+        """
+        Replace the tags of an instance or load balancer, keeping the tags
+        Invisinet relies on to track its resources.
+        """
+        return await self._call(InvisinetAWS.set_tags.__wrapped__, self._deployment, {resource: tags})
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
@@ -1,10 +1,17 @@
-import boto3
+import clients
+import cache
 import logging
+import aws.tags
 import aws.subnet
+import aws.waiter
+import transactions.journal
 from _api import *
 from botocore.exceptions import ClientError
-from typing import Type, TypeVar, Optional
+from typing import Iterator, Type, TypeVar, Optional
 
+MAX_CONCURRENT_REQUESTS = 16
+MAX_INSTANCE_IDS_PER_REQUEST = 1000
+DEFAULT_PAGE_SIZE = 1000
 logger = logging.getLogger(__name__)
 TInstance = TypeVar("TInstance", bound="Instance")
 __all__ = ["Instance", "TInstance"]
@@ -13,7 +20,7 @@ __all__ = ["Instance", "TInstance"]
 class Instance(EndpointIP):
     """Encapsulates Amazon Elastic Compute Cloud (Amazon EC2) instance actions."""
 
-    _resource = boto3.resource('ec2')
+    _resource = clients.AWSResource("ec2")
 
     def __init__(self, instance):
         super().__init__()
@@ -21,8 +28,7 @@ class Instance(EndpointIP):
 
     @classmethod
     def from_resource(cls):
-        ec2_resource = boto3.resource('ec2')
-        return cls(ec2_resource)
+        return cls(cls._resource)
 
     @classmethod
     def load(cls: Type[TInstance], instance_id: str) -> TInstance:
@@ -30,44 +36,179 @@ class Instance(EndpointIP):
         instance.load()
         return cls(instance)
 
+    @classmethod
+    def load_many(cls: Type[TInstance], instance_ids: Optional[list[str]] = None,
+                  filters: Optional[list[dict]] = None) -> Iterator[TInstance]:
+        """
+        Load the instances with the given IDs, matching the given filters, or
+        both, in the current region. Wrappers are hydrated from the
+        describe_instances pages, which are only requested as the instances
+        are consumed.
+        """
+        # Bound now, so that the pages are requested in the current region
+        resource = cls._resource
+        paginator = resource.meta.client.get_paginator("describe_instances")
+        if instance_ids is None:
+            requests = [{"PaginationConfig": {"PageSize": DEFAULT_PAGE_SIZE}}]
+        else:
+            # Instance IDs cannot be combined with a page size
+            requests = [{"InstanceIds": instance_ids[i:i + MAX_INSTANCE_IDS_PER_REQUEST]}
+                        for i in range(0, len(instance_ids), MAX_INSTANCE_IDS_PER_REQUEST)]
+
+        def instances() -> Iterator[TInstance]:
+            for request in requests:
+                if filters:
+                    request["Filters"] = filters
+                for page in paginator.paginate(**request):
+                    for reservation in page["Reservations"]:
+                        for data in reservation["Instances"]:
+                            instance = resource.Instance(data["InstanceId"])
+                            instance.meta.data = data
+                            aws.tags.index.put(data["InstanceId"],
+                                               {tag["Key"]: tag["Value"] for tag in data.get("Tags", [])})
+                            yield cls(instance)
+
+        return instances()
+
     @classmethod
     def create(cls: Type[TInstance], name, image, instance_type, key_pair,
-               subnet_id, security_groups=None) -> TInstance:
+               subnet_id, security_groups=None, wait: bool = True,
+               deployment_id: Optional[str] = None) -> TInstance:
         """
                Creates a new EC2 instance. The instance starts immediately after
                it is created.
                The instance is created in the default VPC of the current account.
+               Pass wait=False to return before the instance is running.
         """
+        return cls.create_many([name], image, instance_type, key_pair, [subnet_id],
+                               security_groups=security_groups, wait=wait, deployment_id=deployment_id)[0]
+
+    @classmethod
+    def create_many(cls: Type[TInstance], names: [str], image, instance_type, key_pair,
+                    subnet_ids: [str], security_groups=None, wait: bool = True,
+                    deployment_id: Optional[str] = None, pooled: bool = False) -> [TInstance]:
+        """
+        Creates one EC2 instance per name, in the subnet at the same position.
+        Instances sharing a subnet are launched by a single request, requests
+        for different subnets are issued concurrently, and the shared waiter
+        service polls every instance in batches. Instances are tagged with
+        the deployment ID when one is given, and as pooled with ``pooled``.
+        """
+        if len(names) != len(subnet_ids):
+            raise ValueError(f"Got {len(names)} names for {len(subnet_ids)} subnets")
+        if len(names) == 0:
+            return []
+
         logger.info(
-            f"Creating a new {instance_type} instance using image {image.name}..."
+            f"Creating {len(names)} new {instance_type} instances using image {image.name}..."
         )
+        client = cls._resource.meta.client
+        groups = {}
+        for name, subnet_id in zip(names, subnet_ids):
+            groups.setdefault(subnet_id, []).append(name)
+
+        def launch(subnet_id: str, group_names: [str]) -> [dict]:
+            tags = [
+                {
+                    "Key": "InvisinetsDeployment",
+                    "Value": "true"
+                },
+            ]
+            if deployment_id is not None:
+                tags.append({"Key": "DeploymentID", "Value": deployment_id})
+            if pooled:
+                tags.append({"Key": aws.tags.POOLED_TAG_KEY, "Value": "true"})
+            if len(group_names) == 1:
+                tags.append({"Key": "Name", "Value": group_names[0]})
+            instance_params = {
+                "ImageId": image.id, "InstanceType": instance_type,
+                "KeyName": key_pair.name, "SubnetId": subnet_id,
+                "TagSpecifications": [{
+                    "ResourceType": "instance",
+                    "Tags": tags
+                }]
+            }
+            if security_groups is not None:
+                instance_params['SecurityGroupIds'] = [sg.id for sg in security_groups]
+            instances = client.run_instances(
+                **instance_params, MinCount=len(group_names), MaxCount=len(group_names)
+            )["Instances"]
+            for instance in instances:
+                transactions.journal.record("aws", "instance", instance["InstanceId"])
 
-        instance_params = {
-            "ImageId": image.id, "InstanceType": instance_type,
-            "KeyName": key_pair.name, "SubnetId": subnet_id,
-            "TagSpecifications": [{
-                "ResourceType": "instance",
-                "Tags": [
-                    {
-                        "Key": "Name",
-                        "Value": name
-                    },
-                    {
-                        "Key": "InvisinetsDeployment",
-                        "Value": "true"
-                    },
-                ]
-            }]
-        }
-        if security_groups is not None:
-            instance_params['SecurityGroupIds'] = [sg.id for sg in security_groups]
-        instance = cls._resource.create_instances(**instance_params, MinCount=1, MaxCount=1)[0]
-        instance.wait_until_running()
-
-        result = cls(instance)
-        logger.info(f"Success. instance_id: {result.endpoint_id}")
+            for instance, name in zip(instances, group_names):
+                name_tag = {"Key": "Name", "Value": name}
+                if len(group_names) > 1:
+                    # Instances launched together can only be named afterwards
+                    client.create_tags(Resources=[instance["InstanceId"]], Tags=[name_tag])
+                instance["Tags"] = [tag for tag in tags if tag["Key"] != "Name"] + [name_tag]
+                aws.tags.index.put(instance["InstanceId"], {tag["Key"]: tag["Value"] for tag in instance["Tags"]})
+            return instances
+
+        launched = dict(zip(groups.keys(), clients.map_concurrently(lambda item: launch(*item), groups.items(),
+                                                                    MAX_CONCURRENT_REQUESTS)))
+        instances_data = [launched[subnet_id].pop(0) for subnet_id in subnet_ids]
+        instance_ids = [data["InstanceId"] for data in instances_data]
+
+        if wait:
+            instances_data = aws.waiter.service.wait("instance", instance_ids, "running")
+
+        result = []
+        for data in instances_data:
+            instance = cls._resource.Instance(data["InstanceId"])
+            instance.meta.data = data
+            result.append(cls(instance))
+        logger.info(f"Success. instance_ids: {', '.join(instance_ids)}")
         return result
 
+    @classmethod
+    def start_many(cls, instances: ["Instance"]):
+        """
+        Start stopped instances with a single request and wait until all of them are running.
+        """
+        for region, group in _by_region(instances).items():
+            with clients.region(region):
+                instance_ids = [instance.endpoint_id for instance in group]
+                cls._resource.meta.client.start_instances(InstanceIds=instance_ids)
+                for instance, data in zip(group, aws.waiter.service.wait("instance", instance_ids, "running")):
+                    instance.instance.meta.data = data
+
+    @classmethod
+    def stop_many(cls, instances: ["Instance"]):
+        """
+        Stop running instances with a single request and wait until all of them are stopped.
+        """
+        for region, group in _by_region(instances).items():
+            with clients.region(region):
+                instance_ids = [instance.endpoint_id for instance in group]
+                cls._resource.meta.client.stop_instances(InstanceIds=instance_ids)
+                for instance, data in zip(group, aws.waiter.service.wait("instance", instance_ids, "stopped")):
+                    instance.instance.meta.data = data
+
+    @classmethod
+    def terminate_many(cls, instances: ["Instance"]):
+        """
+        Terminate instances with a single request per region, wait until all
+        of them are terminated, then delete their subnets.
+        """
+        for region, group in _by_region(instances).items():
+            with clients.region(region):
+                client = cls._resource.meta.client
+                instance_ids = [instance.endpoint_id for instance in group]
+                # Terminated instances no longer report their subnet
+                missing = [instance.endpoint_id for instance in group if instance.instance.meta.data is None]
+                loaded = {instance.endpoint_id: instance for instance in cls.load_many(missing)} if missing else {}
+                subnet_ids = [loaded.get(instance.endpoint_id, instance).subnet_id for instance in group]
+
+                client.terminate_instances(InstanceIds=instance_ids)
+                aws.waiter.service.wait("instance", instance_ids, "terminated")
+                for instance in group:
+                    cache.attributes.invalidate(instance.endpoint_id)
+                    aws.tags.index.remove(instance.endpoint_id)
+                    instance.instance = None
+                aws.subnet.Subnet.deallocate_many(list(aws.subnet.Subnet.load_many(subnet_ids).values()))
+                logger.info(f"Terminated instances: {', '.join(instance_ids)}")
+
     @classmethod
     def get_images(cls, image_ids):
         """
@@ -93,11 +234,41 @@ class Instance(EndpointIP):
                 return tag["Value"]
         raise ValueError("Couldn't find the instance name")
 
+    @property
+    def pooled(self) -> bool:
+        """Whether the instance waits in a warm pool."""
+        assert self.instance is not None, "Endpoint not initialized"
+        return any(tag["Key"] == aws.tags.POOLED_TAG_KEY for tag in self.instance.tags or [])
+
+    @classmethod
+    def unpool_many(cls, instances: ["Instance"]):
+        """Remove the pooled tag of instances handed out by a warm pool."""
+        aws.tags.untag([instance.endpoint_id for instance in instances], [aws.tags.POOLED_TAG_KEY])
+        for instance in instances:
+            instance.instance.meta.data["Tags"] = [
+                tag for tag in instance.instance.meta.data.get("Tags", []) if tag["Key"] != aws.tags.POOLED_TAG_KEY
+            ]
+
+    @clients.regional
+    def set_name(self, name: str):
+        assert self.instance is not None, "Endpoint not initialized"
+        name_tag = {"Key": "Name", "Value": name}
+        self._resource.meta.client.create_tags(Resources=[self.instance.id], Tags=[name_tag])
+        self.instance.meta.data["Tags"] = [
+            tag for tag in self.instance.meta.data.get("Tags", []) if tag["Key"] != "Name"
+        ] + [name_tag]
+        aws.tags.index.update(self.instance.id, {"Name": name})
+
     @property
     def subnet_id(self) -> str:
         assert self.instance is not None, "Endpoint not initialized"
         return self.instance.subnet_id
 
+    @property
+    def region(self) -> str:
+        assert self.instance is not None, "Endpoint not initialized"
+        return self.instance.meta.client.meta.region_name
+
     @property
     def endpoint_id(self):
         assert self.instance is not None, "Endpoint not initialized"
@@ -108,6 +279,11 @@ class Instance(EndpointIP):
         assert self.instance is not None, "Endpoint not initialized"
         return self.instance.public_ip_address
 
+    @property
+    def private_ip(self) -> str:
+        assert self.instance is not None, "Endpoint not initialized"
+        return self.instance.private_ip_address
+
     def display(self, indent=1):
         """
         Displays information about an instance.
@@ -131,6 +307,7 @@ class Instance(EndpointIP):
                 err.response['Error']['Code'], err.response['Error']['Message'])
             raise
 
+    @clients.regional
     def terminate(self):
         """
         Terminates an instance and waits for it to be in a terminated state.
@@ -140,8 +317,10 @@ class Instance(EndpointIP):
         instance_id = self.instance.id
         try:
             self.instance.terminate()
-            self.instance.wait_until_terminated()
-            subnet = aws.subnet.Subnet(self.subnet_id)
+            aws.waiter.service.wait("instance", [instance_id], "terminated")
+            cache.attributes.invalidate(instance_id)
+            aws.tags.index.remove(instance_id)
+            subnet = aws.subnet.Subnet.load(self.subnet_id)
             subnet.deallocate()
 
             self.instance = None
@@ -151,6 +330,7 @@ class Instance(EndpointIP):
                 err.response['Error']['Code'], err.response['Error']['Message'])
             raise
 
+    @clients.regional
     def start(self):
         """
         Starts an instance and waits for it to be in a running state.
@@ -160,7 +340,7 @@ class Instance(EndpointIP):
 
         try:
             response = self.instance.start()
-            self.instance.wait_until_running()
+            self.instance.meta.data = aws.waiter.service.wait("instance", [self.instance.id], "running")[0]
         except ClientError as err:
             logger.error(
                 "Couldn't start instance %s. Here's why: %s: %s", self.instance.id,
@@ -169,6 +349,7 @@ class Instance(EndpointIP):
         else:
             return response
 
+    @clients.regional
     def stop(self):
         """
         Stops an instance and waits for it to be in a stopped state.
@@ -178,7 +359,7 @@ class Instance(EndpointIP):
 
         try:
             response = self.instance.stop()
-            self.instance.wait_until_stopped()
+            self.instance.meta.data = aws.waiter.service.wait("instance", [self.instance.id], "stopped")[0]
         except ClientError as err:
             logger.error(
                 "Couldn't stop instance %s. Here's why: %s: %s", self.instance.id,
@@ -212,3 +393,25 @@ class Instance(EndpointIP):
             raise
         else:
             return inst_types
+
+
+def _by_region(instances: [Instance]) -> dict[str, list[Instance]]:
+    groups = {}
+    for instance in instances:
+        groups.setdefault(instance.region, []).append(instance)
+    return groups
+
+
+def _destroy_instance(instance_id: str):
+    client = Instance._resource.meta.client
+    try:
+        client.terminate_instances(InstanceIds=[instance_id])
+        aws.waiter.service.wait("instance", [instance_id], "terminated")
+    except ClientError as err:
+        if not err.response["Error"]["Code"].endswith("NotFound"):
+            raise
+    cache.attributes.invalidate(instance_id)
+    aws.tags.index.remove(instance_id)
+
+
+transactions.journal.register_destroyer("aws", "instance", _destroy_instance)
@@ -0,0 +1,94 @@
+import attrs
+import clients
+import logging
+import aws.tags
+import threading
+from typing import Optional
+
+RESOURCES_PER_PAGE = 100
+# Resource types Invisinet creates, as named by the resource tagging API
+RESOURCE_TYPES = [
+    "ec2:vpc",
+    "ec2:subnet",
+    "ec2:route-table",
+    "ec2:instance",
+    "elasticloadbalancing:loadbalancer",
+]
+logger = logging.getLogger(__name__)
+__all__ = ["Deployment", "RESOURCE_TYPES", "sweep", "cached"]
+
+# Result of the last sweep of every (region, deployment ID), None for a sweep of every deployment
+_sweeps: dict[(str, Optional[str]), dict[Optional[str], "Deployment"]] = {}
+_sweeps_lock = threading.Lock()
+
+
+@attrs.define
+class Deployment:
+    """
+    The resources of one deployment found by a sweep. EC2 resources are
+    given by ID and load balancers by ARN.
+    """
+    deployment_id: Optional[str]
+    vpcs: list[str] = attrs.Factory(list)
+    subnets: list[str] = attrs.Factory(list)
+    route_tables: list[str] = attrs.Factory(list)
+    instances: list[str] = attrs.Factory(list)
+    load_balancers: list[str] = attrs.Factory(list)
+
+    @property
+    def vpc_id(self) -> Optional[str]:
+        return self.vpcs[0] if self.vpcs else None
+
+
+def _resource(arn: str) -> (Optional[str], str):
+    """The Deployment field holding a resource and its ID, from its ARN."""
+    _, _, service, _, _, resource = arn.split(":", 5)
+    if service == "elasticloadbalancing":
+        return "load_balancers" if resource.startswith("loadbalancer/") else None, arn
+    resource_type, _, resource_id = resource.partition("/")
+    fields = {"vpc": "vpcs", "subnet": "subnets", "route-table": "route_tables", "instance": "instances"}
+    return fields.get(resource_type), resource_id
+
+
+def sweep(deployment_id: Optional[str] = None) -> dict[Optional[str], Deployment]:
+    """
+    Every resource tagged as part of an Invisinet deployment, or of the given
+    deployment only, grouped by deployment ID with a single paginated
+    listing of the resource tagging API. Resources created before they were
+    tagged with their deployment ID are grouped under None. The tag index is
+    refreshed with the tags of every resource found.
+    """
+    if deployment_id is not None:
+        deployment_id = deployment_id.lower()
+    tag_filters = [{"Key": "InvisinetsDeployment", "Values": ["true"]}]
+    if deployment_id is not None:
+        tag_filters.append({"Key": "DeploymentID", "Values": [deployment_id]})
+
+    deployments: dict[Optional[str], Deployment] = {}
+    paginator = clients.registry.client("resourcegroupstaggingapi").get_paginator("get_resources")
+    for page in paginator.paginate(TagFilters=tag_filters, ResourceTypeFilters=RESOURCE_TYPES,
+                                   ResourcesPerPage=RESOURCES_PER_PAGE):
+        for mapping in page["ResourceTagMappingList"]:
+            field, resource_id = _resource(mapping["ResourceARN"])
+            if field is None:
+                continue
+            tags = {tag["Key"]: tag["Value"] for tag in mapping["Tags"]}
+            aws.tags.index.put(resource_id, tags)
+            owner = tags["DeploymentID"].lower() if "DeploymentID" in tags else None
+            getattr(deployments.setdefault(owner, Deployment(owner)), field).append(resource_id)
+    logger.debug(f"Swept {len(deployments)} deployments")
+    with _sweeps_lock:
+        _sweeps[(clients.current_region(), deployment_id)] = deployments
+    return deployments
+
+
+def cached(region: str, deployment_id: Optional[str] = None) -> Optional[dict[Optional[str], Deployment]]:
+    """
+    The result of the last sweep of a region, for every deployment or for the
+    given one, falling back to the last sweep of every deployment. None when
+    the region was not swept.
+    """
+    with _sweeps_lock:
+        if deployment_id is not None and (region, deployment_id.lower()) in _sweeps:
+            return _sweeps[(region, deployment_id.lower())]
+        return _sweeps.get((region, None))
@@ -1,5 +1,16 @@
-import boto3
+import clients
+import metrics
+import ratelimit
 import logging
+import routes
+import permits
+import aws.pool
+import aws.tags
+import aws.inventory
+import functools
+import threading
+import transactions.plan
+import transactions.journal
 from _api import *
 from utils import *
 from aws.vpc import *
@@ -7,33 +18,112 @@ from aws.subnet import *
 from aws.endpoint import *
 from aws.service import *
 import transactions.actions
-from typing import Optional, Union
+from botocore.exceptions import ClientError
+from typing import Any, Callable, Iterator, Optional, Union
 
 ubuntu_20_ami_id = "ami-0f4feb99425e13b50"
 key_name = "Main"
+instance_type = "t2.micro"
+# A network load balancer holds at most 500 targets per availability zone
+MAX_TARGETS_PER_REQUEST = 500
+MAX_CONCURRENT_REQUESTS = 16
+# Parameter naming the next hop of a route, by resource ID prefix. Routes to
+# an instance are also described with its network interface, so instances
+# come first.
+ROUTE_TARGET_KEYS = {
+    "i-": "InstanceId",
+    "eni-": "NetworkInterfaceId",
+    "nat-": "NatGatewayId",
+    "tgw-": "TransitGatewayId",
+    "pcx-": "VpcPeeringConnectionId",
+    "igw-": "GatewayId",
+    "vgw-": "GatewayId",
+}
 logger = logging.getLogger(__name__)
 
 
+def _permit_from_rule(rule: dict) -> Optional[permits.Permit]:
+    """The permit of a security group rule, or None for rules without an IPv4 block."""
+    if "CidrIpv4" not in rule:
+        return None
+    protocol = permits.ALL_PROTOCOLS if rule["IpProtocol"] == "-1" else rule["IpProtocol"]
+    ports = {}
+    if protocol in ("tcp", "udp"):
+        ports = {"from_port": rule["FromPort"], "to_port": rule["ToPort"]}
+    elif protocol == "icmp":
+        # ICMP rules hold the type and code in the port fields
+        ports = {"icmp_type": rule["FromPort"], "icmp_code": rule["ToPort"]}
+    direction = permits.OUTBOUND if rule["IsEgress"] else permits.INBOUND
+    return permits.Permit(direction, protocol, rule["CidrIpv4"], **ports)
+
+
+def _security_group_rule(permit: permits.Permit) -> dict:
+    rule = {"IpProtocol": "-1" if permit.protocol == permits.ALL_PROTOCOLS else permit.protocol,
+            "CidrIpv4": permit.cidr}
+    if permit.protocol in ("tcp", "udp"):
+        rule.update(FromPort=permit.from_port, ToPort=permit.to_port)
+    elif permit.protocol == "icmp":
+        rule.update(FromPort=permit.icmp_type, ToPort=permit.icmp_code)
+    return rule
+
+
+def _ip_permission(permit: permits.Permit) -> dict:
+    rule = _security_group_rule(permit)
+    permission = {"IpProtocol": rule["IpProtocol"], "IpRanges": [{"CidrIp": rule["CidrIpv4"]}]}
+    if "FromPort" in rule:
+        permission.update(FromPort=rule["FromPort"], ToPort=rule["ToPort"])
+    return permission
+
+
 class InvisinetAWS(Invisinet):
 
     teardown: bool = False
 
-    # TODO: Implement this
+    image_id: str = ubuntu_20_ami_id
+
+    # Transactional calls are recorded into plan instead of being executed,
+    # to be estimated with aws.plan.estimate and applied later
     dryrun: bool = False
 
-    _ec2_resource = boto3.resource('ec2')
-    _ec2_client = boto3.client('ec2')
+    _ec2_resource = clients.AWSResource("ec2")
+    _ec2_client = clients.AWSClient("ec2")
 
-    _elb_client = boto3.client('elbv2')
+    _elb_client = clients.AWSClient("elbv2")
+
+    # AMI to launch in every region, falling back to image_id
+    image_ids: dict[str, str] = {}
 
     _vpc: VPC
+    # VPC of the deployment in every region it spans, _vpc being the primary one
+    _vpcs: dict[str, VPC]
+    # Images and key pairs by region, shared by every deployment
+    _images: dict[(str, str), Any] = {}
+    _key_pairs: dict[str, Any] = {}
+    _regional_lock = threading.Lock()
 
-    def __init__(self, deployment_id: Optional[str] = None):
+    @metrics.instrument("aws", "create_deployment")
+    def __init__(self, deployment_id: Optional[str] = None, regions: Optional[list[str]] = None):
+        """
+        Create a new deployment, or load an existing one if a deployment id is
+        given, in the given regions. The first region is the primary one, the
+        current region by default. The VPCs of the other regions are created
+        or loaded concurrently once the primary one exists.
+        """
         super().__init__()
-        if deployment_id is None:
-            self._vpc = VPC.create()
-        else:
-            self._vpc = VPC.load(deployment_id)
+        regions = list(dict.fromkeys(regions or [clients.current_region()]))
+        with clients.region(regions[0]):
+            if deployment_id is None:
+                self._vpc = VPC.create()
+            else:
+                self._vpc = VPC.load(deployment_id)
+        self._vpcs = {regions[0]: self._vpc} if self._vpc is not None else {}
+        if self._vpc is not None and len(regions) > 1:
+            load = deployment_id is not None
+            vpcs = self._map_regions(
+                lambda region: VPC.load(self.deployment_id) if load else VPC.create(self.deployment_id),
+                regions[1:]
+            )
+            self._vpcs.update({region: vpc for region, vpc in zip(regions[1:], vpcs) if vpc is not None})
 
     def __repr__(self):
         return f"invisinet aws deployment {self.deployment_id}"
@@ -42,18 +132,221 @@ class InvisinetAWS(Invisinet):
     def deployment_id(self) -> str:
         return self._vpc.deployment_id
 
+    @property
+    def regions(self) -> [str]:
+        return list(self._vpcs)
+
+    @property
+    def plan(self) -> transactions.plan.Plan:
+        """The calls recorded in dry-run mode, applied with plan.apply()."""
+        if getattr(self, "_plan", None) is None:
+            self._plan = transactions.plan.Plan(journal=transactions.journal.default)
+        return self._plan
+
     @staticmethod
+    @metrics.instrument("aws")
     def list_deployments() -> [TInvisinet]:
-        return list(map(lambda x: VPC.load(x), VPC.list_deployment_ids()))
+        """
+        Every deployment of the account, found by sweeping the resource
+        tagging API of every enabled region in parallel. The primary region
+        of a deployment spanning several regions is the current region when
+        it is one of them.
+        """
+        def sweep(region: str) -> dict[str, VPC]:
+            return {
+                deployment_id: VPC.from_id(deployment.vpc_id)
+                for deployment_id, deployment in aws.inventory.sweep().items()
+                if deployment_id is not None and deployment.vpc_id is not None
+            }
+
+        regions = clients.registry.enabled_regions()
+        vpcs: dict[str, dict[str, VPC]] = {}
+        for region, found in zip(regions, InvisinetAWS._map_regions(sweep, regions)):
+            for deployment_id, vpc in found.items():
+                vpcs.setdefault(deployment_id, {})[region] = vpc
+
+        current = clients.current_region()
+        return [
+            InvisinetAWS._from_vpcs(vpcs[deployment_id], current if current in vpcs[deployment_id] else None)
+            for deployment_id in sorted(vpcs)
+        ]
+
+    @classmethod
+    def _from_vpcs(cls, vpcs: dict[str, VPC], primary: Optional[str] = None) -> "InvisinetAWS":
+        deployment = cls.__new__(cls)
+        Invisinet.__init__(deployment)
+        deployment._vpcs = dict(vpcs)
+        deployment._vpc = vpcs[primary if primary is not None else next(iter(vpcs))]
+        return deployment
+
+    @staticmethod
+    def _map_regions(f: Callable[[str], Any], regions: [str]) -> list:
+        """Call ``f`` with every region, concurrently, each call running in its region."""
+        def call(region: str):
+            with clients.region(region):
+                return f(region)
+
+        return clients.map_concurrently(call, regions, MAX_CONCURRENT_REQUESTS)
+
+    def _regional_vpc(self, region: Optional[str]) -> VPC:
+        if region is None:
+            return self._vpc
+        if region not in self._vpcs:
+            raise ValueError(f"Deployment {self.deployment_id} has no VPC in {region}, call add_region first")
+        return self._vpcs[region]
+
+    @metrics.instrument("aws")
+    def add_region(self, region: str) -> VPC:
+        """
+        Extend the deployment to another region, creating its VPC there.
+        """
+        if region not in self._vpcs:
+            with clients.region(region):
+                self._vpcs[region] = VPC.load(self.deployment_id) or VPC.create(self.deployment_id)
+        return self._vpcs[region]
 
     @transactions.actions.ResourceAction.register()
+    @metrics.instrument("aws")
     def request_eip(self, name: Optional[str] = None,
-                    use_existing_vm_id: Optional[str] = None) -> EndpointIP:
-        image = Instance.get_images([ubuntu_20_ami_id])[0]
-        subnet = Subnet.create(f"invisinet-eip-subnet-{random_hex(5)}", self._vpc)
+                    use_existing_vm_id: Optional[str] = None,
+                    count: Optional[int] = None,
+                    region: Union[str, list[str], None] = None) -> Union[EndpointIP, list[EndpointIP]]:
+        """
+        Provision an instance in a new subnet. When count is given, provision
+        that many instances in one pass and return them as a list; name is
+        then used as a prefix for the instance names. Instances are placed in
+        the primary region unless another region of the deployment is given.
+        Given a list of regions, count instances, one by default, are
+        provisioned in every region concurrently and returned as one list.
+        """
+        if isinstance(region, list):
+            names = [f"{name or 'invisinet-eip'}-{random_hex(5)}" for _ in range(count or 1)]
+            per_region = self._map_regions(lambda current: self._request_eips(names, current), region)
+            return [instance for instances in per_region for instance in instances]
+
+        if count is None:
+            names = [name or f"invisinet-eip-{random_hex(5)}"]
+        else:
+            names = [f"{name or 'invisinet-eip'}-{random_hex(5)}" for _ in range(count)]
+        ec2_instances = self._request_eips(names, region)
+        return ec2_instances if count is not None else ec2_instances[0]
+
+    def _request_eips(self, names: [str], region: Optional[str]) -> [Instance]:
+        vpc = self._regional_vpc(region)
+        with clients.region(vpc.region):
+            return self._request_eips_in(names, vpc)
+
+    def _request_eips_in(self, names: [str], vpc: VPC) -> [Instance]:
+        # Pooled instances live in the primary region
+        pool = self._pool("eip") if vpc is self._vpc else None
+        pooled = pool.acquire_many(len(names)) if pool is not None else []
+        if len(pooled) > 0:
+            logger.info(f"Starting {len(pooled)} pooled instances...")
+            for instance in pooled:
+                transactions.journal.record("aws", "instance", instance.endpoint_id)
+            Instance.start_many(pooled)
+            for instance, instance_name in zip(pooled, names):
+                instance.set_name(instance_name)
 
-        name = name or f"invisinet-eip-{random_hex(5)}"
+        ec2_instances = pooled + self._create_instances(names[len(pooled):], vpc)
+        logger.info("Process finished.")
+
+        if self.teardown:
+            logger.info(f"Tearing down...")
+            for ec2_instance in ec2_instances:
+                ec2_instance.terminate()
+            logger.info("Done.")
+
+        return ec2_instances
+
+    def _create_instances(self, names: [str], vpc: Optional[VPC] = None, pooled: bool = False) -> [Instance]:
+        vpc = vpc or self._vpc
+        subnets = Subnet.create_many(
+            [f"invisinet-eip-subnet-{random_hex(5)}" for _ in names], vpc
+        )
+        with clients.region(vpc.region):
+            return Instance.create_many(
+                names,
+                image=self._image,
+                instance_type=instance_type,
+                key_pair=self._key_pair,
+                subnet_ids=[subnet.subnet_id for subnet in subnets],
+                deployment_id=self.deployment_id,
+                pooled=pooled,
+            )
+
+    def configure_pools(self, eip_size: int = 0, sip_size: int = 0,
+                        max_idle: float = aws.pool.DEFAULT_MAX_IDLE):
+        """
+        Keep eip_size stopped instances and sip_size idle load balancers ready
+        for request_eip and request_sip of this deployment. Pooled resources
+        idle for longer than max_idle seconds are replaced. They are tagged as
+        pooled, and left out of active_eip and active_sip, until handed out.
+        """
+        for kind, size, provision, destroy, prepare in (
+                ("eip", eip_size, self._provision_pooled_eips, Instance.terminate, Instance.unpool_many),
+                ("sip", sip_size, self._provision_pooled_sips, LoadBalancer.terminate, LoadBalancer.unpool_many)):
+            pool = self._pool(kind)
+            if pool is None:
+                aws.pool.maintainer.register(aws.pool.WarmPool(
+                    f"{self.deployment_id}/{kind}", provision, destroy, size=size, max_idle=max_idle,
+                    prepare=prepare
+                ))
+            else:
+                pool.resize(size, max_idle)
+
+    def drain_pools(self):
+        """
+        Destroy the pooled resources of this deployment and stop refilling its pools.
+        """
+        for kind in ("eip", "sip"):
+            pool = self._pool(kind)
+            if pool is not None:
+                aws.pool.maintainer.unregister(pool)
+                pool.drain()
+
+    def _pool(self, kind: str) -> Optional[aws.pool.WarmPool]:
+        return aws.pool.maintainer.pools.get(f"{self.deployment_id}/{kind}")
+
+    def _provision_pooled_eips(self, count: int) -> [Instance]:
+        instances = self._create_instances([f"invisinet-pool-eip-{random_hex(5)}" for _ in range(count)],
+                                           pooled=True)
+        Instance.stop_many(instances)
+        return instances
 
+    def _provision_pooled_sips(self, count: int) -> [LoadBalancer]:
+        subnets = Subnet.create_many(
+            [f"invisinet-sip-subnet-{random_hex(5)}" for _ in range(count)], self._vpc
+        )
+        return clients.map_concurrently(
+            lambda subnet: LoadBalancer.create(f"invisinet-pool-sip-{random_hex(5)}", subnet=subnet,
+                                               vpc=self._vpc, pooled=True),
+            subnets, MAX_CONCURRENT_REQUESTS
+        )
+
+    @property
+    def _image(self):
+        """The image new instances of the current region are launched from."""
+        region = clients.current_region()
+        image_id = self.image_ids.get(region, self.image_id)
+        with self._regional_lock:
+            image = self._images.get((region, image_id))
+        if image is None:
+            image = Instance.get_images([image_id])[0]
+            with self._regional_lock:
+                self._images[(region, image_id)] = image
+        return image
+
+    @property
+    def _key_pair(self):
+        """
+        The key pair used for new instances of the current region, created if
+        it does not exist yet.
+        """
+        region = clients.current_region()
+        with self._regional_lock:
+            if region in self._key_pairs:
+                return self._key_pairs[region]
         key_pairs = self._ec2_client.describe_key_pairs()["KeyPairs"]
         key_pairs = list(
             filter(
@@ -63,109 +356,298 @@ class InvisinetAWS(Invisinet):
         )
         if len(key_pairs) == 0:
             logger.info(f"Creating a new ed25519 key pair {key_name}...")
-            self._ec2_client.create_key_pair(
-                KeyName=key_name, DryRun=False, KeyType="ed25519")
-
-        key = self._ec2_resource.KeyPair(key_name)
-
-        instance_type = "t2.micro"
-        ec2_instance = Instance.create(
-            name=name,
-            image=image,
-            instance_type=instance_type,
-            key_pair=key,
-            subnet_id=subnet.subnet_id,
-        )
-        logger.info("Process finished.")
-
-        if self.teardown:
-            logger.info(f"Tearing down...")
-            ec2_instance.terminate()
-            logger.info("Done.")
+            try:
+                self._ec2_client.create_key_pair(
+                    KeyName=key_name, DryRun=False, KeyType="ed25519")
+            except ClientError as err:
+                # Another request created the key pair concurrently
+                if err.response['Error']['Code'] != "InvalidKeyPair.Duplicate":
+                    raise
 
-        return ec2_instance
+        key_pair = self._ec2_resource.KeyPair(key_name)
+        with self._regional_lock:
+            self._key_pairs[region] = key_pair
+        return key_pair
 
-    def active_eip(self) -> [EndpointIP]:
-        instances = self._ec2_client.describe_instances(
-            Filters=[
-                {
-                    "Name": "tag:InvisinetsDeployment",
-                    "Values": ["true"]
-                }
-            ]
-        )["Reservations"]["Instances"]
-        return [Instance.load(i["InstanceId"]) for i in instances]
+    @metrics.instrument("aws")
+    def active_eip(self) -> Iterator[EndpointIP]:
+        """
+        The instances of this deployment in every region, listed page by page
+        as they are consumed. Pooled instances are left out.
+        """
+        for region, vpc in self._vpcs.items():
+            with clients.region(region):
+                instances = Instance.load_many(filters=[
+                    {
+                        "Name": "vpc-id",
+                        "Values": [vpc.vpc_id]
+                    },
+                    {
+                        "Name": "tag:InvisinetsDeployment",
+                        "Values": ["true"]
+                    },
+                    {
+                        "Name": "instance-state-name",
+                        "Values": ["pending", "running", "stopping", "stopped"]
+                    },
+                ])
+            yield from (instance for instance in instances if not instance.pooled)
 
     @transactions.actions.ResourceAction.register()
-    def request_sip(self, name: Optional[str] = None) -> ServiceIP:
-        subnet = Subnet.create(f"invisinet-sip-subnet-{random_hex(5)}", self._vpc)
-
-        lb_wrapper = LoadBalancer()
+    @metrics.instrument("aws")
+    def request_sip(self, name: Optional[str] = None, region: Optional[str] = None) -> ServiceIP:
+        """
+        Provision a load balancer in a new subnet, in the primary region
+        unless another region of the deployment is given.
+        """
         name = name or f"invisinet-sip-{random_hex(5)}"
-        arn = lb_wrapper.create(name, subnet=subnet,
-                                vpc=self._vpc)
+        vpc = self._regional_vpc(region)
+        with clients.region(vpc.region):
+            return self._request_sip(name, vpc)
+
+    def _request_sip(self, name: str, vpc: VPC) -> ServiceIP:
+        # Pooled load balancers live in the primary region
+        pool = self._pool("sip") if vpc is self._vpc else None
+        lb_wrapper = pool.acquire() if pool is not None else None
+        if lb_wrapper is not None:
+            transactions.journal.record("aws", "load_balancer", lb_wrapper.arn)
+            for target_group_arn in lb_wrapper.target_group_arn:
+                transactions.journal.record("aws", "target_group", target_group_arn)
+            for listener_arn in lb_wrapper.listener_arn:
+                transactions.journal.record("aws", "listener", listener_arn)
+            lb_wrapper.set_name(name)
+            logger.info("Process finished.")
+            return lb_wrapper
+
+        subnet = Subnet.create(f"invisinet-sip-subnet-{random_hex(5)}", vpc)
+        lb_wrapper = LoadBalancer.create(name, subnet=subnet,
+                                         vpc=vpc)
         logger.info("Process finished.")
         return lb_wrapper
 
-    def active_sip(self) -> [ServiceIP]:
-        instances = self._elb_client.client.describe_load_balancers(
-            Filters=[
-                {
-                    "Name": "tag:InvisinetsDeployment",
-                    "Value": ["true"]
-                }
-            ]
-        )["LoadBalancers"]
-        return [LoadBalancer(i["LoadBalancerArn"]) for i in instances]
-
-    @transactions.actions.Action.register(undo_callback=lambda: None)
-    def bind(self, sip: ServiceIP, eip: EndpointIP):
-        target_group = self._elb_client.describe_target_groups(
-            LoadBalancerArn=sip,
-        )["TargetGroups"][0]["TargetGroupArn"]
-        self._elb_client.register_targets(
-            TargetGroupArn=target_group,
-            Targets=[{
-                    "Id": eip.endpoint_id,
-            }]
-        )
+    @metrics.instrument("aws")
+    def active_sip(self) -> Iterator[ServiceIP]:
+        """
+        The load balancers of this deployment in every region, listed page by
+        page as they are consumed. Pooled load balancers are left out.
+        """
+        for region, vpc in self._vpcs.items():
+            with clients.region(region):
+                load_balancers = LoadBalancer.load_many(vpc_id=vpc.vpc_id)
+            yield from (load_balancer for load_balancer in load_balancers if not load_balancer.pooled)
+
+    @transactions.actions.Action.register(undo_callback=lambda result: InvisinetAWS._unbind(result))
+    @metrics.instrument("aws")
+    def bind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        """
+        Register one or more instances as targets of the load balancer.
+        """
+        result = self._change_targets("register_targets", sip, eips)
+        logger.info("Process finished.")
+        return result
+
+    @transactions.actions.Action.register(undo_callback=lambda result: InvisinetAWS._bind(result))
+    @metrics.instrument("aws")
+    def unbind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        """
+        Deregister one or more instances from the targets of the load balancer.
+        """
+        result = self._change_targets("deregister_targets", sip, eips)
         logger.info("Process finished.")
+        return result
+
+    @classmethod
+    def _change_targets(cls, change: str, sip: ServiceIP,
+                        eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        """
+        Register or deregister targets in as few requests as possible, in the
+        region of the load balancer. The targets of a batch that fails are
+        retried one by one to tell which of them failed.
+        """
+        eips = [eips] if isinstance(eips, EndpointIP) else list(eips)
+        result = BindResult(sip)
+        if len(eips) == 0:
+            return result
+
+        with clients.region(sip.region):
+            change = getattr(cls._elb_client, change)
+            target_group = sip.target_group_arn[0]
+            batches = [eips[i:i + MAX_TARGETS_PER_REQUEST] for i in range(0, len(eips), MAX_TARGETS_PER_REQUEST)]
+            while batches:
+                batch = batches.pop(0)
+                try:
+                    change(
+                        TargetGroupArn=target_group,
+                        Targets=[{"Id": eip.endpoint_id} for eip in batch]
+                    )
+                except ClientError as err:
+                    if len(batch) > 1:
+                        logger.info(f"Retrying {len(batch)} targets one by one: {err}")
+                        batches[:0] = [[eip] for eip in batch]
+                        continue
+                    error = err.response["Error"]
+                    result.failed.append((batch[0], f"{error['Code']}: {error['Message']}"))
+                else:
+                    result.succeeded.extend(batch)
+        return result
+
+    @classmethod
+    def _bind(cls, result: BindResult):
+        cls._change_targets("register_targets", result.sip, result.succeeded)
+
+    @classmethod
+    def _unbind(cls, result: BindResult):
+        cls._change_targets("deregister_targets", result.sip, result.succeeded)
 
-    @transactions.actions.Action.register(undo_callback=lambda: None)
+    @transactions.actions.Action.register(undo_callback=lambda ops: InvisinetAWS._apply_route_ops(routes.invert(ops)))
+    @metrics.instrument("aws")
     def annotate(self,
                  endpoints: (EndpointIP, EndpointIP),
-                 middlebox: Instance):
+                 middlebox: Instance) -> [routes.RouteOp]:
+        return self._annotate([endpoints], middlebox)
 
-        subnet_wrappers = (
-            Subnet(endpoints[0].subnet_id),
-            Subnet(endpoints[1].subnet_id)
-        )
-        route_table = self._ec2_resource.RouteTable(subnet_wrappers[0].route_table_id)
-        route_table.create_route(
-            DestinationCidrBlock=subnet_wrappers[1].cidr,
-            InstanceId=middlebox.endpoint_id
-        )
+    @transactions.actions.Action.register(undo_callback=lambda ops: InvisinetAWS._apply_route_ops(routes.invert(ops)))
+    @metrics.instrument("aws")
+    def annotate_many(self, pairs: [(EndpointIP, EndpointIP)], middlebox: Instance,
+                      prune: bool = False) -> [routes.RouteOp]:
+        """
+        Route the traffic between every pair of endpoints through the
+        middlebox. With prune, routes through the middlebox that are not
+        wanted anymore are deleted from the affected route tables.
+        """
+        return self._annotate(pairs, middlebox, prune)
 
-        route_table = self._ec2_resource.RouteTable(subnet_wrappers[1].route_table_id)
-        route_table.create_route(
-            DestinationCidrBlock=subnet_wrappers[0].cidr,
-            InstanceId=middlebox.endpoint_id
-        )
-        logger.info("Process finished.")
+    def _annotate(self, pairs: [(EndpointIP, EndpointIP)], middlebox: Instance,
+                  prune: bool = False) -> [routes.RouteOp]:
+        """
+        Read every affected route table once and only change the routes that
+        differ from the wanted ones, so annotating again changes nothing.
+        Return the changes made.
+        """
+        with clients.region(middlebox.region):
+            subnets = Subnet.load_many([endpoint.subnet_id for pair in pairs for endpoint in pair])
+        desired = routes.middlebox_routes([
+            (subnets[first.subnet_id].route_table_id, subnets[first.subnet_id].cidr,
+             subnets[second.subnet_id].route_table_id, subnets[second.subnet_id].cidr)
+            for first, second in pairs
+        ], middlebox.endpoint_id)
+        with clients.region(middlebox.region):
+            current = self._current_routes(list(desired))
+        ops = [
+            op
+            for route_table_id, table_routes in desired.items()
+            for op in routes.diff(route_table_id, current[route_table_id], table_routes,
+                                  owned=lambda target: prune and target == middlebox.endpoint_id,
+                                  region=middlebox.region)
+        ]
+        self._apply_route_ops(ops)
+        logger.info(f"Process finished. {len(ops)} routes changed in {len(desired)} route tables.")
+        return ops
 
-    def set_permit_list(self, sg_id, sg_permit_list):
+    @classmethod
+    def _current_routes(cls, route_table_ids: [str]) -> dict[str, dict[str, str]]:
         """
-        Update the rules in the security group for the VM
+        The routes of every route table, mapping destinations to next hops.
+        The local route of the VPC is left out.
         """
+        current = {route_table_id: {} for route_table_id in route_table_ids}
+        if len(route_table_ids) == 0:
+            return current
+        paginator = cls._ec2_client.get_paginator("describe_route_tables")
+        for page in paginator.paginate(RouteTableIds=route_table_ids):
+            for route_table in page["RouteTables"]:
+                for route in route_table["Routes"]:
+                    if "DestinationCidrBlock" not in route or route.get("GatewayId") == "local":
+                        continue
+                    target = next((route[key] for key in ROUTE_TARGET_KEYS.values() if key in route), None)
+                    current[route_table["RouteTableId"]][route["DestinationCidrBlock"]] = target
+        return current
+
+    @classmethod
+    def _apply_route_ops(cls, ops: [routes.RouteOp]):
+        """
+        Apply route changes, one route table at a time and to several tables
+        concurrently, each in the region of its operations.
+        """
+        tables = {}
+        for op in ops:
+            tables.setdefault(op.table, []).append(op)
+
+        def apply(table_ops: [routes.RouteOp]):
+            with clients.region(table_ops[0].region):
+                apply_in_region(table_ops)
+
+        def apply_in_region(table_ops: [routes.RouteOp]):
+            for op in table_ops:
+                route = {"RouteTableId": op.table, "DestinationCidrBlock": op.destination}
+                if op.action == routes.DELETE:
+                    cls._ec2_client.delete_route(**route)
+                    continue
+                target_key = next((key for prefix, key in ROUTE_TARGET_KEYS.items()
+                                   if op.target.startswith(prefix)), "GatewayId")
+                route[target_key] = op.target
+                if op.action == routes.CREATE:
+                    cls._ec2_client.create_route(**route)
+                else:
+                    cls._ec2_client.replace_route(**route)
+
+        clients.map_concurrently(apply, tables.values(), MAX_CONCURRENT_REQUESTS)
+
+    @metrics.instrument("aws")
+    def set_permit_list(self, sg_id: str, permit_list: [permits.Permit],
+                        directions: Optional[set[str]] = None,
+                        region: Optional[str] = None) -> ([permits.Permit], [permits.Permit]):
+        """
+        Make the rules of the security group allow exactly the compiled permit
+        list, in the given directions or else in both, so that an empty list
+        revokes every rule. Only the rules that differ are changed, and rules
+        that do not allow a CIDR block, such as rules referencing other
+        security groups, are left alone. Return the permits added and removed.
+        """
+        with clients.region(region):
+            return self._set_permit_list(sg_id, permit_list, directions)
+
+    def _set_permit_list(self, sg_id: str, permit_list: [permits.Permit],
+                         directions: Optional[set[str]]) -> ([permits.Permit], [permits.Permit]):
+        desired = permits.compile(permit_list)
+        directions = directions if directions is not None else {permits.INBOUND, permits.OUTBOUND}
+        rule_ids = {}
+        paginator = self._ec2_client.get_paginator("describe_security_group_rules")
+        for page in paginator.paginate(Filters=[{"Name": "group-id", "Values": [sg_id]}]):
+            for rule in page["SecurityGroupRules"]:
+                permit = _permit_from_rule(rule)
+                if permit is not None and permit.direction in directions:
+                    rule_ids[permit] = rule["SecurityGroupRuleId"]
+        added, removed = permits.diff(rule_ids, [permit for permit in desired if permit.direction in directions])
+
+        logger.info(f"Updating security group rules for security group: {sg_id}")
+        modified = []
+        for direction in directions:
+            additions = [permit for permit in added if permit.direction == direction]
+            removals = [permit for permit in removed if permit.direction == direction]
+            # A rule that is not wanted anymore is rewritten into a missing one
+            modified += list(zip(removals, additions))
+            authorize, revoke = additions[len(removals):], removals[len(additions):]
+            if authorize:
+                change = self._ec2_client.authorize_security_group_ingress if direction == permits.INBOUND \
+                    else self._ec2_client.authorize_security_group_egress
+                change(GroupId=sg_id, IpPermissions=[_ip_permission(permit) for permit in authorize])
+            if revoke:
+                change = self._ec2_client.revoke_security_group_ingress if direction == permits.INBOUND \
+                    else self._ec2_client.revoke_security_group_egress
+                change(GroupId=sg_id, SecurityGroupRuleIds=[rule_ids[permit] for permit in revoke])
+        if modified:
+            self._ec2_client.modify_security_group_rules(
+                GroupId=sg_id,
+                SecurityGroupRules=[
+                    {"SecurityGroupRuleId": rule_ids[old], "SecurityGroupRule": _security_group_rule(new)}
+                    for old, new in modified
+                ]
+            )
         logger.info(
-            f"Updating security group rules for security group: {sg_id}")
-        response = self._ec2_client.modify_security_group_rules(
-            GroupId=sg_id,
-            SecurityGroupRules=sg_permit_list,
-            DryRun=False
-        )
-        logger.info(
-            f"Successfully updated security group rules for security group: {sg_id}")
+            f"Successfully updated security group rules for security group: {sg_id}, "
+            f"{len(added)} permits added and {len(removed)} removed")
+        return added, removed
 
     def _describe_security_groups(self):
         """
@@ -179,45 +661,38 @@ class InvisinetAWS(Invisinet):
         )
         return response['SecurityGroups']
 
-    def set_tag(self, load_balancer, tags_request):
-        # First remove the existing tags
-        describe_tags_response = self._ec2_client.describe_tags(
-            LoadBalancerNames=[
-                load_balancer,
-            ],
-        )
-        tags = []
-        if describe_tags_response:
-            tags = describe_tags_response['TagDescriptions']['Tags']
-        for tag in tags:
-            response = self._ec2_client.remove_tags(
-                LoadBalancerNames=[
-                    load_balancer,
-                ],
-                Tags=[
-                    {
-                        'Key': tag,
-                    },
-                ]
-            )
-        logger.info(
-            f"Successfully removed tags for load balancer: {load_balancer} "
-            f"tags: {tags}"
-        )
-        # Add new tags
-        for key, value in tags_request:
-            response = self._ec2_client.add_tags(
-                LoadBalancerNames=[
-                    load_balancer,
-                ],
-                Tags=[
-                    {
-                        'Key': key,
-                        'Value': value
-                    },
+    @metrics.instrument("aws")
+    def set_tag(self, resource: Resource, tags: dict[str, str]) -> aws.tags.TagChanges:
+        """
+        Replace the tags of an instance or load balancer, keeping the tags
+        Invisinet relies on to track its resources.
+        """
+        return self.set_tags({resource: tags})
+
+    @metrics.instrument("aws")
+    def set_tags(self, tags: dict[Resource, dict[str, str]], replace: bool = True) -> aws.tags.TagChanges:
+        """
+        Bring the tags of many instances and load balancers to the given ones.
+        Only the tags that differ are changed, with one request per batch of
+        resources getting the same change. Without ``replace``, tags missing
+        from the request are kept.
+        """
+        regions: dict[str, dict[str, dict[str, str]]] = {}
+        for resource, resource_tags in tags.items():
+            regions.setdefault(resource.region, {})[resource.endpoint_id] = resource_tags
+        changes = aws.tags.TagChanges()
+        for region, desired in regions.items():
+            with clients.region(region):
+                region_changes = aws.tags.reconcile(desired, replace=replace)
+            changes.added.update(region_changes.added)
+            changes.removed.update(region_changes.removed)
+        changed = changes.added.keys() | changes.removed.keys()
+        for resource in tags:
+            if isinstance(resource, Instance) and resource.endpoint_id in changed:
+                # Keep the tags the instance wrapper reads its name from current
+                resource.instance.meta.data["Tags"] = [
+                    {"Key": key, "Value": value}
+                    for key, value in aws.tags.index.get(resource.endpoint_id).items()
                 ]
-            )
-        logger.info(
-            f"Successfully updated tags for load balancer: {load_balancer} "
-            f"with tags: {tags_request}"
-        )
+        logger.info(f"Successfully updated tags for {len(tags)} resources")
+        return changes
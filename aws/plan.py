@@ -0,0 +1,134 @@
+import math
+import aws.tags
+import aws.inventory
+import transactions.plan
+from aws.main import InvisinetAWS, MAX_CONCURRENT_REQUESTS, MAX_TARGETS_PER_REQUEST
+from transactions.plan import Estimate, PlanEstimate
+from typing import Optional, Union
+
+# Default quotas of an account, by region except subnets, which are limited
+# per VPC. Running instances are limited in vCPUs, which depend on the
+# instance type, so their limit is left to the caller.
+QUOTAS = {
+    "vpcs": 5,
+    "subnets": 200,
+    "load_balancers": 50,
+}
+# Time new instances take to reach the running state when request_eip has
+# no recorded profile, in seconds
+DEFAULT_INSTANCE_START = 30.0
+__all__ = ["QUOTAS", "usage", "estimate"]
+
+
+def _region(deployment: InvisinetAWS, region: Optional[str]) -> str:
+    return region if region is not None else deployment.regions[0]
+
+
+def _count(items) -> int:
+    return len(items) if isinstance(items, (list, tuple)) else 1
+
+
+def _subnet_calls(count: int) -> dict[(str, str, str), int]:
+    # The VPC's subnets are listed once to carve the CIDR blocks
+    return {
+        ("aws", "ec2", "DescribeSubnets"): 1,
+        ("aws", "ec2", "CreateRouteTable"): count,
+        ("aws", "ec2", "CreateSubnet"): count,
+        ("aws", "ec2", "AssociateRouteTable"): count,
+    }
+
+
+def _request_eip(deployment: InvisinetAWS, name: Optional[str] = None,
+                 use_existing_vm_id: Optional[str] = None,
+                 count: Optional[int] = None,
+                 region: Union[str, list[str], None] = None) -> Estimate:
+    """Every instance gets its own subnet, pooled instances are not accounted for."""
+    regions = region if isinstance(region, list) else [_region(deployment, region)]
+    per_region = count or 1
+    result = Estimate(
+        results=per_region * len(regions) if count is not None or isinstance(region, list) else None,
+        concurrency=min(per_region, MAX_CONCURRENT_REQUESTS) * len(regions),
+        idle=DEFAULT_INSTANCE_START,
+    )
+    for current in regions:
+        for call, calls in {**_subnet_calls(per_region), ("aws", "ec2", "RunInstances"): per_region}.items():
+            result.calls[call] = result.calls.get(call, 0) + calls
+        result.quota[(current, "instances")] = per_region
+        result.quota[(current, "subnets")] = per_region
+    return result
+
+
+def _request_sip(deployment: InvisinetAWS, name: Optional[str] = None,
+                 region: Optional[str] = None) -> Estimate:
+    region = _region(deployment, region)
+    return Estimate(
+        calls={
+            **_subnet_calls(1),
+            ("aws", "elbv2", "CreateLoadBalancer"): 1,
+            ("aws", "elbv2", "CreateTargetGroup"): 1,
+            ("aws", "elbv2", "CreateListener"): 1,
+        },
+        quota={(region, "load_balancers"): 1, (region, "subnets"): 1},
+    )
+
+
+def _change_targets(call: str):
+    def model(deployment: InvisinetAWS, sip, eips) -> Estimate:
+        return Estimate(calls={("aws", "elbv2", call): math.ceil(_count(eips) / MAX_TARGETS_PER_REQUEST)})
+    return model
+
+
+def _annotate_many(deployment: InvisinetAWS, pairs: list, middlebox, prune: bool = False) -> Estimate:
+    """Routes already in place are not changed, so route creations are an upper bound."""
+    return Estimate(calls={
+        ("aws", "ec2", "DescribeSubnets"): 1,
+        ("aws", "ec2", "DescribeRouteTables"): 1,
+        ("aws", "ec2", "CreateRoute"): 2 * _count(pairs),
+    })
+
+
+transactions.plan.planner.register(InvisinetAWS.request_eip, "aws", _request_eip)
+transactions.plan.planner.register(InvisinetAWS.request_sip, "aws", _request_sip)
+transactions.plan.planner.register(InvisinetAWS.bind, "aws", _change_targets("RegisterTargets"))
+transactions.plan.planner.register(InvisinetAWS.unbind, "aws", _change_targets("DeregisterTargets"))
+transactions.plan.planner.register(InvisinetAWS.annotate, "aws",
+                                   lambda deployment, endpoints, middlebox: _annotate_many(
+                                       deployment, [endpoints], middlebox))
+transactions.plan.planner.register(InvisinetAWS.annotate_many, "aws", _annotate_many)
+
+
+def _unpooled(resource_ids: [str]) -> [str]:
+    return [resource_id for resource_id in resource_ids
+            if aws.tags.POOLED_TAG_KEY not in (aws.tags.index.get(resource_id) or {})]
+
+
+def usage(deployment: InvisinetAWS) -> dict[(str, str), int]:
+    """
+    The use of every quota in the regions of the deployment, from the last
+    inventory sweeps and without any request. Only resources tagged by
+    Invisinet and not waiting in a warm pool are counted, and region-wide
+    quotas are only known once every deployment of the region was swept.
+    """
+    used = {}
+    for region in deployment.regions:
+        swept = aws.inventory.cached(region)
+        if swept is not None:
+            used[(region, "vpcs")] = sum(len(found.vpcs) for found in swept.values())
+            used[(region, "instances")] = sum(len(_unpooled(found.instances)) for found in swept.values())
+            used[(region, "load_balancers")] = sum(len(_unpooled(found.load_balancers))
+                                                   for found in swept.values())
+        own = (aws.inventory.cached(region, deployment.deployment_id) or {}).get(deployment.deployment_id)
+        if own is not None:
+            used[(region, "subnets")] = len(own.subnets)
+    return used
+
+
+def estimate(deployment: InvisinetAWS, plan: Optional[transactions.plan.Plan] = None,
+             limits: Optional[dict[str, int]] = None) -> PlanEstimate:
+    """
+    Estimate a plan, the one recorded by the deployment in dry-run mode by
+    default, against the cached inventory and the default quotas updated
+    with ``limits``.
+    """
+    plan = plan if plan is not None else deployment.plan
+    return plan.estimate(usage(deployment), {**QUOTAS, **(limits or {})})
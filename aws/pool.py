@@ -0,0 +1,223 @@
+import time
+import attrs
+import logging
+import metrics
+import threading
+from typing import Any, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_IDLE = 3600.0
+DEFAULT_MAINTENANCE_INTERVAL = 30.0
+MAX_CONCURRENT_REFILLS = 4
+logger = logging.getLogger(__name__)
+__all__ = ["PoolStats", "WarmPool", "PoolMaintainer", "maintainer"]
+
+
+@attrs.define
+class PoolStats:
+    hits: int = 0
+    misses: int = 0
+    provisioned: int = 0
+    evicted: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+
+@attrs.define(eq=False)
+class _Entry:
+    resource: Any
+    since: float
+
+
+class WarmPool:
+    """
+    Keeps up to ``size`` pre-provisioned resources of one kind ready to be
+    handed out. Resources are handed out oldest first, once ``prepare`` was
+    called with them, and destroyed once they have been idle for longer than
+    ``max_idle`` seconds. Refilling is left to ``maintain``, which the
+    maintainer the pool is registered with calls in the background.
+    """
+
+    def __init__(self, name: str, provision: Callable[[int], list], destroy: Callable[[Any], None],
+                 size: int = 0, max_idle: float = DEFAULT_MAX_IDLE,
+                 prepare: Optional[Callable[[list], None]] = None):
+        self.name = name
+        self.provision = provision
+        self.destroy = destroy
+        self.prepare = prepare
+        self.size = size
+        self.max_idle = max_idle
+        self.stats = PoolStats()
+        self._entries: list[_Entry] = []
+        self._lock = threading.Lock()
+        self._maintaining = threading.Lock()
+        # Set when a maintenance was requested while another one was running
+        self._requested = False
+        self._maintainer: Optional["PoolMaintainer"] = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def acquire(self) -> Optional[Any]:
+        """Take a resource out of the pool, or return None when it is empty."""
+        acquired = self.acquire_many(1)
+        return acquired[0] if acquired else None
+
+    def acquire_many(self, count: int) -> list:
+        """Take up to ``count`` resources out of the pool."""
+        with self._lock:
+            acquired, self._entries = self._entries[:count], self._entries[count:]
+            self.stats.hits += len(acquired)
+            self.stats.misses += count - len(acquired)
+        if len(acquired) < count:
+            logger.debug(f"Pool {self.name} missed {count - len(acquired)} of {count} requests")
+        self._notify()
+        resources = [entry.resource for entry in acquired]
+        if self.prepare is not None and resources:
+            try:
+                self.prepare(resources)
+            except Exception:
+                # Resources that could not be handed out are not put back
+                self._destroy(resources, evicted=False)
+                raise
+        return resources
+
+    def resize(self, size: int, max_idle: Optional[float] = None):
+        self.size = size
+        if max_idle is not None:
+            self.max_idle = max_idle
+        self._notify()
+
+    def maintain(self) -> bool:
+        """
+        Evict idle resources and provision the missing ones. Returns False
+        without doing anything when another maintenance is in progress.
+        """
+        if not self._maintaining.acquire(blocking=False):
+            self._requested = True
+            return False
+        self._requested = False
+        try:
+            now = time.monotonic()
+            with self._lock:
+                evicted = [entry for entry in self._entries if now - entry.since > self.max_idle]
+                kept = [entry for entry in self._entries if now - entry.since <= self.max_idle]
+                evicted += kept[self.size:]
+                self._entries = kept[:self.size]
+                missing = self.size - len(self._entries)
+            self._destroy([entry.resource for entry in evicted])
+
+            if missing > 0:
+                logger.info(f"Refilling pool {self.name} with {missing} resources...")
+                with metrics.operation("pool_refill", "aws"):
+                    resources = self.provision(missing)
+                with self._lock:
+                    now = time.monotonic()
+                    self._entries.extend(_Entry(resource, now) for resource in resources)
+                    self.stats.provisioned += len(resources)
+            return True
+        finally:
+            self._maintaining.release()
+            if self._requested:
+                self._notify()
+
+    def drain(self):
+        """Destroy every pooled resource and stop refilling the pool."""
+        self.size = 0
+        with self._lock:
+            entries, self._entries = self._entries, []
+        self._destroy([entry.resource for entry in entries], evicted=False)
+
+    def _notify(self):
+        if self._maintainer is not None:
+            self._maintainer.notify(self)
+
+    def _destroy(self, resources: list, evicted: bool = True):
+        for resource in resources:
+            try:
+                self.destroy(resource)
+            except Exception as e:
+                logger.error(f"Could not destroy pooled resource of {self.name}: {e}")
+        if evicted:
+            with self._lock:
+                self.stats.evicted += len(resources)
+
+    def summary(self) -> dict:
+        return {
+            "pool": self.name,
+            "size": self.size,
+            "ready": len(self),
+            "hits": self.stats.hits,
+            "misses": self.stats.misses,
+            "hit_rate": self.stats.hit_rate,
+            "provisioned": self.stats.provisioned,
+            "evicted": self.stats.evicted,
+        }
+
+
+class PoolMaintainer:
+    """
+    Background thread maintaining every registered pool: each pool is
+    maintained right after resources are taken from it, and every
+    ``interval`` seconds to evict idle resources.
+    """
+
+    def __init__(self, interval: float = DEFAULT_MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self.pools: dict[str, WarmPool] = {}
+        self._due: set[str] = set()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REFILLS,
+                                            thread_name_prefix="invisinet-pool")
+
+    def register(self, pool: WarmPool):
+        with self._condition:
+            self.pools[pool.name] = pool
+            pool._maintainer = self
+        self.notify(pool)
+
+    def unregister(self, pool: WarmPool):
+        with self._condition:
+            self.pools.pop(pool.name, None)
+            self._due.discard(pool.name)
+            pool._maintainer = None
+
+    def notify(self, pool: WarmPool):
+        with self._condition:
+            if pool.name not in self.pools:
+                return
+            self._due.add(pool.name)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="invisinet-pool-maintainer", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def summary(self) -> [dict]:
+        with self._condition:
+            pools = list(self.pools.values())
+        return [pool.summary() for pool in pools]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._due:
+                    self._condition.wait(self.interval)
+                due = [self.pools[name] for name in (self._due or self.pools) if name in self.pools]
+                self._due.clear()
+            for pool in due:
+                self._executor.submit(self._maintain, pool)
+
+    @staticmethod
+    def _maintain(pool: WarmPool):
+        try:
+            pool.maintain()
+        except Exception as e:
+            logger.error(f"Maintaining pool {pool.name} failed: {e}")
+
+
+maintainer = PoolMaintainer()
@@ -0,0 +1,355 @@
+import json
+import attrs
+import clients
+import hashlib
+import logging
+import metrics
+import permits
+import aws.tags
+import transactions
+import transactions.plan
+import transactions.context
+import transactions.actions
+from aws.main import InvisinetAWS, MAX_CONCURRENT_REQUESTS
+from aws.endpoint import Instance
+from aws.service import LoadBalancer
+from transactions.actions import ActionHandle
+from typing import Optional, Union
+
+# Tag holding the digest of the spec a resource was last converged to
+SPEC_TAG = "InvisinetSpec"
+# Resources kept in the warm pools of a deployment, which specs do not name
+POOLED_NAME_PREFIX = "invisinet-pool-"
+logger = logging.getLogger(__name__)
+__all__ = ["EndpointSpec", "ServiceSpec", "AnnotationSpec", "DeploymentSpec", "Changes", "SPEC_TAG", "reconcile"]
+
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()[:16]
+
+
+@attrs.define
+class EndpointSpec:
+    """
+    An instance, known by its name, in the primary region of the deployment
+    unless another one is given. Its security groups allow exactly the
+    permit list, or are left alone without one.
+    """
+    name: str
+    region: Optional[str] = None
+    tags: dict[str, str] = attrs.Factory(dict)
+    permit_list: Optional[list[permits.Permit]] = None
+
+    def digest(self) -> str:
+        permit_list = None if self.permit_list is None else [attrs.astuple(permit)
+                                                         for permit in permits.compile(self.permit_list)]
+        return _digest({"tags": self.tags, "permits": permit_list})
+
+
+@attrs.define
+class ServiceSpec:
+    """A load balancer, known by its name, and the endpoints it targets."""
+    name: str
+    region: Optional[str] = None
+    targets: list[str] = attrs.Factory(list)
+    tags: dict[str, str] = attrs.Factory(dict)
+
+    def digest(self) -> str:
+        return _digest({"tags": self.tags, "targets": sorted(self.targets)})
+
+
+@attrs.define(frozen=True, order=True)
+class AnnotationSpec:
+    """Traffic between two endpoints routed through a middlebox endpoint."""
+    first: str
+    second: str
+    middlebox: str
+
+
+@attrs.define
+class DeploymentSpec:
+    """
+    The endpoints, services and annotations a deployment should have. With
+    ``prune``, endpoints and services of the deployment missing from the
+    spec are terminated, and routes through the middleboxes that are not
+    wanted anymore are deleted from the annotated route tables.
+    """
+    endpoints: list[EndpointSpec] = attrs.Factory(list)
+    services: list[ServiceSpec] = attrs.Factory(list)
+    annotations: list[AnnotationSpec] = attrs.Factory(list)
+    prune: bool = False
+
+    def validate(self, primary: str):
+        endpoints = {endpoint.name: endpoint for endpoint in self.endpoints}
+        if len(endpoints) != len(self.endpoints) or len({service.name for service in self.services}) \
+                != len(self.services):
+            raise ValueError("Endpoint and service names must be unique")
+        for service in self.services:
+            for target in service.targets:
+                if target not in endpoints:
+                    raise ValueError(f"Service {service.name} targets unknown endpoint {target}")
+                if (endpoints[target].region or primary) != (service.region or primary):
+                    raise ValueError(f"Service {service.name} and its target {target} are in different regions")
+        for annotation in self.annotations:
+            for name in attrs.astuple(annotation):
+                if name not in endpoints:
+                    raise ValueError(f"Annotation {annotation} refers to unknown endpoint {name}")
+
+    def annotations_digest(self) -> str:
+        return _digest({"annotations": [attrs.astuple(annotation) for annotation in sorted(self.annotations)],
+                        "prune": self.prune})
+
+
+@attrs.define
+class Changes:
+    """Names of the endpoints and services changed to converge to a spec."""
+    created: list[str] = attrs.Factory(list)
+    updated: list[str] = attrs.Factory(list)
+    deleted: list[str] = attrs.Factory(list)
+    annotated: bool = False
+
+    def __bool__(self) -> bool:
+        return bool(self.created or self.updated or self.deleted or self.annotated)
+
+
+def _resource_id(resource: Union[str, Instance, LoadBalancer]) -> str:
+    return resource if isinstance(resource, str) else resource.endpoint_id
+
+
+def _restore_permits(result: (InvisinetAWS, str, [(str, [permits.Permit])], set)):
+    deployment, region, groups, directions = result
+    for sg_id, previous in groups:
+        deployment.set_permit_list(sg_id, previous, directions, region)
+
+
+@transactions.actions.Action.register(undo_callback=_restore_permits)
+@metrics.instrument("aws")
+def _set_endpoint_permits(deployment: InvisinetAWS, endpoint: Instance,
+                          permit_list: [permits.Permit]) -> (InvisinetAWS, str, [(str, [permits.Permit])], set):
+    """
+    Make the security groups of the endpoint allow exactly the permit list.
+    Return what rolling back needs to restore the previous rules.
+    """
+    desired = permits.compile(permit_list)
+    directions = {permits.INBOUND, permits.OUTBOUND}
+    groups = []
+    for group in endpoint.instance.security_groups:
+        added, removed = deployment.set_permit_list(group["GroupId"], desired, directions, endpoint.region)
+        groups.append((group["GroupId"], sorted(set(desired) - set(added) | set(removed))))
+    return deployment, endpoint.region, groups, directions
+
+
+@transactions.actions.Action.register(undo_callback=lambda changes: None)
+@metrics.instrument("aws")
+def _set_spec_tags(deployment: InvisinetAWS, region: str,
+                   resources: [(Union[str, Instance, LoadBalancer], dict[str, str])],
+                   vpc_tags: Optional[dict[str, str]] = None) -> aws.tags.TagChanges:
+    """
+    Bring the tags of the converged resources of a region to the spec,
+    including the digests marking them converged. Runs after every other
+    change, so a failed convergence is retried in full next time.
+    """
+    with clients.region(region):
+        changes = aws.tags.reconcile({_resource_id(resource): tags for resource, tags in resources})
+        if vpc_tags is not None:
+            vpc_changes = aws.tags.reconcile({deployment._regional_vpc(region).vpc_id: vpc_tags}, replace=False)
+            changes.added.update(vpc_changes.added)
+    return changes
+
+
+# Terminated resources cannot be brought back
+@transactions.actions.Action.register(undo_callback=lambda resources: None)
+@metrics.instrument("aws")
+def _terminate_unspecified(deployment: InvisinetAWS,
+                           resources: [Union[Instance, LoadBalancer]]) -> [Union[Instance, LoadBalancer]]:
+    def terminate(resource: Union[Instance, LoadBalancer]):
+        with clients.region(resource.region):
+            resource.terminate()
+
+    clients.map_concurrently(terminate, resources, MAX_CONCURRENT_REQUESTS)
+    return resources
+
+
+def _set_endpoint_permits_cost(deployment: InvisinetAWS, endpoint, permit_list) -> transactions.plan.Estimate:
+    """One security group, its rules changed in one request."""
+    return transactions.plan.Estimate(calls={
+        ("aws", "ec2", "DescribeSecurityGroupRules"): 1,
+        ("aws", "ec2", "ModifySecurityGroupRules"): 1,
+    })
+
+
+def _set_spec_tags_cost(deployment: InvisinetAWS, region: str, resources: list,
+                        vpc_tags: Optional[dict[str, str]] = None) -> transactions.plan.Estimate:
+    """One request per distinct set of tags, names aside."""
+    tag_sets = {frozenset((key, value) for key, value in tags.items() if key != "Name") for _, tags in resources}
+    return transactions.plan.Estimate(calls={("aws", "ec2", "CreateTags"): len(tag_sets) + (vpc_tags is not None)})
+
+
+def _terminate_unspecified_cost(deployment: InvisinetAWS, resources: list) -> transactions.plan.Estimate:
+    estimate = transactions.plan.Estimate(concurrency=max(1, min(len(resources), MAX_CONCURRENT_REQUESTS)))
+    for resource in resources:
+        if isinstance(resource, LoadBalancer):
+            calls = {("aws", "elbv2", "DeleteListener"): 1, ("aws", "elbv2", "DeleteTargetGroup"): 1,
+                     ("aws", "elbv2", "DeleteLoadBalancer"): 1}
+            quota = (resource.region, "load_balancers")
+        else:
+            calls = {("aws", "ec2", "TerminateInstances"): 1}
+            quota = (resource.region, "instances")
+        for call, count in calls.items():
+            estimate.calls[call] = estimate.calls.get(call, 0) + count
+        estimate.quota[quota] = estimate.quota.get(quota, 0) - 1
+    return estimate
+
+
+transactions.plan.planner.register(_set_endpoint_permits, "aws", _set_endpoint_permits_cost)
+transactions.plan.planner.register(_set_spec_tags, "aws", _set_spec_tags_cost)
+transactions.plan.planner.register(_terminate_unspecified, "aws", _terminate_unspecified_cost)
+
+
+def _live(deployment: InvisinetAWS) -> (dict[str, list], dict[str, list]):
+    """
+    The running endpoints and the services of the deployment by name, with
+    their current tags. Takes one listing of the instances, one of the load
+    balancers and one describe of their tags per region.
+    """
+    endpoints, services = {}, {}
+    for instance in deployment.active_eip():
+        name = (aws.tags.index.get(instance.endpoint_id) or {}).get("Name")
+        if name is not None and not name.startswith(POOLED_NAME_PREFIX):
+            endpoints.setdefault(name, []).append(instance)
+
+    load_balancers = {}
+    for load_balancer in deployment.active_sip():
+        load_balancers.setdefault(load_balancer.region, []).append(load_balancer)
+    for region in deployment.regions:
+        with clients.region(region):
+            found = load_balancers.get(region, [])
+            aws.tags.describe([load_balancer.arn for load_balancer in found]
+                              + [deployment._regional_vpc(region).vpc_id], refresh=True)
+        for load_balancer in found:
+            name = aws.tags.index.get(load_balancer.arn).get("Name")
+            if name is not None and not name.startswith(POOLED_NAME_PREFIX):
+                services.setdefault(name, []).append(load_balancer)
+    return endpoints, services
+
+
+def _spec_digest(resource_id: str) -> Optional[str]:
+    return (aws.tags.index.get(resource_id) or {}).get(SPEC_TAG)
+
+
+@metrics.instrument("aws", "reconcile")
+def reconcile(deployment: InvisinetAWS, spec: DeploymentSpec,
+              max_workers: int = transactions.context.DEFAULT_MAX_WORKERS) -> Changes:
+    """
+    Converge the deployment to the spec, changing only the endpoints and
+    services whose spec changed since they were last converged, as told by
+    the digest tagged on them. The changes run as one transaction, as many
+    at once as their dependencies allow. Within a transaction or a plan
+    already started, or for a deployment in dry-run mode, the changes are
+    queued there instead.
+    """
+    primary = deployment.regions[0]
+    spec.validate(primary)
+    for region in {endpoint.region for endpoint in spec.endpoints} | {service.region for service in spec.services}:
+        if region is not None and region not in deployment.regions:
+            if deployment.dryrun:
+                raise ValueError(f"Deployment {deployment.deployment_id} has no VPC in {region}, "
+                                 f"call add_region before planning")
+            deployment.add_region(region)
+
+    live_endpoints, live_services = _live(deployment)
+    changes = Changes()
+    started = isinstance(transactions.context.current(), transactions.context.MultiActionContext)
+    if not started:
+        transactions.begin(max_workers=max_workers)
+    handles: [ActionHandle] = []
+    tags: dict[str, list] = {}
+    unspecified = [resource for found in live_endpoints.values() for resource in found[1:]] \
+        + [resource for found in live_services.values() for resource in found[1:]]
+
+    endpoints: dict[str, Union[Instance, ActionHandle]] = {}
+    for endpoint in spec.endpoints:
+        region = endpoint.region or primary
+        live = live_endpoints.get(endpoint.name, [None])[0]
+        if live is not None and live.region != region:
+            unspecified.append(live)
+            live = None
+        if live is None:
+            endpoints[endpoint.name] = deployment.request_eip(endpoint.name, region=region)
+            handles.append(endpoints[endpoint.name])
+            changes.created.append(endpoint.name)
+        else:
+            endpoints[endpoint.name] = live
+            if _spec_digest(live.endpoint_id) == endpoint.digest():
+                continue
+            changes.updated.append(endpoint.name)
+        if endpoint.permit_list is not None:
+            handles.append(_set_endpoint_permits(deployment, endpoints[endpoint.name], endpoint.permit_list))
+        tags.setdefault(region, []).append((endpoints[endpoint.name], {
+            **endpoint.tags, "Name": endpoint.name, SPEC_TAG: endpoint.digest()
+        }))
+
+    for service in spec.services:
+        region = service.region or primary
+        live = live_services.get(service.name, [None])[0]
+        if live is not None and live.region != region:
+            unspecified.append(live)
+            live = None
+        if live is None:
+            sip = deployment.request_sip(service.name, region=region)
+            handles.append(sip)
+            changes.created.append(service.name)
+            current = set()
+        else:
+            sip = live
+            if _spec_digest(live.arn) == service.digest():
+                continue
+            changes.updated.append(service.name)
+            current = set(live.targets())
+        desired = {target: endpoints[target] for target in service.targets}
+        added = [endpoint for endpoint in desired.values()
+                 if isinstance(endpoint, ActionHandle) or endpoint.endpoint_id not in current]
+        kept = {endpoint.endpoint_id for endpoint in desired.values() if isinstance(endpoint, Instance)}
+        with clients.region(region):
+            removed = [Instance(Instance._resource.Instance(target_id)) for target_id in sorted(current - kept)]
+        if added:
+            handles.append(deployment.bind(sip, added))
+        if removed:
+            handles.append(deployment.unbind(sip, removed))
+        tags.setdefault(region, []).append((sip, {**service.tags, "Name": service.name, SPEC_TAG: service.digest()}))
+
+    vpc_tags = None
+    annotated = {name for annotation in spec.annotations for name in attrs.astuple(annotation)}
+    if _spec_digest(deployment._regional_vpc(primary).vpc_id) != spec.annotations_digest() \
+            or annotated & set(changes.created):
+        middleboxes: dict[str, list] = {}
+        for annotation in spec.annotations:
+            middleboxes.setdefault(annotation.middlebox, []).append(
+                (endpoints[annotation.first], endpoints[annotation.second]))
+        for middlebox, pairs in middleboxes.items():
+            handles.append(deployment.annotate_many(pairs, endpoints[middlebox], prune=spec.prune))
+        vpc_tags = {SPEC_TAG: spec.annotations_digest()}
+        changes.annotated = True
+
+    if spec.prune:
+        specified = {endpoint.name for endpoint in spec.endpoints} | {service.name for service in spec.services}
+        unspecified += [found[0] for name, found in {**live_endpoints, **live_services}.items()
+                        if name not in specified]
+        changes.deleted = sorted(resource.name for resource in unspecified)
+    elif unspecified:
+        logger.warning(f"Leaving {len(unspecified)} duplicate or moved resources in place, prune to delete them")
+
+    converged = list(handles)
+    if vpc_tags is not None:
+        tags.setdefault(primary, [])
+    for region, resources in tags.items():
+        handles.append(_set_spec_tags(deployment, region, resources, vpc_tags if region == primary else None,
+                                      depends_on=converged))
+    if spec.prune and unspecified:
+        _terminate_unspecified(deployment, unspecified, depends_on=handles)
+
+    if not started and transactions.commit() is None:
+        raise RuntimeError(f"Reconciling deployment {deployment.deployment_id} failed and was rolled back")
+    logger.info(f"Reconciled deployment {deployment.deployment_id}: {len(changes.created)} created, "
+                f"{len(changes.updated)} updated, {len(changes.deleted)} deleted")
+    return changes
@@ -1,10 +1,16 @@
 import uuid
-import boto3
+import clients
+import cache
 import logging
 import aws.vpc
+import aws.tags
 import aws.subnet
+import transactions.journal
+from botocore.exceptions import ClientError
 from _api import *
 
+DEFAULT_PAGE_SIZE = 400
+MAX_ARNS_PER_REQUEST = 20
 TLoadBalancer = TypeVar("TLoadBalancer", bound="LoadBalancer")
 logger = logging.getLogger(__name__)
 __all__ = ["LoadBalancer", "TLoadBalancer"]
@@ -12,7 +18,7 @@ __all__ = ["LoadBalancer", "TLoadBalancer"]
 
 class LoadBalancer(ServiceIP):
     
-    _elb_client = boto3.client('elbv2')
+    _elb_client = clients.AWSClient("elbv2")
     
     def __init__(self, arn: str) -> None:
         super().__init__()
@@ -22,38 +28,80 @@ class LoadBalancer(ServiceIP):
     def load(cls: Type[TLoadBalancer], arn: str) -> TLoadBalancer:
         return cls(arn)
 
+    @classmethod
+    def load_many(cls: Type[TLoadBalancer], arns: Optional[list[str]] = None,
+                  vpc_id: Optional[str] = None) -> Iterator[TLoadBalancer]:
+        """
+        Load the load balancers with the given ARNs, or all of them in the
+        current region, keeping the ones in the given VPC. Pages of
+        describe_load_balancers are only requested as the load balancers are
+        consumed.
+        """
+        # Bound now, so that the pages are requested in the current region
+        paginator = cls._elb_client.get_paginator("describe_load_balancers")
+        if arns is None:
+            requests = [{"PaginationConfig": {"PageSize": DEFAULT_PAGE_SIZE}}]
+        else:
+            requests = [{"LoadBalancerArns": arns[i:i + MAX_ARNS_PER_REQUEST]}
+                        for i in range(0, len(arns), MAX_ARNS_PER_REQUEST)]
+
+        def load_balancers() -> Iterator[TLoadBalancer]:
+            for request in requests:
+                for page in paginator.paginate(**request):
+                    for description in page["LoadBalancers"]:
+                        if vpc_id is None or description["VpcId"] == vpc_id:
+                            cache.attributes.put(description["LoadBalancerArn"], "description", description)
+                            yield cls(description["LoadBalancerArn"])
+
+        return load_balancers()
+
     @classmethod
     def create(cls: Type[TLoadBalancer], name: str, subnet: aws.subnet.Subnet,
-               vpc: aws.vpc.VPC, port: int = 80) -> TLoadBalancer:
+               vpc: aws.vpc.VPC, port: int = 80, pooled: bool = False) -> TLoadBalancer:
         """
-        Create an internet-facing load balancer. Return the load balancer ARN.
+        Create an internet-facing load balancer, tagged as pooled with
+        ``pooled``. Return the load balancer ARN.
         """
 
         if port < 0 or port > 65535:
             raise ValueError(f"Port number {port} is out of range")
-        
+
+        with clients.region(vpc.region):
+            return cls._create(name, subnet, vpc, port, pooled)
+
+    @classmethod
+    def _create(cls: Type[TLoadBalancer], name: str, subnet: aws.subnet.Subnet,
+                vpc: aws.vpc.VPC, port: int, pooled: bool) -> TLoadBalancer:
         logger.info("Creating network load balancer...")
+        tags = [
+            {
+                "Key": "Name",
+                "Value": name
+            },
+            {
+                "Key": "SubnetID",
+                "Value": subnet.subnet_id
+            },
+            {
+                "Key": "InvisinetsDeployment",
+                "Value": "true"
+            },
+            {
+                "Key": "DeploymentID",
+                "Value": vpc.deployment_id
+            },
+        ]
+        if pooled:
+            tags.append({"Key": aws.tags.POOLED_TAG_KEY, "Value": "true"})
         response = cls._elb_client.create_load_balancer(
             Name=name,
             Subnets=[subnet.subnet_id],
             Scheme="internet-facing",
             Type="network",
-            Tags=[
-                {
-                    "Key": "Name",
-                    "Value": name
-                },
-                {
-                    "Key": "SubnetID",
-                    "Value": subnet.subnet_id
-                },
-                {
-                    "Key": "InvisinetsDeployment",
-                    "Value": "true"
-                },
-            ],
+            Tags=tags,
         )
         arn = response["LoadBalancers"][0]["LoadBalancerArn"]
+        transactions.journal.record("aws", "load_balancer", arn)
         
         target_group_name = uuid.uuid4().hex
         logger.info(f"Creating target group {target_group_name}...")
@@ -65,48 +113,66 @@ class LoadBalancer(ServiceIP):
             TargetType="instance"
         )
         
+        target_group_arn = target_group["TargetGroups"][0]["TargetGroupArn"]
+        transactions.journal.record("aws", "target_group", target_group_arn)
+
         logger.info("Assigning target group to listener...")
-        cls._elb_client.create_listener(
+        listener = cls._elb_client.create_listener(
             LoadBalancerArn=arn,
             Protocol="TCP",
             Port=port,
             DefaultActions=[
                 {
                     "Type": "forward",
-                    "TargetGroupArn": target_group["TargetGroups"]
-                    [0]["TargetGroupArn"]
+                    "TargetGroupArn": target_group_arn
                 }
             ]
         )
+        transactions.journal.record("aws", "listener", listener["Listeners"][0]["ListenerArn"])
         logger.info("Success.")
 
+        cache.attributes.put(arn, "tags", {tag["Key"]: tag["Value"] for tag in tags})
+        aws.tags.index.put(arn, {tag["Key"]: tag["Value"] for tag in tags})
+        cache.attributes.put(arn, "target_group_arn", [target_group_arn])
+        cache.attributes.put(arn, "listener_arn", [listener["Listeners"][0]["ListenerArn"]])
         return cls(arn)
 
+    @property
+    @cache.cached(lambda self: self.arn)
+    @clients.regional
+    def tags(self) -> dict[str, str]:
+        assert self.arn is not None, "Load balancer not initialized."
+
+        return aws.tags.describe([self.arn])[self.arn]
+
     @property
     def name(self) -> str:
+        return self.tags["Name"]
+
+    @clients.regional
+    def set_name(self, name: str):
         assert self.arn is not None, "Load balancer not initialized."
 
-        response = self._elb_client.describe_tags(
-            ResourceArns=[self.arn]
+        self._elb_client.add_tags(
+            ResourceArns=[self.arn],
+            Tags=[{"Key": "Name", "Value": name}]
         )
-        response = list(filter(
-            lambda entry: entry["Key"] == "Name",
-            response["TagDescriptions"][0]["Tags"]
-        ))
-        return response[0]["Value"]
+        cache.attributes.put(self.arn, "tags", {**self.tags, "Name": name})
+        aws.tags.index.update(self.arn, {"Name": name})
 
     @property
     def subnet_id(self):
-        assert self.arn is not None, "Load balancer not initialized."
+        return self.tags["SubnetID"]
 
-        response = self._elb_client.describe_tags(
-            ResourceArns=[self.arn]
-        )
-        response = list(filter(
-            lambda entry: entry["Key"] == "SubnetID",
-            response["TagDescriptions"][0]["Tags"]
-        ))
-        return response[0]["Value"]
+    @property
+    def pooled(self) -> bool:
+        """Whether the load balancer waits in a warm pool."""
+        return aws.tags.POOLED_TAG_KEY in self.tags
+
+    @classmethod
+    def unpool_many(cls, load_balancers: ["LoadBalancer"]):
+        """Remove the pooled tag of load balancers handed out by a warm pool."""
+        aws.tags.untag([load_balancer.arn for load_balancer in load_balancers], [aws.tags.POOLED_TAG_KEY])
 
     @property
     def endpoint_id(self) -> str:
@@ -115,6 +181,14 @@ class LoadBalancer(ServiceIP):
         return self.arn
 
     @property
+    def region(self) -> str:
+        assert self.arn is not None, "Load balancer not initialized."
+
+        return self.arn.split(":")[3]
+
+    @property
+    @cache.cached(lambda self: self.arn)
+    @clients.regional
     def target_group_arn(self) -> [str]:
         assert self.arn is not None, "Load balancer not initialized."
 
@@ -124,6 +198,8 @@ class LoadBalancer(ServiceIP):
         return list(map(lambda elem: elem["TargetGroupArn"], response))
 
     @property
+    @cache.cached(lambda self: self.arn)
+    @clients.regional
     def listener_arn(self) -> [str]:
         assert self.arn is not None, "Load balancer not initialized."
 
@@ -132,6 +208,17 @@ class LoadBalancer(ServiceIP):
         )["Listeners"]
         return list(map(lambda elem: elem["ListenerArn"], response))
 
+    @clients.regional
+    def targets(self) -> [str]:
+        """The IDs of the instances registered as targets of the load balancer."""
+        assert self.arn is not None, "Load balancer not initialized."
+
+        response = self._elb_client.describe_target_health(
+            TargetGroupArn=self.target_group_arn[0],
+        )["TargetHealthDescriptions"]
+        return [description["Target"]["Id"] for description in response]
+
+    @clients.regional
     def terminate(self):
         assert self.arn is not None, "Load balancer not initialized."
 
@@ -148,12 +235,33 @@ class LoadBalancer(ServiceIP):
             )
             logger.info(f"Target group {target_group} deleted.")
 
+        subnet_id = self.subnet_id
         self._elb_client.delete_load_balancer(
             LoadBalancerArn=self.arn
         )
+        cache.attributes.invalidate(self.arn)
+        aws.tags.index.remove(self.arn)
         logger.info(f"Load balancer {self.arn} deleted.")
 
-        subnet = aws.subnet.Subnet(self.subnet_id)
+        subnet = aws.subnet.Subnet.load(subnet_id)
         subnet.deallocate()
 
         self.arn = None
+
+
+def _destroyer(delete: str, parameter: str):
+    def destroy(arn: str):
+        try:
+            getattr(LoadBalancer._elb_client, delete)(**{parameter: arn})
+        except ClientError as err:
+            if not err.response["Error"]["Code"].endswith("NotFound"):
+                raise
+        cache.attributes.invalidate(arn)
+        aws.tags.index.remove(arn)
+
+    return destroy
+
+
+transactions.journal.register_destroyer("aws", "load_balancer", _destroyer("delete_load_balancer", "LoadBalancerArn"))
+transactions.journal.register_destroyer("aws", "target_group", _destroyer("delete_target_group", "TargetGroupArn"))
+transactions.journal.register_destroyer("aws", "listener", _destroyer("delete_listener", "ListenerArn"))
@@ -1,8 +1,13 @@
-import boto3
+import clients
+import cache
 import logging
+import aws.tags
+import transactions.journal
 from aws.vpc import *
+from botocore.exceptions import ClientError
 from typing import Optional, TypeVar, Type
 
+MAX_CONCURRENT_REQUESTS = 16
 TSubnet = TypeVar("TSubnet", bound="Subnet")
 logger = logging.getLogger(__name__)
 __all__ = ["Subnet", "TSubnet"]
@@ -10,8 +15,8 @@ __all__ = ["Subnet", "TSubnet"]
 
 class Subnet:
 
-    _client = boto3.client("ec2")
-    _resource = boto3.resource("ec2")
+    _client = clients.AWSClient("ec2")
+    _resource = clients.AWSResource("ec2")
 
     def __init__(self, subnet):
         self.subnet = subnet
@@ -20,59 +25,179 @@ class Subnet:
     def load(cls: Type[TSubnet], subnet_id: str) -> Optional[TSubnet]:
         if subnet_id is not None:
             subnet = cls._resource.Subnet(subnet_id)
-            # Verify that the subnet is valid
-            subnet.load()
+            # Describing the subnet also verifies that it is valid
+            subnet.meta.data = cache.attributes.get(subnet_id, "description", lambda: cls._client.describe_subnets(
+                SubnetIds=[subnet_id]
+            )["Subnets"][0])
             return cls(subnet)
         else:
 
             return None
 
+    @classmethod
+    def load_many(cls: Type[TSubnet], subnet_ids: [str]) -> dict[str, TSubnet]:
+        """
+        Load several subnets, describing the ones missing from the cache with a single request.
+        """
+        subnet_ids = list(dict.fromkeys(subnet_ids))
+        missing = [subnet_id for subnet_id in subnet_ids if not cache.attributes.contains(subnet_id, "description")]
+        if missing:
+            paginator = cls._client.get_paginator("describe_subnets")
+            for page in paginator.paginate(SubnetIds=missing):
+                for description in page["Subnets"]:
+                    cache.attributes.put(description["SubnetId"], "description", description)
+        return {subnet_id: cls.load(subnet_id) for subnet_id in subnet_ids}
+
     @classmethod
     def create(cls: Type[TSubnet], name: str, vpc: VPC) -> TSubnet:
-        cidr = vpc.next_available_subnet_cidr()
-        logger.info(f"Creating subnet {name} {cidr} for VPC: {vpc.vpc_id}...")
-        response = cls._client.create_subnet(
-            VpcId=vpc.vpc_id,
-            CidrBlock=cidr,
-            TagSpecifications=[
+        return cls.create_many([name], vpc)[0]
+
+    @classmethod
+    def create_many(cls: Type[TSubnet], names: [str], vpc: VPC) -> [TSubnet]:
+        """
+        Create one subnet per name. The CIDR blocks are carved from a single
+        listing of the VPC's subnets, and the subnets are created concurrently.
+        When a subnet cannot be created, the CIDR blocks of the subnets that
+        were not created are returned to the allocator.
+        """
+        if len(names) == 0:
+            return []
+
+        cidrs = vpc.next_available_subnet_cidrs(len(names))
+        started = set()
+
+        def create(name: str, cidr: str) -> TSubnet:
+            started.add(cidr)
+            return cls._create(name, cidr, vpc)
+
+        try:
+            with clients.region(vpc.region):
+                return clients.map_concurrently(lambda args: create(*args), zip(names, cidrs),
+                                                MAX_CONCURRENT_REQUESTS)
+        except Exception:
+            # The first error stops the subnets not started yet
+            for cidr in cidrs:
+                if cidr not in started:
+                    VPC.free_subnet_cidr(vpc.vpc_id, cidr)
+            raise
+
+    @classmethod
+    def _discard(cls, vpc: VPC, cidr: str, route_table_id: Optional[str], subnet_id: Optional[str]):
+        """Delete what a failed subnet creation left behind, and free its CIDR block once it is unused."""
+        try:
+            if subnet_id is not None:
+                cls._client.delete_subnet(SubnetId=subnet_id)
+            VPC.free_subnet_cidr(vpc.vpc_id, cidr)
+            if route_table_id is not None:
+                cls._client.delete_route_table(RouteTableId=route_table_id)
+        except ClientError as e:
+            logger.error(f"Could not clean up subnet {cidr} of VPC {vpc.vpc_id}: {e}")
+
+    @classmethod
+    def _create(cls: Type[TSubnet], name: str, cidr: str, vpc: VPC) -> TSubnet:
+        """
+        Create a subnet with its own route table. Only the thread-safe client is
+        used here so that several subnets can be created in parallel. When a
+        request fails, what was created is deleted and the CIDR block freed.
+        """
+        route_table_id = subnet_id = None
+        try:
+            route_table_id = cls._client.create_route_table(
+                VpcId=vpc.vpc_id,
+                TagSpecifications=[
+                    {
+                        "ResourceType": "route-table",
+                        "Tags": [
+                            {
+                                "Key": "InvisinetsDeployment",
+                                "Value": "true"
+                            },
+                            {
+                                "Key": "DeploymentID",
+                                "Value": vpc.deployment_id
+                            }
+                        ]
+                    },
+                ]
+            )["RouteTable"]["RouteTableId"]
+            transactions.journal.record("aws", "route_table", route_table_id)
+
+            logger.info(f"Creating subnet {name} {cidr} for VPC: {vpc.vpc_id}...")
+            tags = [
                 {
-                    'ResourceType': 'subnet',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': name
-                        },
-                        {
-                            "Key": "InvisinetsDeployment",
-                            "Value": "true"
-                        }
-                    ]
+                    'Key': 'Name',
+                    'Value': name
+                },
+                {
+                    "Key": "InvisinetsDeployment",
+                    "Value": "true"
                 },
-            ]
-        )
-        subnet = cls._resource.Subnet(response["Subnet"]["SubnetId"])
-        subnet.load()
-        result = cls(subnet)
-        logger.info(f"Success. subnet_id: {result.subnet_id}.")
-
-        route_table = vpc.vpc.create_route_table()
-        route_table.associate_with_subnet(SubnetId=result.subnet_id)
-        subnet.create_tags(
-            Tags=[
                 {
                     "Key": "AssociatedRouteTableID",
-                    "Value": route_table.id
+                    "Value": route_table_id
+                },
+                {
+                    "Key": "DeploymentID",
+                    "Value": vpc.deployment_id
                 }
             ]
-        )
-        result.subnet.load()
+            response = cls._client.create_subnet(
+                VpcId=vpc.vpc_id,
+                CidrBlock=cidr,
+                TagSpecifications=[
+                    {
+                        'ResourceType': 'subnet',
+                        'Tags': tags
+                    },
+                ]
+            )
+            subnet_id = response["Subnet"]["SubnetId"]
+            transactions.journal.record("aws", "subnet", subnet_id)
+            cls._client.associate_route_table(
+                RouteTableId=route_table_id,
+                SubnetId=subnet_id
+            )
+        except Exception:
+            cls._discard(vpc, cidr, route_table_id, subnet_id)
+            raise
+
+        subnet = cls._resource.Subnet(subnet_id)
+        subnet.meta.data = {**response["Subnet"], "Tags": tags}
+        cache.attributes.put(subnet.id, "description", subnet.meta.data)
+        aws.tags.index.put(subnet.id, {tag["Key"]: tag["Value"] for tag in tags})
+        result = cls(subnet)
+        logger.info(f"Success. subnet_id: {result.subnet_id}.")
         return result
 
     def deallocate(self):
-        logger.info(f"Subnet {self.subnet_id} deleted.")
+        vpc_id, cidr = self.subnet.vpc_id, self.cidr
         self.subnet.delete()
+        self._deallocated(self.subnet_id, vpc_id, cidr)
         self.subnet = None
 
+    @classmethod
+    def deallocate_many(cls, subnets: [TSubnet]):
+        """
+        Delete several subnets of the current region concurrently. Only the
+        thread-safe client is used, so that the subnets can be deleted from
+        any thread.
+        """
+        def delete(entry: (str, str, str)):
+            cls._client.delete_subnet(SubnetId=entry[0])
+            cls._deallocated(*entry)
+
+        clients.map_concurrently(delete, [(subnet.subnet_id, subnet.subnet.vpc_id, subnet.cidr) for subnet in subnets],
+                                 MAX_CONCURRENT_REQUESTS)
+        for subnet in subnets:
+            subnet.subnet = None
+
+    @staticmethod
+    def _deallocated(subnet_id: str, vpc_id: str, cidr: str):
+        cache.attributes.invalidate(subnet_id)
+        aws.tags.index.remove(subnet_id)
+        VPC.free_subnet_cidr(vpc_id, cidr)
+        logger.info(f"Subnet {subnet_id} deleted.")
+
     @property
     def cidr(self):
         return self.subnet.cidr_block
@@ -81,6 +206,36 @@ class Subnet:
     def subnet_id(self):
         return self.subnet.subnet_id
 
+    @property
+    def region(self) -> str:
+        return self.subnet.meta.client.meta.region_name
+
     @property
     def route_table_id(self):
-        return self.subnet.tags["AssociatedRouteTableID"]
+        for tag in self.subnet.tags:
+            if tag["Key"] == "AssociatedRouteTableID":
+                return tag["Value"]
+        raise ValueError(f"Subnet {self.subnet_id} has no associated route table")
+
+
+def _destroy_subnet(subnet_id: str):
+    try:
+        Subnet.load(subnet_id).deallocate()
+    except ClientError as err:
+        if not err.response["Error"]["Code"].endswith("NotFound"):
+            raise
+
+
+def _destroy_route_table(route_table_id: str):
+    try:
+        route_table = Subnet._client.describe_route_tables(RouteTableIds=[route_table_id])["RouteTables"][0]
+        for association in route_table["Associations"]:
+            Subnet._client.disassociate_route_table(AssociationId=association["RouteTableAssociationId"])
+        Subnet._client.delete_route_table(RouteTableId=route_table_id)
+    except ClientError as err:
+        if not err.response["Error"]["Code"].endswith("NotFound"):
+            raise
+
+
+transactions.journal.register_destroyer("aws", "subnet", _destroy_subnet)
+transactions.journal.register_destroyer("aws", "route_table", _destroy_route_table)
@@ -0,0 +1,235 @@
+import attrs
+import cache
+import clients
+import logging
+import threading
+from typing import Optional
+
+# Limits of a single tagging request
+MAX_EC2_RESOURCES_PER_REQUEST = 1000
+MAX_EC2_FILTER_VALUES = 200
+MAX_ELB_RESOURCES_PER_REQUEST = 20
+# Set on resources waiting in a warm pool, removed when they are handed out
+POOLED_TAG_KEY = "InvisinetPooled"
+# Tags used by Invisinet itself to track resources, never removed when reconciling
+RESERVED_TAG_KEYS = frozenset({"Name", "SubnetID", "DeploymentID", "InvisinetsDeployment",
+                               "AssociatedRouteTableID", "InvisinetSpec", POOLED_TAG_KEY})
+logger = logging.getLogger(__name__)
+__all__ = ["TagIndex", "TagChanges", "RESERVED_TAG_KEYS", "POOLED_TAG_KEY", "index", "plan", "describe",
+           "reconcile", "untag"]
+
+
+class TagIndex:
+    """
+    Local copy of the tags of the resources Invisinet created or described,
+    indexed by tag so that resources can be found by a tag without a
+    describe request. It is kept up to date by every tag change going
+    through this module. Resources are known along with the region they
+    were indexed in, since resources of a deployment share its tags across
+    regions.
+    """
+
+    def __init__(self):
+        self._tags: dict[str, dict[str, str]] = {}
+        self._regions: dict[str, Optional[str]] = {}
+        self._resources: dict[(str, str), set[str]] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, resource_id: str) -> bool:
+        with self._lock:
+            return resource_id in self._tags
+
+    def _unindex(self, resource_id: str):
+        self._regions.pop(resource_id, None)
+        for item in self._tags.pop(resource_id, {}).items():
+            self._resources[item].discard(resource_id)
+            if not self._resources[item]:
+                del self._resources[item]
+
+    def put(self, resource_id: str, tags: dict[str, str]):
+        """Replace the tags known for a resource of the current region."""
+        region = clients.current_region()
+        with self._lock:
+            self._unindex(resource_id)
+            self._tags[resource_id] = dict(tags)
+            self._regions[resource_id] = region
+            for item in tags.items():
+                self._resources.setdefault(item, set()).add(resource_id)
+
+    def update(self, resource_id: str, tags: dict[str, str]):
+        """
+        Merge tags set on a resource into the known ones. Resources missing
+        from the index stay missing, since their other tags are not known.
+        """
+        with self._lock:
+            if resource_id not in self._tags:
+                return
+            merged = {**self._tags[resource_id], **tags}
+            region = self._regions.get(resource_id)
+            self._unindex(resource_id)
+            self._tags[resource_id] = merged
+            self._regions[resource_id] = region
+            for item in merged.items():
+                self._resources.setdefault(item, set()).add(resource_id)
+
+    def get(self, resource_id: str) -> Optional[dict[str, str]]:
+        with self._lock:
+            tags = self._tags.get(resource_id)
+            return dict(tags) if tags is not None else None
+
+    def remove(self, resource_id: str, region: Optional[str] = None):
+        """Forget a resource, only if it was indexed in ``region`` when one is given."""
+        with self._lock:
+            if region is None or self._regions.get(resource_id) == region:
+                self._unindex(resource_id)
+
+    def find(self, key: str, value: str, prefix: str = "", region: Optional[str] = None) -> [str]:
+        """
+        The resources tagged with ``key`` set to ``value`` whose ID starts
+        with ``prefix``, indexed in ``region`` when one is given.
+        """
+        with self._lock:
+            return sorted(resource_id for resource_id in self._resources.get((key, value), ())
+                          if resource_id.startswith(prefix)
+                          and (region is None or self._regions.get(resource_id) == region))
+
+    def clear(self):
+        with self._lock:
+            self._tags.clear()
+            self._regions.clear()
+            self._resources.clear()
+
+
+index = TagIndex()
+
+
+@attrs.define
+class TagChanges:
+    """The tags set on and the tag keys removed from every changed resource."""
+    added: dict[str, dict[str, str]] = attrs.Factory(dict)
+    removed: dict[str, list[str]] = attrs.Factory(dict)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed)
+
+
+def _is_load_balancer(resource_id: str) -> bool:
+    return resource_id.startswith("arn:") and ":elasticloadbalancing:" in resource_id
+
+
+def _chunks(items: list, size: int) -> [list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def plan(current: dict[str, dict[str, str]], desired: dict[str, dict[str, str]],
+         replace: bool = True, keep: frozenset = RESERVED_TAG_KEYS) -> TagChanges:
+    """
+    The tag changes turning the ``current`` tags of every resource into the
+    ``desired`` ones. With ``replace``, tags that are not desired are
+    removed, except the ones in ``keep``.
+    """
+    changes = TagChanges()
+    for resource_id, tags in desired.items():
+        existing = current.get(resource_id, {})
+        added = {key: value for key, value in tags.items() if existing.get(key) != value}
+        removed = [key for key in existing if replace and key not in tags and key not in keep]
+        if added:
+            changes.added[resource_id] = added
+        if removed:
+            changes.removed[resource_id] = removed
+    return changes
+
+
+def describe(resource_ids: [str], refresh: bool = False) -> dict[str, dict[str, str]]:
+    """
+    The tags of several instances, subnets, VPCs or load balancers. Resources
+    missing from the index, or every resource with ``refresh``, are described
+    with as few requests as the APIs allow.
+    """
+    resource_ids = list(dict.fromkeys(resource_ids))
+    missing = [resource_id for resource_id in resource_ids if refresh or resource_id not in index]
+    described = {resource_id: {} for resource_id in missing}
+
+    ec2_ids = [resource_id for resource_id in missing if not _is_load_balancer(resource_id)]
+    if ec2_ids:
+        paginator = clients.registry.client("ec2").get_paginator("describe_tags")
+        for chunk in _chunks(ec2_ids, MAX_EC2_FILTER_VALUES):
+            for page in paginator.paginate(Filters=[{"Name": "resource-id", "Values": chunk}]):
+                for tag in page["Tags"]:
+                    described[tag["ResourceId"]][tag["Key"]] = tag["Value"]
+
+    elb_arns = [resource_id for resource_id in missing if _is_load_balancer(resource_id)]
+    for chunk in _chunks(elb_arns, MAX_ELB_RESOURCES_PER_REQUEST):
+        response = clients.registry.client("elbv2").describe_tags(ResourceArns=chunk)
+        for description in response["TagDescriptions"]:
+            described[description["ResourceArn"]] = {tag["Key"]: tag["Value"] for tag in description["Tags"]}
+
+    for resource_id, tags in described.items():
+        index.put(resource_id, tags)
+    return {resource_id: described[resource_id] if resource_id in described else index.get(resource_id)
+            for resource_id in resource_ids}
+
+
+def _apply(changes: TagChanges):
+    """Apply tag changes, one request per batch of resources getting the same change."""
+    ec2 = clients.registry.client("ec2")
+    elbv2 = clients.registry.client("elbv2")
+
+    additions: dict[frozenset, list[str]] = {}
+    for resource_id, tags in changes.added.items():
+        additions.setdefault(frozenset(tags.items()), []).append(resource_id)
+    for tags, resource_ids in additions.items():
+        tags = [{"Key": key, "Value": value} for key, value in sorted(tags)]
+        elb_arns = [resource_id for resource_id in resource_ids if _is_load_balancer(resource_id)]
+        ec2_ids = [resource_id for resource_id in resource_ids if not _is_load_balancer(resource_id)]
+        for chunk in _chunks(ec2_ids, MAX_EC2_RESOURCES_PER_REQUEST):
+            ec2.create_tags(Resources=chunk, Tags=tags)
+        for chunk in _chunks(elb_arns, MAX_ELB_RESOURCES_PER_REQUEST):
+            elbv2.add_tags(ResourceArns=chunk, Tags=tags)
+
+    removals: dict[tuple, list[str]] = {}
+    for resource_id, keys in changes.removed.items():
+        removals.setdefault(tuple(sorted(keys)), []).append(resource_id)
+    for keys, resource_ids in removals.items():
+        elb_arns = [resource_id for resource_id in resource_ids if _is_load_balancer(resource_id)]
+        ec2_ids = [resource_id for resource_id in resource_ids if not _is_load_balancer(resource_id)]
+        for chunk in _chunks(ec2_ids, MAX_EC2_RESOURCES_PER_REQUEST):
+            ec2.delete_tags(Resources=chunk, Tags=[{"Key": key} for key in keys])
+        for chunk in _chunks(elb_arns, MAX_ELB_RESOURCES_PER_REQUEST):
+            elbv2.remove_tags(ResourceArns=chunk, TagKeys=list(keys))
+
+
+def reconcile(desired: dict[str, dict[str, str]], replace: bool = True,
+              keep: frozenset = RESERVED_TAG_KEYS) -> TagChanges:
+    """
+    Bring the tags of many resources to the desired ones, changing only the
+    tags that differ. Returns the changes that were applied.
+    """
+    current = describe(list(desired))
+    changes = plan(current, desired, replace, keep)
+    _apply(changes)
+
+    for resource_id in changes.added.keys() | changes.removed.keys():
+        tags = {**current[resource_id], **changes.added.get(resource_id, {})}
+        for key in changes.removed.get(resource_id, []):
+            tags.pop(key)
+        index.put(resource_id, tags)
+        if _is_load_balancer(resource_id):
+            cache.attributes.put(resource_id, "tags", tags)
+    logger.info(f"Reconciled tags of {len(desired)} resources, "
+                f"{len(changes.added)} tagged and {len(changes.removed)} untagged")
+    return changes
+
+
+def untag(resource_ids: [str], keys: [str]):
+    """
+    Remove tag keys from several instances, subnets, VPCs or load balancers
+    with as few requests as the APIs allow.
+    """
+    _apply(TagChanges(removed={resource_id: list(keys) for resource_id in resource_ids}))
+    for resource_id in resource_ids:
+        tags = index.get(resource_id)
+        if tags is not None:
+            index.put(resource_id, {key: value for key, value in tags.items() if key not in keys})
+        if _is_load_balancer(resource_id):
+            cache.attributes.invalidate(resource_id, "tags")
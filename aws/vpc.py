@@ -1,6 +1,11 @@
-import boto3
+import clients
 import logging
+import aws.tags
+import aws.inventory
+import threading
+import singleflight
 from utils import *
+from botocore.exceptions import ClientError
 from typing import Optional, TypeVar, Type
 
 DEFAULT_VPC_CIDR_BLOCK = "10.10.0.0/16"
@@ -11,8 +16,10 @@ __all__ = ["VPC"]
 
 class VPC:
 
-    _resource = boto3.resource("ec2")
-    _client = boto3.client("ec2")
+    _resource = clients.AWSResource("ec2")
+    _client = clients.AWSClient("ec2")
+    _allocators: dict[str, CidrAllocator] = {}
+    _allocators_lock = threading.Lock()
     vpc = None
 
     def __init__(self, vpc):
@@ -22,9 +29,36 @@ class VPC:
     @classmethod
     def load(cls: Type[TVPC], deployment_id: str) -> Optional[TVPC]:
         """
-        Load the VPC with the specified deployment id
+        Load the VPC with the specified deployment id. Concurrent loads of
+        the same VPC share their requests.
         """
-        deployment_id = deployment_id.lower()
+        description = cls._describe(deployment_id.lower())
+        if description is None:
+            return None
+        # Built here, since resources are bound to the clients of the thread that creates them
+        vpc = cls._resource.Vpc(description["VpcId"])
+        vpc.meta.data = dict(description)
+        return cls(vpc)
+
+    @classmethod
+    @singleflight.coalesced(lambda cls, deployment_id: (clients.current_region(), deployment_id),
+                            hedge=("aws", "ec2", "DescribeVpcs"))
+    def _describe(cls, deployment_id: str) -> Optional[dict]:
+        """The description of the VPC with the specified deployment id, if any."""
+        region = clients.current_region()
+
+        # The VPCs of the deployment in other regions share its tags
+        for vpc_id in aws.tags.index.find("DeploymentID", deployment_id, prefix="vpc-", region=region):
+            try:
+                vpcs = cls._client.describe_vpcs(VpcIds=[vpc_id])["Vpcs"]
+            except ClientError as err:
+                if not err.response["Error"]["Code"].endswith("NotFound"):
+                    raise
+                vpcs = []
+            if len(vpcs) > 0:
+                return vpcs[0]
+            # Deleted outside of Invisinet
+            aws.tags.index.remove(vpc_id, region)
 
         vpcs = cls._client.describe_vpcs(
             Filters=[
@@ -35,12 +69,18 @@ class VPC:
             ]
         )["Vpcs"]
 
-        if len(vpcs) > 0:
-            vpc = cls._resource.Vpc(vpcs[0]["VpcId"])
-            vpc.load()
-            return cls(vpc)
-        else:
-            return None
+        for vpc in vpcs:
+            aws.tags.index.put(vpc["VpcId"], {tag["Key"]: tag["Value"] for tag in vpc.get("Tags", [])})
+        return vpcs[0] if len(vpcs) > 0 else None
+
+    @classmethod
+    def from_id(cls: Type[TVPC], vpc_id: str) -> TVPC:
+        """
+        Wrap a VPC known to exist without describing it. Its attributes are
+        described on first use, except the deployment ID when its tags are
+        in the tag index.
+        """
+        return cls(cls._resource.Vpc(vpc_id))
 
     @classmethod
     def create(cls: Type[TVPC], deployment_id: Optional[str] = None) -> TVPC:
@@ -60,28 +100,30 @@ class VPC:
 
         name = f"invisinet-vpc-{deployment_id}"
         logger.info(f"Creating a new VPC named {name}...")
+        tags = [
+            {
+                "Key": "Name",
+                "Value": name
+            },
+            {
+                "Key": "DeploymentID",
+                "Value": deployment_id
+            },
+            {
+                "Key": "InvisinetsDeployment",
+                "Value": "true"
+            }
+        ]
         response = cls._client.create_vpc(
             CidrBlock=DEFAULT_VPC_CIDR_BLOCK,
             TagSpecifications=[
                 {
                     "ResourceType": "vpc",
-                    "Tags": [
-                        {
-                            "Key": "Name",
-                            "Value": name
-                        },
-                        {
-                            "Key": "DeploymentID",
-                            "Value": deployment_id
-                        },
-                        {
-                            "Key": "InvisinetsDeployment",
-                            "Value": "true"
-                        }
-                    ]
+                    "Tags": tags
                 },
             ]
         )
+        aws.tags.index.put(response["Vpc"]["VpcId"], {tag["Key"]: tag["Value"] for tag in tags})
         vpc = cls._resource.Vpc(response["Vpc"]["VpcId"])
         vpc.load()
         result = cls(vpc)
@@ -96,15 +138,11 @@ class VPC:
 
     @classmethod
     def list_deployment_ids(cls: Type[TVPC]) -> [str]:
-        vpcs = cls._client.describe_vpcs()["Vpcs"]
-        deployment_ids = []
-        for vpc in vpcs:
-            for tag in vpc["Tags"]:
-                if tag["Key"] == "DeploymentID":
-                    deployment_ids.append(tag["Value"].lower())
-                    break
-
-        return deployment_ids
+        return sorted(
+            deployment_id
+            for deployment_id, deployment in aws.inventory.sweep().items()
+            if deployment_id is not None and deployment.vpc_id is not None
+        )
 
     @property
     def cidr_block(self) -> str:
@@ -116,16 +154,24 @@ class VPC:
         assert self.vpc is not None, "VPC wrapper not initialized"
         return self.vpc.vpc_id
 
+    @property
+    def region(self) -> str:
+        assert self.vpc is not None, "VPC wrapper not initialized"
+        return self.vpc.meta.client.meta.region_name
+
     @property
     def deployment_id(self) -> str:
         assert self.vpc is not None, "VPC wrapper not initialized"
-        for tag in self.vpc.tags:
-            if tag["Key"] == "DeploymentID":
-                return tag["Value"].lower()
+        tags = aws.tags.index.get(self.vpc_id)
+        if tags is None:
+            tags = {tag["Key"]: tag["Value"] for tag in self.vpc.tags}
+        if "DeploymentID" in tags:
+            return tags["DeploymentID"].lower()
         raise ValueError("This VPC was not initialized with a deployment ID")
 
-    def next_available_subnet_cidr(self, size: int = 16) -> Optional[str]:
-        subnets_cidr = [
+    @clients.regional
+    def _subnet_cidrs(self) -> [str]:
+        return [
             subnet["CidrBlock"]
             for subnet in self._client.describe_subnets(
                 Filters=[
@@ -137,4 +183,40 @@ class VPC:
             )["Subnets"]
         ]
 
-        return next_available_cidr([self.cidr_block], subnets_cidr, size)
+    @property
+    def allocator(self) -> CidrAllocator:
+        """
+        The subnet allocator of this VPC, seeded from a single listing of its
+        subnets the first time it is used and shared by every wrapper of the VPC.
+        The listing is made outside of the lock shared by every VPC; when two
+        threads seed the same VPC, the first allocator stored wins.
+        """
+        with self._allocators_lock:
+            allocator = self._allocators.get(self.vpc_id)
+        if allocator is not None:
+            return allocator
+        allocator = CidrAllocator([self.cidr_block], self._subnet_cidrs())
+        with self._allocators_lock:
+            return self._allocators.setdefault(self.vpc_id, allocator)
+
+    @classmethod
+    def free_subnet_cidr(cls, vpc_id: str, cidr: str):
+        """
+        Return the CIDR block of a deleted subnet to the VPC's allocator.
+        """
+        with cls._allocators_lock:
+            allocator = cls._allocators.get(vpc_id)
+        if allocator is not None and cidr in allocator:
+            allocator.free(cidr)
+
+    def next_available_subnet_cidr(self, size: int = 16) -> Optional[str]:
+        return self.allocator.allocate(size)
+
+    def next_available_subnet_cidrs(self, count: int, size: int = 16) -> [str]:
+        """
+        Allocate ``count`` distinct free CIDR blocks for new subnets.
+        """
+        cidrs = self.allocator.allocate_many([size] * count)
+        if cidrs is None:
+            raise ValueError(f"VPC {self.vpc_id} has no room for {count} subnets of size {size}")
+        return cidrs
@@ -0,0 +1,268 @@
+import time
+import attrs
+import clients
+import logging
+import metrics
+import threading
+from botocore.exceptions import ClientError
+from concurrent.futures import Future
+from typing import Callable, Hashable, Optional
+
+DEFAULT_MIN_INTERVAL = 1.0
+DEFAULT_MAX_INTERVAL = 15.0
+DEFAULT_TIMEOUT = 600.0
+# Waits registered within this window are covered by the same first poll
+DEFAULT_BATCH_WINDOW = 0.05
+BACKOFF_FACTOR = 1.5
+THROTTLE_BACKOFF_FACTOR = 2.0
+logger = logging.getLogger(__name__)
+__all__ = ["ResourceKind", "WaiterService", "WaiterError", "service"]
+
+
+class WaiterError(Exception):
+    """A resource entered a state from which it cannot reach the awaited one."""
+
+
+@attrs.define
+class ResourceKind:
+    """
+    How to describe a batch of resources of one type, and how to read the
+    state of a single resource from its description.
+    """
+    # Maps a batch of keys to the descriptions found, missing keys are left out
+    describe: Callable[[list], dict]
+    state: Callable[[dict], str]
+    batch_size: int = 100
+    # States from which a resource can never reach the target state
+    failure_states: dict[str, frozenset] = attrs.Factory(dict)
+    # State reached by resources the describe call no longer returns
+    missing_state: Optional[str] = None
+
+
+@attrs.define(eq=False)
+class _Wait:
+    key: Hashable
+    target: str
+    future: Future
+    deadline: float
+    region: Optional[str] = None
+
+
+class WaiterService:
+    """
+    Shared poller for resources converging to a target state. Pending waits
+    are grouped by resource kind and polled with one batched describe per
+    kind and region, instead of one polling loop per resource. The interval
+    of a kind grows while none of its resources make progress, grows faster
+    when the provider throttles, and is reset whenever a new wait is
+    registered.
+    """
+
+    def __init__(self, min_interval: float = DEFAULT_MIN_INTERVAL,
+                 max_interval: float = DEFAULT_MAX_INTERVAL,
+                 timeout: float = DEFAULT_TIMEOUT,
+                 batch_window: float = DEFAULT_BATCH_WINDOW):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.kinds: dict[str, ResourceKind] = {}
+        self.polls = 0
+        self._pending: dict[str, list[_Wait]] = {}
+        self._intervals: dict[str, float] = {}
+        self._next_poll: dict[str, float] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def register_kind(self, name: str, kind: ResourceKind):
+        with self._condition:
+            self.kinds[name] = kind
+
+    def submit(self, kind: str, key: Hashable, target: str, timeout: Optional[float] = None) -> Future:
+        """Return a future resolved with the resource's description once it reaches ``target``."""
+        if kind not in self.kinds:
+            raise ValueError(f"Unknown resource kind {kind}")
+        future = Future()
+        now = time.monotonic()
+        wait = _Wait(key, target, future, now + (timeout if timeout is not None else self.timeout),
+                     clients.current_region())
+        with self._condition:
+            self._pending.setdefault(kind, []).append(wait)
+            self._intervals[kind] = self.min_interval
+            self._next_poll[kind] = min(self._next_poll.get(kind, float("inf")), now + self.batch_window)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="invisinet-waiter", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def wait(self, kind: str, keys: [Hashable], target: str, timeout: Optional[float] = None) -> [dict]:
+        """Block until every resource reached ``target``, returning their descriptions in order."""
+        futures = [self.submit(kind, key, target, timeout) for key in keys]
+        return [future.result() for future in futures]
+
+    def pending(self) -> dict[str, int]:
+        with self._condition:
+            return {kind: len(waits) for kind, waits in self._pending.items() if waits}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    due = [kind for kind, waits in self._pending.items() if waits]
+                    if not due:
+                        self._condition.wait()
+                        continue
+                    now = time.monotonic()
+                    ready = [kind for kind in due if self._next_poll[kind] <= now]
+                    if ready:
+                        break
+                    self._condition.wait(min(self._next_poll[kind] for kind in due) - now)
+            for kind in ready:
+                try:
+                    self._poll(kind)
+                except Exception as e:
+                    logger.error(f"Polling {kind} resources failed: {e}")
+                    self._fail(kind, e)
+
+    def _fail(self, kind_name: str, error: Exception):
+        with self._condition:
+            waits, self._pending[kind_name] = self._pending[kind_name], []
+            self._next_poll.pop(kind_name, None)
+        for wait in waits:
+            if not wait.future.done():
+                wait.future.set_exception(error)
+
+    def _poll(self, kind_name: str):
+        kind = self.kinds[kind_name]
+        with self._condition:
+            waits = list(self._pending[kind_name])
+        regions: dict[Optional[str], list] = {}
+        for wait in waits:
+            regions.setdefault(wait.region, []).append(wait.key)
+
+        descriptions, throttled, error = {}, False, None
+        with metrics.operation("waiter", "aws"):
+            for region, keys in regions.items():
+                keys = list(dict.fromkeys(keys))
+                with clients.region(region):
+                    for i in range(0, len(keys), kind.batch_size):
+                        try:
+                            descriptions.update(kind.describe(keys[i:i + kind.batch_size]))
+                        except ClientError as err:
+                            if err.response["Error"]["Code"] in metrics.THROTTLE_ERROR_CODES:
+                                throttled = True
+                            else:
+                                error = err
+                            break
+                if throttled or error is not None:
+                    break
+        self.polls += 1
+
+        now, outcomes = time.monotonic(), {}
+        for wait in waits:
+            if throttled:
+                pass
+            elif error is not None:
+                outcomes[id(wait)] = (wait, None, error)
+            else:
+                description = descriptions.get(wait.key)
+                if description is None:
+                    if wait.target == kind.missing_state:
+                        outcomes[id(wait)] = (wait, None, None)
+                else:
+                    state = kind.state(description)
+                    if state == wait.target:
+                        outcomes[id(wait)] = (wait, description, None)
+                    elif state in kind.failure_states.get(wait.target, ()):
+                        outcomes[id(wait)] = (wait, None, WaiterError(
+                            f"{kind_name} {wait.key} entered state {state} while waiting for {wait.target}"))
+            if id(wait) not in outcomes and now >= wait.deadline:
+                outcomes[id(wait)] = (wait, None, TimeoutError(
+                    f"Timed out waiting for {kind_name} {wait.key} to reach {wait.target}"))
+
+        with self._condition:
+            self._pending[kind_name] = [wait for wait in self._pending[kind_name] if id(wait) not in outcomes]
+            interval = self._intervals[kind_name]
+            if throttled:
+                interval = min(self.max_interval, interval * THROTTLE_BACKOFF_FACTOR)
+            elif outcomes:
+                interval = self.min_interval
+            else:
+                interval = min(self.max_interval, interval * BACKOFF_FACTOR)
+            self._intervals[kind_name] = interval
+            if self._pending[kind_name]:
+                self._next_poll[kind_name] = now + interval
+            else:
+                self._next_poll.pop(kind_name, None)
+
+        for wait, result, exception in outcomes.values():
+            if exception is not None:
+                wait.future.set_exception(exception)
+            else:
+                wait.future.set_result(result)
+
+
+def _describe_instances(instance_ids: [str]) -> dict[str, dict]:
+    # Filtering by ID, unlike InstanceIds, tolerates instances that are not visible yet
+    paginator = clients.registry.client("ec2").get_paginator("describe_instances")
+    descriptions = {}
+    for page in paginator.paginate(Filters=[{"Name": "instance-id", "Values": instance_ids}]):
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                descriptions[instance["InstanceId"]] = instance
+    return descriptions
+
+
+def _describe_load_balancers(arns: [str]) -> dict[str, dict]:
+    client = clients.registry.client("elbv2")
+    try:
+        load_balancers = client.describe_load_balancers(LoadBalancerArns=arns)["LoadBalancers"]
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "LoadBalancerNotFound":
+            raise
+        if len(arns) == 1:
+            return {}
+        # One missing load balancer fails the whole batch, describe them one by one
+        descriptions = {}
+        for arn in arns:
+            descriptions.update(_describe_load_balancers([arn]))
+        return descriptions
+    return {load_balancer["LoadBalancerArn"]: load_balancer for load_balancer in load_balancers}
+
+
+def _describe_target_health(keys: [(str, str)]) -> dict[(str, str), dict]:
+    client = clients.registry.client("elbv2")
+    targets = {}
+    for target_group_arn, target_id in keys:
+        targets.setdefault(target_group_arn, []).append({"Id": target_id})
+    descriptions = {}
+    for target_group_arn, group in targets.items():
+        for description in client.describe_target_health(
+                TargetGroupArn=target_group_arn, Targets=group)["TargetHealthDescriptions"]:
+            descriptions[(target_group_arn, description["Target"]["Id"])] = description
+    return descriptions
+
+
+service = WaiterService()
+service.register_kind("instance", ResourceKind(
+    describe=_describe_instances,
+    state=lambda description: description["State"]["Name"],
+    # Filter values are limited to 200 per filter
+    batch_size=200,
+    failure_states={
+        "running": frozenset({"shutting-down", "terminated", "stopping", "stopped"}),
+        "stopped": frozenset({"shutting-down", "terminated"}),
+    },
+    missing_state="terminated",
+))
+service.register_kind("load_balancer", ResourceKind(
+    describe=_describe_load_balancers,
+    state=lambda description: description["State"]["Code"],
+    batch_size=20,
+    failure_states={"active": frozenset({"failed"})},
+))
+service.register_kind("target_health", ResourceKind(
+    describe=_describe_target_health,
+    state=lambda description: description["TargetHealth"]["State"],
+))
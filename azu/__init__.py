@@ -8,3 +8,4 @@ assert "AZURE_SUBSCRIPTION_ID" in os.environ
 logging.basicConfig(level="INFO")
 
 from azu.main import *
+from azu.aio import AsyncInvisinetAzure
@@ -0,0 +1,394 @@
+import clients
+import metrics
+import permits
+import asyncio
+import singleflight
+from _api import *
+from utils import *
+from azu.vnet import *
+from azu.subnet import *
+from azu.service import *
+from azu.endpoint import *
+from azu.resource import *
+import azure.mgmt.network.models
+import azure.core.exceptions
+from azure_utils import get_resource_name_from_id
+from azure.identity.aio import AzureCliCredential as AsyncAzureCliCredential
+from azure.mgmt.compute.aio import ComputeManagementClient as AsyncComputeManagementClient
+from azure.mgmt.network.aio import NetworkManagementClient as AsyncNetworkManagementClient
+from azure.mgmt.resource.resources.models import TagsPatchResource, Tags
+from azure.mgmt.resource.resources.aio import ResourceManagementClient as AsyncResourceManagementClient
+
+logger = logging.getLogger(__name__)
+__all__ = ["AsyncInvisinetAzure"]
+
+
+class AsyncInvisinetAzure(AsyncInvisinet, AzureResourceMixin):
+    """
+    Asyncio flavour of InvisinetAzure built on the asynchronous ARM clients.
+    Long-running operations are awaited on the event loop instead of blocking
+    a thread in ``poller.result()``.
+    """
+
+    _vnet: azure.mgmt.network.models.VirtualNetwork
+
+    def __init__(self, vnet: azure.mgmt.network.models.VirtualNetwork,
+                 credential: AsyncAzureCliCredential,
+                 resource_client: AsyncResourceManagementClient,
+                 compute_client: AsyncComputeManagementClient,
+                 network_client: AsyncNetworkManagementClient):
+        super().__init__()
+        self._vnet = vnet
+        self._credential = credential
+        self._resource = resource_client
+        self._compute = compute_client
+        self._network = network_client
+
+    @classmethod
+    async def create(cls, deployment_id: Optional[str] = None) -> "AsyncInvisinetAzure":
+        """
+        Create a new deployment, or load an existing one if a deployment id is given.
+        """
+        credential = AsyncAzureCliCredential()
+        resource_client = AsyncResourceManagementClient(credential, clients.registry.azure_subscription_id,
+                                                    per_retry_policies=clients.registry.azure_async_policies)
+        compute_client = AsyncComputeManagementClient(credential, clients.registry.azure_subscription_id,
+                                                   per_retry_policies=clients.registry.azure_async_policies)
+        network_client = AsyncNetworkManagementClient(credential, clients.registry.azure_subscription_id,
+                                                   per_retry_policies=clients.registry.azure_async_policies)
+
+        if deployment_id is None:
+            deployment_id = random_hex(5)
+            while await resource_client.resource_groups.check_existence(
+                    cls.resource_group_name_from_deployment_id(deployment_id)):
+                deployment_id = random_hex(5)
+            vnet = await cls._create_vnet(resource_client, network_client, deployment_id)
+        else:
+            deployment_id = deployment_id.lower()
+            vnet = await network_client.virtual_networks.get(
+                resource_group_name=cls.resource_group_name_from_deployment_id(deployment_id),
+                virtual_network_name=cls.vnet_name_from_deployment_id(deployment_id),
+            )
+
+        return cls(vnet, credential, resource_client, compute_client, network_client)
+
+    @classmethod
+    async def _create_vnet(cls, resource_client: AsyncResourceManagementClient,
+                           network_client: AsyncNetworkManagementClient,
+                           deployment_id: str) -> azure.mgmt.network.models.VirtualNetwork:
+        logger.info(f"Creating a new resource group {deployment_id} in {cls.location}")
+        resource_group_name = cls.resource_group_name_from_deployment_id(deployment_id)
+        await resource_client.resource_groups.create_or_update(resource_group_name, {
+            "location": cls.location
+        })
+
+        vnet_cidr = "10.0.0.0/16"
+        logger.info(f"Creating a new VirtualNet CIDR block: {vnet_cidr}...")
+        poller = await network_client.virtual_networks.begin_create_or_update(
+            resource_group_name,
+            cls.vnet_name_from_deployment_id(deployment_id),
+            {
+                "location": cls.location,
+                "address_space": {"address_prefixes": [vnet_cidr]},
+            },
+        )
+        vnet = await poller.result()
+        logger.info(f"Success. vnet_id: {vnet.id}")
+        return vnet
+
+    def __repr__(self):
+        return f"async invisinet azure deployment {self.deployment_id}"
+
+    @property
+    def deployment_id(self) -> str:
+        return self._vnet.name.split("-")[-1]
+
+    @property
+    def _resource_group_name(self) -> str:
+        return self.resource_group_name_from_deployment_id(self.deployment_id)
+
+    async def _allocate_subnet_cidr(self, size: int = 16) -> str:
+        # Shared with the synchronous flavour, seeded on a worker thread the first time
+        loop = asyncio.get_running_loop()
+        allocator = await loop.run_in_executor(clients.registry.executor,
+                                               metrics.propagate(lambda: VirtualNet(self._vnet).allocator))
+        cidr = allocator.allocate(size)
+        if cidr is None:
+            raise ValueError(f"No address space left in {self._vnet.name}")
+        return cidr
+
+    async def _create_subnet(self, name: str) -> Subnet:
+        cidr = await self._allocate_subnet_cidr()
+        route_table = None
+        try:
+            logger.info(f"Creating an empty route table for the subnet...")
+            poller = await self._network.route_tables.begin_create_or_update(
+                self._resource_group_name,
+                f"{name}-route-table",
+                {
+                    "location": self.location,
+                    "routes": []
+                }
+            )
+            route_table = await poller.result()
+
+            logger.info(f"Creating subnet {name} {cidr} for VirtualNet: {self._vnet.id}...")
+            poller = await self._network.subnets.begin_create_or_update(
+                self._resource_group_name,
+                self._vnet.name,
+                name,
+                {
+                    "address_prefix": cidr,
+                    "route_table": {
+                        "id": route_table.id
+                    }
+                }
+            )
+            result = Subnet(await poller.result())
+        except Exception:
+            if route_table is not None:
+                await self._delete_route_table(route_table.name)
+            VirtualNet(self._vnet).allocator.free(cidr)
+            raise
+
+        logger.info(f"Success. subnet_id: {result.subnet_id}")
+        return result
+
+    async def _delete_route_table(self, name: str):
+        try:
+            poller = await self._network.route_tables.begin_delete(self._resource_group_name, name)
+            await poller.result()
+        except azure.core.exceptions.HttpResponseError as e:
+            logger.error(f"Could not delete route table {name}: {e}")
+
+    async def _new_public_ip(self, name: str) -> azure.mgmt.network.models.PublicIPAddress:
+        logger.info(f"Creating a new public ip...")
+        poller = await self._network.public_ip_addresses.begin_create_or_update(
+            resource_group_name=self._resource_group_name,
+            public_ip_address_name=name,
+            parameters=self._public_ip_parameters()
+        )
+        return await poller.result()
+
+    async def _private_ip_from_subnet(self, subnet: azure.mgmt.network.models.Subnet) -> Optional[str]:
+        private_ip = subnet.address_prefix.split("/")[0]
+        options = await self._network.virtual_networks.check_ip_address_availability(
+            self._resource_group_name,
+            self._vnet.name,
+            private_ip
+        )
+        return self._select_private_ip(subnet, private_ip, options)
+
+    @singleflight.coalesced(lambda self, instance: instance.endpoint_id,
+                            hedge=("azure", "Microsoft.Network", "GET networkInterfaces"))
+    async def _primary_nic(self, instance: Instance) -> azure.mgmt.network.models.NetworkInterface:
+        for nic_ref in instance.instance.network_profile.network_interfaces:
+            nic = await self._network.network_interfaces.get(
+                instance.resource_group_name,
+                get_resource_name_from_id(nic_ref.id),
+            )
+            if nic.primary:
+                return nic
+
+        raise ValueError(f"No primary NIC found.")
+
+    @metrics.instrument("azure")
+    async def request_eip(self, name: Optional[str] = None,
+                          use_existing_vm_id: Optional[str] = None) -> EndpointIP:
+        name = name or f"invisinet-eip-{random_hex(5)}"
+        subnet, public_ip = await asyncio.gather(
+            self._create_subnet(f"{name}-subnet"),
+            self._new_public_ip(f"{name}-ip-address"),
+        )
+        private_ip = await self._private_ip_from_subnet(subnet.subnet)
+
+        poller = await self._network.network_interfaces.begin_create_or_update(
+            self._resource_group_name,
+            f"{name}-nic-primary",
+            Instance._network_interface_parameters(name, subnet.subnet, private_ip, public_ip)
+        )
+        network_interface = await poller.result()
+
+        poller = await self._compute.virtual_machines.begin_create_or_update(
+            self._resource_group_name,
+            name,
+            Instance._vm_parameters(name, network_interface.id),
+        )
+        result = await poller.result()
+        logger.info(f"Success. instance_id: {result.id}")
+
+        return Instance(result, self._resource_group_name)
+
+    @metrics.instrument("azure")
+    async def request_sip(self, name: Optional[str] = None) -> ServiceIP:
+        name = name or f"invisinet-sip-{random_hex(5)}"
+        subnet = await self._create_subnet(f"{name}-subnet")
+
+        logger.info(f"Creating a new load balancer {name}...")
+        private_ip = await self._private_ip_from_subnet(subnet.subnet)
+        parameters, backend_pool = LoadBalancer._load_balancer_parameters(name, subnet.subnet, private_ip)
+        poller = await self._network.load_balancers.begin_create_or_update(
+            resource_group_name=self._resource_group_name,
+            load_balancer_name=name,
+            parameters=parameters
+        )
+        result = await poller.result()
+
+        poller = await self._network.load_balancer_backend_address_pools.begin_create_or_update(
+            resource_group_name=self._resource_group_name,
+            load_balancer_name=name,
+            backend_address_pool_name=backend_pool.name,
+            parameters=backend_pool
+        )
+        await poller.result()
+        logger.info(f"Success. instance_id: {result.id}")
+
+        return LoadBalancer(result)
+
+    @metrics.instrument("azure")
+    async def bind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        return await self._update_backend_pool(sip, eips, bind=True)
+
+    @metrics.instrument("azure")
+    async def unbind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        return await self._update_backend_pool(sip, eips, bind=False)
+
+    async def _update_backend_pool(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]],
+                                   bind: bool) -> BindResult:
+        """
+        Add or remove the backend addresses of every endpoint with a single
+        update of the backend pool.
+        """
+        eips = [eips] if isinstance(eips, EndpointIP) else list(eips)
+        result = BindResult(sip)
+        if len(eips) == 0:
+            return result
+
+        logger.info(f"Retrieving backend pool for sip {sip.name}...")
+        backend_pool, *nics = await asyncio.gather(
+            self._network.load_balancer_backend_address_pools.get(
+                resource_group_name=self._resource_group_name,
+                load_balancer_name=sip.name,
+                backend_address_pool_name=f"{sip.name}-backend-pool"
+            ),
+            *[self._primary_nic(eip) for eip in eips] if bind else [],
+        )
+        names = [f"{sip.name}-{eip.name}-backend-address" for eip in eips]
+        addresses = [address for address in backend_pool.load_balancer_backend_addresses or []
+                     if address.name not in names]
+        if bind:
+            addresses += [
+                azure.mgmt.network.models.LoadBalancerBackendAddress(
+                    name=name,
+                    virtual_network=self._vnet,
+                    ip_address=nic.ip_configurations[0].private_ip_address,
+                )
+                for name, nic in zip(names, nics)
+            ]
+        backend_pool.load_balancer_backend_addresses = addresses
+
+        logger.info(f"Updating {len(eips)} backend addresses...")
+        try:
+            poller = await self._network.load_balancer_backend_address_pools.begin_create_or_update(
+                resource_group_name=self._resource_group_name,
+                load_balancer_name=sip.name,
+                backend_address_pool_name=backend_pool.name,
+                parameters=backend_pool
+            )
+            await poller.result()
+        except azure.core.exceptions.HttpResponseError as err:
+            result.failed = [(eip, err.message) for eip in eips]
+        else:
+            result.succeeded = eips
+        logger.info(f"Process finished. {len(result.succeeded)} backend addresses updated.")
+        return result
+
+    @metrics.instrument("azure")
+    async def annotate(self,
+                       endpoints: (EndpointIP, EndpointIP),
+                       middlebox: EndpointIP):
+        nics = await asyncio.gather(*[self._primary_nic(endpoint)
+                                      for endpoint in (*endpoints, middlebox)])
+        subnets = await asyncio.gather(*[
+            self._network.subnets.get(
+                self._resource_group_name,
+                self._vnet.name,
+                get_resource_name_from_id(nic.ip_configurations[0].subnet.id)
+            )
+            for nic in nics[:2]
+        ])
+        middlebox_ip = nics[2].ip_configurations[0].private_ip_address
+
+        async def create_route(subnet, destination):
+            poller = await self._network.routes.begin_create_or_update(
+                self._resource_group_name,
+                get_resource_name_from_id(subnet.route_table.id),
+                f"{subnet.name}-{middlebox.name}-middlebox-route",
+                {
+                    "address_prefix": destination.address_prefix,
+                    "next_hop_type": "VirtualAppliance",
+                    "next_hop_ip_address": middlebox_ip
+                }
+            )
+            return await poller.result()
+
+        logger.info(f"Creating routes for the middleware...")
+        await asyncio.gather(
+            create_route(subnets[0], subnets[1]),
+            create_route(subnets[1], subnets[0]),
+        )
+        logger.info("Process finished.")
+
+    @metrics.instrument("azure")
+    async def set_permit_list(self, eip: EndpointIP, permit_list: [permits.Permit],
+                              directions: Optional[set[str]] = None):
+        """
+        Make the network security group of the endpoint's primary NIC allow
+        exactly the compiled permit list, creating the group if the NIC has none.
+        """
+        nic = await self._primary_nic(eip)
+        if nic.network_security_group is None:
+            nsg = azure.mgmt.network.models.NetworkSecurityGroup(
+                location=self.location, security_rules=[]
+            )
+            nsg_name = f"{eip.name}-nsg"
+        else:
+            nsg_name = get_resource_name_from_id(nic.network_security_group.id)
+            nsg = await self._network.network_security_groups.get(self._resource_group_name, nsg_name)
+
+        rules = self.permit_security_rules(nsg.security_rules or [], permit_list, directions)
+        if rules is None:
+            logger.info(f"Rules on NSG {nsg_name} are up to date")
+            return
+        nsg.security_rules = rules
+
+        poller = await self._network.network_security_groups.begin_create_or_update(
+            resource_group_name=self._resource_group_name,
+            network_security_group_name=nsg_name,
+            parameters=nsg,
+        )
+        nsg = await poller.result()
+
+        if nic.network_security_group is None:
+            nic.network_security_group = azure.mgmt.network.models.NetworkSecurityGroup(id=nsg.id)
+            poller = await self._network.network_interfaces.begin_create_or_update(
+                self._resource_group_name, nic.name, nic
+            )
+            await poller.result()
+        logger.info(f"Updated rules on NSG {nsg_name}")
+
+    @metrics.instrument("azure")
+    async def set_tag(self, resource: Resource, tags: dict[str, str]):
+        await self._resource.tags.update_at_scope(
+            resource.endpoint_id,
+            TagsPatchResource(operation="Replace", properties=Tags(tags=tags)),
+        )
+        logger.info(f"Successfully updated tags for {resource.endpoint_id} with tags: {tags}")
+
+    async def close(self):
+        await asyncio.gather(
+            self._network.close(),
+            self._compute.close(),
+            self._resource.close(),
+        )
+        await self._credential.close()
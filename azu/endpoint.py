@@ -1,9 +1,11 @@
+import cache
 import string
 import secrets
 from _api import *
 from azu.vnet import *
 from azu.subnet import *
 from azu.resource import *
+from azu.lro import LROGroup
 from azure.mgmt.network.models import PublicIPAddress, NetworkInterface, NetworkInterfaceIPConfiguration
 from azure.mgmt.compute.models import VirtualMachine, VirtualMachineSizeTypes
 
@@ -23,30 +25,62 @@ class Instance(EndpointIP, AzureResourceMixin):
         self.resource_group_name = resource_group_name
 
     @classmethod
-    def create(cls: Type[TInstance], name: str, vnet: VirtualNet,
-               subnet_name: str) -> TInstance:
-        public_ip = cls.new_public_ip(f"{name}-ip-address", vnet.resource_group_name)
-        subnet = Subnet.load(subnet_name, vnet)
-        private_ip = cls.private_ip_from_subnet(vnet.resource_group_name, vnet.name, subnet.subnet)
+    def create(cls: Type[TInstance], name: str, vnet: VirtualNet, subnet_name: str,
+               public_ip: Optional[PublicIPAddress] = None,
+               subnet: Optional[Subnet] = None) -> TInstance:
+        """
+        Create a VM in an existing subnet. The public IP is created while the
+        subnet is looked up, unless an existing one is given. The lookup is
+        skipped when the subnet itself is given.
+        """
+        def private_ip_in_subnet() -> (Subnet, str):
+            found = subnet or Subnet.load(subnet_name, vnet)
+            return found, cls.private_ip_from_subnet(vnet.resource_group_name, vnet.name, found.subnet)
+
+        with LROGroup() as group:
+            if public_ip is None:
+                new_public_ip = group.submit(cls.new_public_ip, f"{name}-ip-address", vnet.resource_group_name)
+            subnet_and_private_ip = group.submit(private_ip_in_subnet)
+        if public_ip is None:
+            public_ip = new_public_ip.result()
+        subnet, private_ip = subnet_and_private_ip.result()
 
+        network_interface = cls.network_client.network_interfaces.begin_create_or_update(
+            vnet.resource_group_name,
+            f"{name}-nic-primary",
+            cls._network_interface_parameters(name, subnet.subnet, private_ip, public_ip)
+        ).result()
+
+        poller = cls.compute_client.virtual_machines.begin_create_or_update(
+            vnet.resource_group_name,
+            name,
+            cls._vm_parameters(name, network_interface.id),
+        )
+
+        result = poller.result()
+        logger.info(f"Success. instance_id: {result.id}")
+
+        return cls(result, vnet.resource_group_name)
+
+    @classmethod
+    def _network_interface_parameters(cls, name: str, subnet: azure.mgmt.network.models.Subnet,
+                                      private_ip: str, public_ip: PublicIPAddress) -> NetworkInterface:
         ip_configuration = NetworkInterfaceIPConfiguration(
             name=f"{name}-ip-config",
             private_ip_allocation_method="Static",
             private_ip_address_version="IPv4",
             private_ip_address=private_ip,
             public_ip_address=public_ip,
-            subnet=subnet.subnet,
+            subnet=subnet,
             primary=True
         )
-        network_interface = cls.network_client.network_interfaces.begin_create_or_update(
-            vnet.resource_group_name,
-            f"{name}-nic-primary",
-            NetworkInterface(
-                location=cls.location,
-                ip_configurations=[ip_configuration],
-            )
-        ).result()
+        return NetworkInterface(
+            location=cls.location,
+            ip_configurations=[ip_configuration],
+        )
 
+    @classmethod
+    def _vm_parameters(cls, name: str, network_interface_id: str) -> dict:
         alphabet = string.ascii_letters + string.digits
         username = "invisinet"
         password = ''.join(secrets.choice(alphabet) for i in range(16))
@@ -57,41 +91,33 @@ class Instance(EndpointIP, AzureResourceMixin):
         logger.info(f"\t*username: {username}")
         logger.info(f"\t*password: {password}")
 
-        poller = cls.compute_client.virtual_machines.begin_create_or_update(
-            vnet.resource_group_name,
-            name,
-            {
-                "location": cls.location,
-                "storage_profile": {
-                    "image_reference": {
-                        "publisher": "Canonical",
-                        "offer": "UbuntuServer",
-                        "sku": "16.04.0-LTS",
-                        "version": "latest",
+        return {
+            "location": cls.location,
+            "storage_profile": {
+                "image_reference": {
+                    "publisher": "Canonical",
+                    "offer": "UbuntuServer",
+                    "sku": "16.04.0-LTS",
+                    "version": "latest",
+                }
+            },
+            "hardware_profile": {"vm_size": VirtualMachineSizeTypes.Standard_DS1_V2},
+            "os_profile": {
+                "computer_name": name,
+                "admin_username": username,
+                "admin_password": password,
+            },
+            "network_profile": {
+                "network_interfaces": [
+                    {
+                        "id": network_interface_id,
                     }
-                },
-                "hardware_profile": {"vm_size": VirtualMachineSizeTypes.Standard_DS1_V2},
-                "os_profile": {
-                    "computer_name": name,
-                    "admin_username": username,
-                    "admin_password": password,
-                },
-                "network_profile": {
-                    "network_interfaces": [
-                        {
-                            "id": network_interface.id,
-                        }
-                    ]
-                },
+                ]
             },
-        )
-
-        result = poller.result()
-        logger.info(f"Success. instance_id: {result.id}")
-
-        return cls(result, vnet.resource_group_name)
+        }
 
     @property
+    @cache.cached(lambda self: self.endpoint_id)
     def _primary_nic(self) -> NetworkInterface:
         nic_ids = [nic_ref.id for nic_ref in self.instance.network_profile.network_interfaces]
         for nic_id in nic_ids:
@@ -140,4 +166,5 @@ class Instance(EndpointIP, AzureResourceMixin):
             self.name
         )
         poller.result()
+        cache.attributes.invalidate(self.endpoint_id)
         logger.info(f"Success.")
@@ -0,0 +1,148 @@
+import clients
+import logging
+import metrics
+import threading
+from typing import Any, Callable, Optional
+from azure.core.polling import LROPoller
+from concurrent.futures import Future, wait, FIRST_EXCEPTION
+
+DEFAULT_MAX_WORKERS = 16
+logger = logging.getLogger(__name__)
+__all__ = ["LROGroup", "LROGroupError"]
+
+
+class LROGroupError(Exception):
+    """One or more operations of an LROGroup failed."""
+
+    def __init__(self, errors: [(str, BaseException)], cancelled: [str] = ()):
+        self.errors = list(errors)
+        self.cancelled = list(cancelled)
+        message = "; ".join(f"{name}: {error}" for name, error in self.errors)
+        if self.cancelled:
+            message += f" (cancelled: {', '.join(self.cancelled)})"
+        super().__init__(message)
+
+
+class LROGroup:
+    """
+    Issues independent Azure operations together and waits for them as a
+    group. ``begin_*`` calls are started concurrently on the registry's
+    executor, at most ``max_workers`` at once, and their pollers are
+    resolved in the worker threads, so the group takes as long as its
+    slowest operation rather than the sum of all of them. The thread
+    waiting for the group runs the operations no worker started yet, so
+    that groups nested in the operations of another group make progress
+    even when every thread of the executor is busy.
+
+    When an operation fails, operations that have not started yet are
+    cancelled, the ones in flight are awaited, and every failure is raised
+    together in an LROGroupError. Used as a context manager, the group is
+    awaited when the block exits.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._futures: [(str, Future)] = []
+        # Operations no thread started yet, and the workers taking them
+        self._pending: [(Future, Callable)] = []
+        self._workers = 0
+        self._lock = threading.Lock()
+
+    def submit(self, f: Callable, *args, **kwargs) -> Future:
+        """
+        Run ``f`` in the group. If it returns an LROPoller, the future resolves
+        to the poller's result.
+        """
+        name = getattr(f, "__qualname__", repr(f))
+
+        def run():
+            result = f(*args, **kwargs)
+            if isinstance(result, LROPoller):
+                logger.debug(f"Waiting for {name}...")
+                result = result.result()
+            return result
+
+        future = Future()
+        self._futures.append((name, future))
+        with self._lock:
+            self._pending.append((future, metrics.propagate(run)))
+            start = self._workers < self.max_workers
+            if start:
+                self._workers += 1
+        if start:
+            clients.registry.executor.submit(self._work)
+        return future
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._workers -= 1
+                    return
+                future, run = self._pending.pop(0)
+            self._run(future, run)
+
+    def _help(self):
+        """Run the operations not started yet on the calling thread, until one of them fails."""
+        while True:
+            with self._lock:
+                if not self._pending or any(future.done() and not future.cancelled()
+                                            and future.exception() is not None for _, future in self._futures):
+                    return
+                future, run = self._pending.pop(0)
+            self._run(future, run)
+
+    @staticmethod
+    def _run(future: Future, run: Callable):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(run())
+        except BaseException as e:
+            future.set_exception(e)
+
+    def wait(self, timeout: Optional[float] = None) -> [Any]:
+        """
+        Wait for every operation, returning their results in submission order.
+        With a timeout, the calling thread only waits, leaving every
+        operation to the executor.
+        """
+        if timeout is None:
+            self._help()
+        futures = [future for _, future in self._futures]
+        _, not_done = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+        if not_done and any(not future.cancelled() and future.exception(0) is not None
+                            for future in futures if future.done()):
+            for future in not_done:
+                future.cancel()
+            # Operations already in flight cannot be cancelled on the Azure side
+            wait([future for future in not_done if not future.cancelled()], timeout=timeout)
+
+        errors, cancelled = [], []
+        for name, future in self._futures:
+            if future.cancelled():
+                cancelled.append(name)
+            elif not future.done():
+                errors.append((name, TimeoutError(f"{name} did not complete in {timeout} seconds")))
+            elif future.exception() is not None:
+                errors.append((name, future.exception()))
+        if errors:
+            raise LROGroupError(errors, cancelled)
+        return [future.result() for _, future in self._futures]
+
+    def close(self):
+        """Cancel the operations not started yet, leaving the ones in flight to finish."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for future, _ in pending:
+            future.cancel()
+
+    def __enter__(self) -> "LROGroup":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.close()
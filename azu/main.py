@@ -1,6 +1,10 @@
 import os
 
 import _api
+import routes
+import permits
+import metrics
+import ratelimit
 from _api import *
 from utils import *
 from azu.vnet import *
@@ -8,7 +12,10 @@ from azu.subnet import *
 from azu.service import *
 from azu.endpoint import *
 from azu.resource import *
+from azu.lro import LROGroup
+from azure_utils import get_resource_name_from_id
 import azure.mgmt.network.models
+import azure.core.exceptions
 from typing import Optional, Union
 
 logger = logging.getLogger(__name__)
@@ -20,6 +27,7 @@ class InvisinetAzure(_api.Invisinet, AzureResourceMixin):
 
     _vnet: VirtualNet
 
+    @metrics.instrument("azure", "create_deployment")
     def __init__(self, deployment_id: str = None):
         super().__init__()
         if deployment_id is None:
@@ -34,23 +42,50 @@ class InvisinetAzure(_api.Invisinet, AzureResourceMixin):
     def deployment_id(self) -> str:
         return self._vnet.deployment_id
 
+    @metrics.instrument("azure")
     def list_deployments(self) -> [TInvisinet]:
         return []
 
+    @metrics.instrument("azure")
     def request_eip(self, name: Optional[str] = None,
-                    use_existing_vm_id: Optional[str] = None) -> EndpointIP:
-        name = name or f"invisinet-eip-{random_hex(5)}"
-        subnet = Subnet.create(f"{name}-subnet", self._vnet)
-        instance = Instance.create(
-            name,
-            self._vnet,
-            subnet.name
-        )
-        return instance
+                    use_existing_vm_id: Optional[str] = None,
+                    count: Optional[int] = None) -> Union[EndpointIP, list[EndpointIP]]:
+        """
+        Provision a VM in a new subnet. When count is given, provision that
+        many VMs in one pass and return them as a list; name is then used as a
+        prefix for the VM names.
+        """
+        if count is None:
+            names = [name or f"invisinet-eip-{random_hex(5)}"]
+        else:
+            names = [f"{name or 'invisinet-eip'}-{random_hex(5)}" for _ in range(count)]
+
+        with LROGroup() as group:
+            subnets = group.submit(Subnet.create_many, [f"{name}-subnet" for name in names], self._vnet)
+            public_ips = [
+                group.submit(self.new_public_ip, f"{name}-ip-address", self._vnet.resource_group_name)
+                for name in names
+            ]
+        with LROGroup() as group:
+            instances = [
+                group.submit(
+                    Instance.create,
+                    name,
+                    self._vnet,
+                    subnet.name,
+                    public_ip=public_ip.result(),
+                    subnet=subnet,
+                )
+                for name, subnet, public_ip in zip(names, subnets.result(), public_ips)
+            ]
+        instances = [instance.result() for instance in instances]
+        return instances if count is not None else instances[0]
 
+    @metrics.instrument("azure")
     def active_eip(self) -> [EndpointIP]:
         return []
 
+    @metrics.instrument("azure")
     def request_sip(self, name: Optional[str] = None) -> ServiceIP:
         name = name or f"invisinet-sip-{random_hex(5)}"
         subnet = Subnet.create(f"{name}-subnet", self._vnet)
@@ -62,94 +97,183 @@ class InvisinetAzure(_api.Invisinet, AzureResourceMixin):
 
         return instance
 
+    @metrics.instrument("azure")
     def active_sip(self) -> [Instance]:
         return []
 
-    def bind(self, sip: ServiceIP, eip: EndpointIP):
+    @metrics.instrument("azure")
+    def bind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        return self._update_backend_pool(sip, eips, bind=True)
+
+    @metrics.instrument("azure")
+    def unbind(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]]) -> BindResult:
+        return self._update_backend_pool(sip, eips, bind=False)
+
+    def _update_backend_pool(self, sip: ServiceIP, eips: Union[EndpointIP, list[EndpointIP]],
+                             bind: bool) -> BindResult:
+        """
+        Add or remove the backend addresses of every endpoint with a single
+        update of the backend pool.
+        """
+        eips = [eips] if isinstance(eips, EndpointIP) else list(eips)
+        result = BindResult(sip)
+        if len(eips) == 0:
+            return result
+
         logger.info(f"Retrieving backend pool for sip {sip.name}...")
         backend_pool = self.network_client.load_balancer_backend_address_pools.get(
             resource_group_name=self._vnet.resource_group_name,
             load_balancer_name=sip.name,
             backend_address_pool_name=f"{sip.name}-backend-pool"
         )
+        names = [f"{sip.name}-{eip.name}-backend-address" for eip in eips]
+        addresses = [address for address in backend_pool.load_balancer_backend_addresses or []
+                     if address.name not in names]
+        if bind:
+            addresses += [
+                azure.mgmt.network.models.LoadBalancerBackendAddress(
+                    name=name,
+                    virtual_network=self._vnet.vnet,
+                    ip_address=eip.private_ip,
+                )
+                for name, eip in zip(names, eips)
+            ]
+        backend_pool.load_balancer_backend_addresses = addresses
 
-        logger.info(f"Updating backend address...")
-        backend_pool.load_balancer_backend_addresses.append(
-            azure.mgmt.network.models.LoadBalancerBackendAddress(
-                name=f"{sip.name}-{eip.name}-backend-address",
-                virtual_network=self._vnet.vnet,
-                ip_address=eip.private_ip,
-            )
-        )
-
-        self.network_client.load_balancer_backend_address_pools.begin_create_or_update(
-            resource_group_name=self._vnet.resource_group_name,
-            load_balancer_name=sip.name,
-            backend_address_pool_name=backend_pool.name,
-            parameters=backend_pool
-        )
-        logger.info(f"Process finished. IP {eip.private_ip} added to the backend.")
+        logger.info(f"Updating {len(eips)} backend addresses...")
+        try:
+            self.network_client.load_balancer_backend_address_pools.begin_create_or_update(
+                resource_group_name=self._vnet.resource_group_name,
+                load_balancer_name=sip.name,
+                backend_address_pool_name=backend_pool.name,
+                parameters=backend_pool
+            ).result()
+        except azure.core.exceptions.HttpResponseError as err:
+            result.failed = [(eip, err.message) for eip in eips]
+        else:
+            result.succeeded = eips
+        logger.info(f"Process finished. {len(result.succeeded)} backend addresses updated.")
+        return result
 
+    @metrics.instrument("azure")
     def annotate(self,
                  endpoints: (EndpointIP, EndpointIP),
-                 middlebox: EndpointIP):
-        subnets = (
-            Subnet.load(endpoints[0].subnet_name, self._vnet),
-            Subnet.load(endpoints[1].subnet_name, self._vnet)
-        )
-        route_tables = [
-            azure.mgmt.network.models.RouteTable(id=subnets[0].route_table_id),
-            azure.mgmt.network.models.RouteTable(id=subnets[1].route_table_id)
-        ]
-
-        route1_params = {
-            "address_prefix": subnets[1].cidr,
-            "next_hop_type": "VirtualAppliance",
-            "next_hop_ip_address": middlebox.private_ip
-        }
-        route2_params = {
-            "address_prefix": subnets[0].cidr,
-            "next_hop_type": "VirtualAppliance",
-            "next_hop_ip_address": middlebox.private_ip
+                 middlebox: EndpointIP) -> [routes.RouteOp]:
+        return self._annotate([endpoints], middlebox)
+
+    @metrics.instrument("azure")
+    def annotate_many(self, pairs: [(EndpointIP, EndpointIP)], middlebox: EndpointIP,
+                      prune: bool = False) -> [routes.RouteOp]:
+        """
+        Route the traffic between every pair of endpoints through the
+        middlebox. With prune, routes through the middlebox that are not
+        wanted anymore are deleted from the affected route tables.
+        """
+        return self._annotate(pairs, middlebox, prune)
+
+    def _annotate(self, pairs: [(EndpointIP, EndpointIP)], middlebox: EndpointIP,
+                  prune: bool = False) -> [routes.RouteOp]:
+        """
+        Read the subnets once and every affected route table once, and only
+        change the routes that differ from the wanted ones. Return the
+        changes made.
+        """
+        resource_group_name = self._vnet.resource_group_name
+        subnets = {
+            subnet.name: subnet
+            for subnet in self.network_client.subnets.list(resource_group_name, self._vnet.name)
         }
 
-        logger.info(f"Creating routes for the middleware...")
+        def table_and_cidr(endpoint: EndpointIP) -> (str, str):
+            subnet = subnets[get_resource_name_from_id(endpoint.subnet_id)]
+            return get_resource_name_from_id(subnet.route_table.id), subnet.address_prefix
 
-        self.network_client.routes.begin_create_or_update(
-            self._vnet.resource_group_name,
-            route_tables[0].name,
-            f"{subnets[0].name}-{middlebox.name}-middlebox-route",
-            route1_params
-        ).result()
+        middlebox_ip = middlebox.private_ip
+        desired = routes.middlebox_routes(
+            [(*table_and_cidr(first), *table_and_cidr(second)) for first, second in pairs],
+            middlebox_ip
+        )
+        with LROGroup() as group:
+            route_tables = {
+                name: group.submit(self.network_client.route_tables.get, resource_group_name, name)
+                for name in desired
+            }
 
-        self.network_client.routes.begin_create_or_update(
-            self._vnet.resource_group_name,
-            route_tables[1].name,
-            f"{subnets[1].name}-{middlebox.name}-middlebox-route",
-            route2_params
-        ).result()
+        route_names, ops = {}, []
+        for name, table_routes in desired.items():
+            current = {}
+            for route in route_tables[name].result().routes or []:
+                route_names[(name, route.address_prefix)] = route.name
+                current[route.address_prefix] = (
+                    route.next_hop_ip_address if route.next_hop_type == "VirtualAppliance" else route.next_hop_type
+                )
+            ops += routes.diff(name, current, table_routes,
+                               owned=lambda target: prune and target == middlebox_ip)
+
+        def apply(table_ops: [routes.RouteOp]):
+            for op in table_ops:
+                route_name = route_names.get(
+                    (op.table, op.destination),
+                    f"{middlebox.name}-{op.destination.replace('.', '-').replace('/', '-')}-route"
+                )
+                if op.action == routes.DELETE:
+                    self.network_client.routes.begin_delete(resource_group_name, op.table, route_name).result()
+                else:
+                    self.network_client.routes.begin_create_or_update(
+                        resource_group_name,
+                        op.table,
+                        route_name,
+                        {
+                            "address_prefix": op.destination,
+                            "next_hop_type": "VirtualAppliance",
+                            "next_hop_ip_address": op.target
+                        }
+                    ).result()
+
+        logger.info(f"Applying {len(ops)} route changes...")
+        tables = {}
+        for op in ops:
+            tables.setdefault(op.table, []).append(op)
+        with LROGroup() as group:
+            for table_ops in tables.values():
+                group.submit(apply, table_ops)
 
         logger.info("Process finished.")
-    
-    # def set_permit_list(self, eip_name: str, permit_list: any):
-    #     credential = AzureCliCredential()
-    #     subscription_id = os.environ["AZURE_SUBSCRIPTION_ID"]
-    #     resource_client = ResourceManagementClient(credential, subscription_id)
-    #     network_client = NetworkManagementClient(credential, subscription_id)
-    #
-    #     eip = network_client.public_ip_addresses.get(RESOURCE_GROUP, eip_name)
-    #     nic_name = get_nic_name_from_ipconf_id(eip.ip_configuration.id)
-    #     nic = network_client.network_interfaces.get(RESOURCE_GROUP, nic_name)
-    #
-    #     nsg = network_client.network_security_groups.get(RESOURCE_GROUP, get_resource_name_from_id(nic.network_security_group.id))
-    #
-    #     poller = client.network_security_groups.begin_create_or_update(
-    #         resource_group_name=RESOURCE_GROUP_NAME,
-    #         network_security_group_name=nsg,
-    #         parameters=permit_list,
-    #     )
-    #     print("Updated rules on NSG {}".format(nsg.name))
+        return ops
+
+    @metrics.instrument("azure")
+    def set_permit_list(self, eip: EndpointIP, permit_list: [permits.Permit],
+                        directions: Optional[set[str]] = None):
+        """
+        Make the network security group of the endpoint's primary NIC allow
+        exactly the compiled permit list, with a single update of the group.
+        The group is created if the NIC has none.
+        """
+        nic = eip._primary_nic
+        if nic.network_security_group is None:
+            nsg = azure.mgmt.network.models.NetworkSecurityGroup(location=self.location, security_rules=[])
+            nsg_name = f"{eip.name}-nsg"
+        else:
+            nsg_name = get_resource_name_from_id(nic.network_security_group.id)
+            nsg = self.network_client.network_security_groups.get(self._vnet.resource_group_name, nsg_name)
+
+        rules = self.permit_security_rules(nsg.security_rules or [], permit_list, directions)
+        if rules is None:
+            logger.info(f"Rules on NSG {nsg_name} are up to date")
+            return
+        nsg.security_rules = rules
+        nsg = self.network_client.network_security_groups.begin_create_or_update(
+            resource_group_name=self._vnet.resource_group_name,
+            network_security_group_name=nsg_name,
+            parameters=nsg,
+        ).result()
 
+        if nic.network_security_group is None:
+            nic.network_security_group = azure.mgmt.network.models.NetworkSecurityGroup(id=nsg.id)
+            self.network_client.network_interfaces.begin_create_or_update(
+                self._vnet.resource_group_name, nic.name, nic
+            ).result()
+        logger.info(f"Updated rules on NSG {nsg_name}")
 
 if __name__ == '__main__':
     deployment = InvisinetAzure()
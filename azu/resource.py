@@ -1,23 +1,31 @@
+import clients
 import logging
 import netaddr
+import itertools
+import permits
 from definitions import *
 import azure.mgmt.network.models
+from azure_utils import create_security_rule, get_highest_rule_priority
 from typing import ClassVar, Optional
-from azure.identity import AzureCliCredential
 from azure.mgmt.compute import ComputeManagementClient
 from azure.mgmt.network import NetworkManagementClient
 from azure.mgmt.resource import ResourceManagementClient
 
+# Security rules created from permit lists are named with this prefix
+PERMIT_RULE_PREFIX = "invisinet-permit"
+AZURE_PROTOCOLS = {permits.ALL_PROTOCOLS: "*", "tcp": "Tcp", "udp": "Udp", "icmp": "Icmp"}
+AZURE_DIRECTIONS = {permits.INBOUND: "Inbound", permits.OUTBOUND: "Outbound"}
+# Priorities security rules can be given
+MIN_RULE_PRIORITY = 100
+MAX_RULE_PRIORITY = 4096
 logger = logging.getLogger(__name__)
-credential = AzureCliCredential()
-subscription_id = os.environ["AZURE_SUBSCRIPTION_ID"]
 
 
 class AzureResourceMixin:
 
-    resource_client = ResourceManagementClient(credential, subscription_id)
-    compute_client = ComputeManagementClient(credential, subscription_id)
-    network_client = NetworkManagementClient(credential, subscription_id)
+    resource_client = clients.AzureClient(ResourceManagementClient)
+    compute_client = clients.AzureClient(ComputeManagementClient)
+    network_client = clients.AzureClient(NetworkManagementClient)
     location: ClassVar[str] = "westus3"
 
     @staticmethod
@@ -35,15 +43,19 @@ class AzureResourceMixin:
         public_ip = cls.network_client.public_ip_addresses.begin_create_or_update(
             resource_group_name=resource_group_name,
             public_ip_address_name=name,
-            parameters={
-                "location": cls.location,
-                "sku": {"name": "Basic"},
-                "public_ip_allocation_method": "Dynamic",
-                "public_ip_address_version": "IPv4",
-            }
+            parameters=cls._public_ip_parameters()
         ).result()
         return public_ip
 
+    @classmethod
+    def _public_ip_parameters(cls) -> dict:
+        return {
+            "location": cls.location,
+            "sku": {"name": "Basic"},
+            "public_ip_allocation_method": "Dynamic",
+            "public_ip_address_version": "IPv4",
+        }
+
     @classmethod
     def private_ip_from_subnet(cls, resource_group_name: str, vnet_name: str,
                                subnet: azure.mgmt.network.models.Subnet) -> Optional[str]:
@@ -53,6 +65,11 @@ class AzureResourceMixin:
             vnet_name,
             private_ip
         )
+        return cls._select_private_ip(subnet, private_ip, options)
+
+    @staticmethod
+    def _select_private_ip(subnet: azure.mgmt.network.models.Subnet, private_ip: str,
+                           options: azure.mgmt.network.models.IPAddressAvailabilityResult) -> Optional[str]:
         if not options.available:
             private_ip = options.available_ip_addresses[0]
 
@@ -60,3 +77,72 @@ class AzureResourceMixin:
             return private_ip
         else:
             return None
+
+    @staticmethod
+    def permit_security_rules(rules: [azure.mgmt.network.models.SecurityRule], permit_list: [permits.Permit],
+                              directions: Optional[set[str]] = None) \
+            -> Optional[list[azure.mgmt.network.models.SecurityRule]]:
+        """
+        The security rules of an NSG with the rules created from permit lists
+        replaced by the compiled permit list, in the given directions or else
+        in both, so that an empty list drops every such rule. Permits opening
+        the same ports share a rule. New rules take the priorities of the rules
+        they replace, then the ones after the highest priority in use, then the
+        lowest free ones. Return None when the rules already match.
+        """
+        desired = permits.compile(permit_list)
+        for permit in desired:
+            if permit.icmp_type != permits.ANY_ICMP:
+                raise ValueError(f"Security rules cannot match ICMP type {permit.icmp_type} of {permit}")
+        directions = directions if directions is not None else {permits.INBOUND, permits.OUTBOUND}
+        directions = {AZURE_DIRECTIONS[direction] for direction in directions}
+
+        groups = {}
+        for permit in desired:
+            key = (AZURE_DIRECTIONS[permit.direction], AZURE_PROTOCOLS.get(permit.protocol, permit.protocol),
+                   permit.from_port, permit.to_port)
+            groups.setdefault(key, []).append(permit.cidr)
+        wanted = {}
+        for (direction, protocol, from_port, to_port), cidrs in groups.items():
+            if direction not in directions:
+                continue
+            ports = "*" if (from_port, to_port) == (permits.MIN_PORT, permits.MAX_PORT) \
+                else str(from_port) if from_port == to_port else f"{from_port}-{to_port}"
+            name = f"{PERMIT_RULE_PREFIX}-{direction}-{protocol.replace('*', 'all')}-{ports.replace('*', 'all')}"
+            wanted[name] = create_security_rule(
+                name, direction, protocol,
+                dest_ports=[ports],
+                source_addresses=cidrs if direction == "Inbound" else None,
+                dest_addresses=cidrs if direction == "Outbound" else None,
+            )
+
+        def signature(rule: azure.mgmt.network.models.SecurityRule) -> tuple:
+            addresses = (rule.source_address_prefixes or [rule.source_address_prefix]) \
+                if rule.direction == "Inbound" else (rule.destination_address_prefixes or [rule.destination_address_prefix])
+            return (rule.direction, rule.protocol, rule.destination_port_range, tuple(sorted(addresses)))
+
+        kept, stale = [], []
+        for rule in rules:
+            managed = rule.name.startswith(PERMIT_RULE_PREFIX) and rule.direction in directions
+            if managed and rule.name in wanted and signature(rule) == signature(wanted[rule.name]):
+                del wanted[rule.name]
+            elif managed:
+                stale.append(rule)
+                continue
+            kept.append(rule)
+        if not wanted and not stale:
+            return None
+
+        used = {rule.priority for rule in kept}
+        highest = get_highest_rule_priority(kept)
+        candidates = itertools.chain(sorted(rule.priority for rule in stale if rule.priority is not None),
+                                     range(highest + 1, MAX_RULE_PRIORITY + 1),
+                                     range(MIN_RULE_PRIORITY, highest + 1))
+        free = (priority for priority in dict.fromkeys(candidates) if priority not in used)
+        for name in sorted(wanted):
+            priority = next(free, None)
+            if priority is None:
+                raise ValueError(f"No priority left for {len(wanted)} new security rules")
+            wanted[name].priority = priority
+        logger.info(f"{len(wanted)} security rules to add and {len(stale)} to remove")
+        return kept + [wanted[name] for name in sorted(wanted)]
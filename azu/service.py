@@ -28,9 +28,35 @@ class LoadBalancer(ServiceIP, AzureResourceMixin):
         logger.info(f"Creating a new load balancer {name}...")
         subnet = Subnet.load(subnet_name, vnet)
         private_ip = cls.private_ip_from_subnet(vnet.resource_group_name, vnet.name, subnet.subnet)
+        parameters, backend_pool = cls._load_balancer_parameters(name, subnet.subnet, private_ip)
+        poller = cls.network_client.load_balancers.begin_create_or_update(
+            resource_group_name=vnet.resource_group_name,
+            load_balancer_name=name,
+            parameters=parameters
+        )
+
+        result = poller.result()
+
+        cls.network_client.load_balancer_backend_address_pools.begin_create_or_update(
+            resource_group_name=vnet.resource_group_name,
+            load_balancer_name=name,
+            backend_address_pool_name=backend_pool.name,
+            parameters=backend_pool
+        )
+
+        logger.info(f"Success. instance_id: {result.id}")
+
+        return cls(result)
+
+    @classmethod
+    def _load_balancer_parameters(cls, name: str, subnet: azure.mgmt.network.models.Subnet,
+                                  private_ip: str) -> (AzureLoadBalancer, BackendAddressPool):
+        """
+        Build the load balancer definition together with its empty backend pool.
+        """
         private_frontend_ip_config = FrontendIPConfiguration(
             name=f"{name}-private-frontend-ip-config",
-            subnet=subnet.subnet,
+            subnet=subnet,
             private_ip_address=private_ip,
             public_ip_address=None,
         )
@@ -64,34 +90,18 @@ class LoadBalancer(ServiceIP, AzureResourceMixin):
             enable_floating_ip=False
         )
 
-        poller = cls.network_client.load_balancers.begin_create_or_update(
-            resource_group_name=vnet.resource_group_name,
-            load_balancer_name=name,
-            parameters=AzureLoadBalancer(
-                location=cls.location,
-                sku=LoadBalancerSku(
-                    name="Standard",
-                    tier="Regional"
-                ),
-                frontend_ip_configurations=[private_frontend_ip_config],
-                backend_address_pools=[backend_pool],
-                probes=[health_probe],
-                load_balancing_rule=[load_balancing_rule],
-            )
-        )
-
-        result = poller.result()
-
-        cls.network_client.load_balancer_backend_address_pools.begin_create_or_update(
-            resource_group_name=vnet.resource_group_name,
-            load_balancer_name=name,
-            backend_address_pool_name=backend_pool_name,
-            parameters=backend_pool
+        parameters = AzureLoadBalancer(
+            location=cls.location,
+            sku=LoadBalancerSku(
+                name="Standard",
+                tier="Regional"
+            ),
+            frontend_ip_configurations=[private_frontend_ip_config],
+            backend_address_pools=[backend_pool],
+            probes=[health_probe],
+            load_balancing_rule=[load_balancing_rule],
         )
-
-        logger.info(f"Success. instance_id: {result.id}")
-
-        return cls(result)
+        return parameters, backend_pool
 
     @property
     def name(self) -> str:
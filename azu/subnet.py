@@ -34,36 +34,15 @@ class Subnet(AzureResourceMixin):
 
     @classmethod
     def create(cls: Type[TSubnet], name: str, vnet: VirtualNet) -> TSubnet:
-        cidr = vnet.next_available_subnet_cidr()
+        return cls.create_many([name], vnet)[0]
 
-        logger.info(f"Creating an empty route table for the subnet...")
-        route_table: azure.mgmt.network.models.RouteTable = cls.network_client.route_tables.begin_create_or_update(
-            vnet.resource_group_name,
-            f"{name}-route-table",
-            {
-                "location": cls.location,
-                "routes": []
-            }
-        ).result()
-        logger.info(f"Success. route_table_id: {route_table.id}")
-
-        logger.info(f"Creating subnet {name} {cidr} for VirtualNet: {vnet.vnet_id}...")
-        poller = cls.network_client.subnets.begin_create_or_update(
-            vnet.resource_group_name,
-            vnet.name,
-            name,
-            {
-                "address_prefix": vnet.next_available_subnet_cidr(size=16),
-                "route_table": {
-                    "id": route_table.id
-                }
-            }
-        )
-
-        result = cls(poller.result())
-        logger.info(f"Success. subnet_id: {result.subnet_id}")
-
-        return result
+    @classmethod
+    def create_many(cls: Type[TSubnet], names: [str], vnet: VirtualNet) -> [TSubnet]:
+        """
+        Create one subnet per name, each with its own route table, through a
+        single update of the VirtualNet.
+        """
+        return [cls(subnet) for subnet in vnet.create_subnets(names)]
 
     @property
     def cidr(self):
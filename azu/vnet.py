@@ -1,9 +1,13 @@
+import threading
 from utils import *
 from azu.resource import *
+from azu.lro import LROGroup, LROGroupError
 import azure.mgmt.network.models
+import azure.core.exceptions
 from typing import Optional, Union, TypeVar, Type
 
 
+MAX_UPDATE_ATTEMPTS = 5
 TVirtualNet = TypeVar('TVirtualNet', bound='VirtualNet')
 logger = logging.getLogger(__name__)
 __all__ = ["VirtualNet"]
@@ -12,6 +16,9 @@ __all__ = ["VirtualNet"]
 class VirtualNet(AzureResourceMixin):
 
     vnet: Optional[azure.mgmt.network.models.VirtualNetwork] = None
+    _allocators: dict[str, CidrAllocator] = {}
+    _allocators_lock = threading.Lock()
+    _update_locks: dict[str, threading.Lock] = {}
     
     def __init__(self, vnet: Optional[azure.mgmt.network.models.VirtualNetwork] = None):
         super().__init__()
@@ -72,17 +79,127 @@ class VirtualNet(AzureResourceMixin):
 
         return result
 
-    def next_available_subnet_cidr(self, size: int = 16) -> str:
+    @property
+    def allocator(self) -> CidrAllocator:
+        """
+        The subnet allocator of this VirtualNet, seeded from a single listing of
+        its subnets the first time it is used and shared by every wrapper of it,
+        including the ones of the asyncio flavour.
+        """
+        with self._allocators_lock:
+            allocator = self._allocators.get(self.vnet_id)
+        if allocator is not None:
+            return allocator
         subnets = self.network_client.subnets.list(
             self.resource_group_name,
             self.name
         )
+        allocator = CidrAllocator([self.cidr], [subnet.address_prefix for subnet in subnets])
+        with self._allocators_lock:
+            return self._allocators.setdefault(self.vnet_id, allocator)
+
+    def next_available_subnet_cidr(self, size: int = 16) -> str:
+        return self.allocator.allocate(size)
+
+    def next_available_subnet_cidrs(self, count: int, size: int = 16) -> [str]:
+        """
+        Allocate ``count`` distinct free CIDR blocks for new subnets.
+        """
+        cidrs = self.allocator.allocate_many([size] * count)
+        if cidrs is None:
+            raise ValueError(f"VirtualNet {self.vnet_id} has no room for {count} subnets of size {size}")
+        return cidrs
 
-        subnets_cidr = [
-            subnet.address_prefix for subnet in subnets
-        ]
+    @property
+    def update_lock(self) -> threading.Lock:
+        """
+        Serializes read-modify-write updates of this VirtualNet's subnets, so
+        that concurrent updates do not drop each other's subnets.
+        """
+        with self._allocators_lock:
+            return self._update_locks.setdefault(self.vnet_id, threading.Lock())
 
-        return next_available_cidr([self.cidr], subnets_cidr, size)
+    def create_subnets(self, names: [str], size: int = 16) -> [azure.mgmt.network.models.Subnet]:
+        """
+        Create one subnet per name, each with its own empty route table. The
+        CIDR blocks are carved locally, the route tables are created
+        concurrently, and all subnets are added in a single update of the
+        VirtualNet.
+        """
+        if len(names) == 0:
+            return []
+
+        cidrs = self.next_available_subnet_cidrs(len(names), size)
+        route_tables = []
+        try:
+            logger.info(f"Creating {len(names)} empty route tables...")
+            with LROGroup() as group:
+                route_tables = [group.submit(
+                    self.network_client.route_tables.begin_create_or_update,
+                    self.resource_group_name,
+                    f"{name}-route-table",
+                    {
+                        "location": self.location,
+                        "routes": []
+                    }
+                ) for name in names]
+
+            with self.update_lock:
+                self._add_subnets([
+                    azure.mgmt.network.models.Subnet(
+                        name=name,
+                        address_prefix=cidr,
+                        route_table=azure.mgmt.network.models.RouteTable(id=route_table.result().id)
+                    )
+                    for name, cidr, route_table in zip(names, cidrs, route_tables)
+                ])
+        except Exception:
+            self._delete_route_tables([f"{name}-route-table" for name, route_table in zip(names, route_tables)
+                                       if route_table.done() and not route_table.cancelled()
+                                       and route_table.exception() is None])
+            for cidr in cidrs:
+                self.allocator.free(cidr)
+            raise
+
+        subnets = {subnet.name: subnet for subnet in self.vnet.subnets}
+        logger.info(f"Success. {len(names)} subnets created.")
+        return [subnets[name] for name in names]
+
+    def _add_subnets(self, subnets: [azure.mgmt.network.models.Subnet]):
+        """
+        Add subnets to the VirtualNet, updating it only if it is unchanged
+        since it was read. The update is retried on a fresh copy when another
+        process changed the VirtualNet in between, instead of dropping the
+        subnets it added.
+        """
+        for attempt in range(MAX_UPDATE_ATTEMPTS):
+            vnet = self.network_client.virtual_networks.get(self.resource_group_name, self.name)
+            vnet.subnets = list(vnet.subnets or []) + subnets
+            logger.info(f"Adding {len(subnets)} subnets to VirtualNet: {self.vnet_id}...")
+            try:
+                self.vnet = self.network_client.virtual_networks.begin_create_or_update(
+                    self.resource_group_name,
+                    self.name,
+                    vnet,
+                    headers={"If-Match": vnet.etag}
+                ).result()
+                return
+            except azure.core.exceptions.HttpResponseError as e:
+                if e.status_code != 412 or attempt == MAX_UPDATE_ATTEMPTS - 1:
+                    raise
+                logger.info(f"VirtualNet {self.vnet_id} was changed concurrently, retrying...")
+
+    def _delete_route_tables(self, names: [str]):
+        """Delete the route tables of subnets that could not be created."""
+        if len(names) == 0:
+            return
+        logger.info(f"Deleting {len(names)} route tables of subnets that were not created...")
+        try:
+            with LROGroup() as group:
+                for name in names:
+                    group.submit(self.network_client.route_tables.begin_delete, self.resource_group_name, name)
+        except LROGroupError as e:
+            logger.error(f"Could not delete the route tables of VirtualNet {self.vnet_id}: {e}")
 
     def deallocate(self):
         pass  # TODO: Implement deallocate
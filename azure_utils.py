@@ -1,5 +1,6 @@
 import string
 import random
+import logging
 from enum import Enum
 from azure.mgmt.network.models import SecurityRule, AzureFirewall
 
@@ -7,6 +8,7 @@ DEFAULT_OFF_RULE_NAME="DENY_ALL"
 VM_USERNAME="adminuser"
 PW_LENGTH=10
 LOCATION="westus2"
+logger = logging.getLogger(__name__)
 
 
 class Middlebox(Enum):
@@ -98,10 +100,11 @@ def select_primary(list):
 
 
 def wait_for_complete(poller, wait_increment=1):
-    """Wait on SDK poller until response is back."""
+    """Wait on SDK poller until response is back, and return its result."""
     while not poller.done():
         poller.wait(wait_increment)
-        print("Waiting...")
+        logger.debug("Waiting...")
+    return poller.result()
 
 
 def increment_subnet(subnet):
@@ -0,0 +1,189 @@
+"""
+End-to-end benchmarks of InvisinetAWS against a local moto stand-in.
+
+Every operation is timed, its botocore API calls are counted and its peak
+memory is traced at several deployment sizes. Results are written as JSON
+and compared with a committed baseline: a run fails when an operation
+issues more API calls, or becomes slower, than the baseline allows.
+
+Run with ``python -m benchmarks.aws``, and pass ``--update-baseline`` to
+record a new baseline after an intended change.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import tracemalloc
+from collections import Counter
+from definitions import ROOT_DIR
+from typing import Callable, Optional
+
+# Larger scales, e.g. --scales 1000, take hours against moto
+DEFAULT_SCALES = [1, 10, 100]
+DEFAULT_BASELINE = os.path.join(ROOT_DIR, "benchmarks", "baseline.json")
+DEFAULT_LATENCY_TOLERANCE = 3.0
+# Cached attributes expire during long runs, so call counts vary slightly
+DEFAULT_CALL_TOLERANCE = 1.05
+# Latency regressions below this many seconds are treated as noise
+LATENCY_NOISE_FLOOR = 0.05
+logger = logging.getLogger(__name__)
+
+
+class CallCounter:
+    """Counts the botocore API calls issued by every registry session."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, event_name: str, **kwargs):
+        _, service, operation = event_name.split(".", 2)
+        with self._lock:
+            self.calls[f"{service}.{operation}"] += 1
+
+    def install(self, session):
+        session.events.register("before-call", self)
+
+    def take(self) -> Counter:
+        with self._lock:
+            calls, self.calls = self.calls, Counter()
+        return calls
+
+
+def measure(counter: CallCounter, f: Callable[[], None], count: int) -> dict:
+    counter.take()
+    tracemalloc.start()
+    start = time.perf_counter()
+    f()
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls = counter.take()
+    return {
+        "count": count,
+        "wall_time": wall_time,
+        "peak_memory": peak_memory,
+        "total_calls": sum(calls.values()),
+        "calls": dict(sorted(calls.items())),
+    }
+
+
+def run_scale(scale: int, counter: CallCounter) -> dict[str, dict]:
+    """Run every benchmarked operation on a fresh deployment of ``scale`` endpoints."""
+    import aws
+    import clients
+
+    results = {}
+    deployment = aws.InvisinetAWS()
+    deployment.image_id = clients.registry.client("ec2").describe_images()["Images"][0]["ImageId"]
+    # Resolve the image and key pair outside of the measured operations
+    _ = deployment._image, deployment._key_pair
+
+    eips, sips = [], []
+    results["request_eip"] = measure(
+        counter, lambda: eips.extend(deployment.request_eip() for _ in range(scale)), scale)
+    results["request_sip"] = measure(
+        counter, lambda: sips.extend(deployment.request_sip() for _ in range(scale)), scale)
+    results["bind"] = measure(
+        counter, lambda: [deployment.bind(sips[0], eip) for eip in eips], scale)
+
+    middlebox = deployment.request_eip("invisinet-benchmark-middlebox")
+    pairs = [(eips[i], eips[i + 1]) for i in range(0, scale - 1, 2)]
+    results["annotate"] = measure(
+        counter, lambda: [deployment.annotate(pair, middlebox) for pair in pairs], len(pairs))
+    results["list_deployments"] = measure(counter, aws.InvisinetAWS.list_deployments, 1)
+    results["teardown"] = measure(
+        counter, lambda: [resource.terminate() for resource in eips + sips + [middlebox]],
+        len(eips) + len(sips) + 1)
+    return results
+
+
+def run(scales: [int]) -> dict[str, dict[str, dict]]:
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    import moto
+    import clients
+
+    counter = CallCounter()
+    clients.registry.add_session_hook(counter.install)
+    results = {}
+    for scale in scales:
+        with moto.mock_ec2(), moto.mock_elbv2():
+            logger.info(f"Benchmarking a deployment of {scale} endpoints...")
+            results[str(scale)] = run_scale(scale, counter)
+    return results
+
+
+def compare(results: dict, baseline: dict, latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE,
+            call_tolerance: float = DEFAULT_CALL_TOLERANCE) -> [str]:
+    """List every operation that regressed relative to the baseline."""
+    regressions = []
+    for scale, operations in results.items():
+        for operation, result in operations.items():
+            expected = baseline.get(scale, {}).get(operation)
+            if expected is None:
+                continue
+            if result["total_calls"] > expected["total_calls"] * call_tolerance:
+                regressions.append(
+                    f"{operation} at scale {scale}: {result['total_calls']} API calls, "
+                    f"baseline {expected['total_calls']}")
+            allowed = max(expected["wall_time"] * latency_tolerance,
+                          expected["wall_time"] + LATENCY_NOISE_FLOOR)
+            if result["wall_time"] > allowed:
+                regressions.append(
+                    f"{operation} at scale {scale}: {result['wall_time']:.3f}s, "
+                    f"baseline {expected['wall_time']:.3f}s")
+    return regressions
+
+
+def report(results: dict):
+    print(f"{'scale':>6} {'operation':>17} {'count':>6} {'wall (s)':>9} "
+          f"{'calls':>7} {'calls/op':>9} {'peak (KiB)':>11}")
+    for scale, operations in results.items():
+        for operation, result in operations.items():
+            per_operation = result["total_calls"] / result["count"] if result["count"] else 0
+            print(f"{scale:>6} {operation:>17} {result['count']:>6} {result['wall_time']:>9.3f} "
+                  f"{result['total_calls']:>7} {per_operation:>9.1f} {result['peak_memory'] / 1024:>11.0f}")
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--latency-tolerance", type=float, default=DEFAULT_LATENCY_TOLERANCE)
+    parser.add_argument("--call-tolerance", type=float, default=DEFAULT_CALL_TOLERANCE)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = run(args.scales)
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline to record one")
+        return 0
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.latency_tolerance, args.call_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="WARNING")
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+Micro-benchmarks for subnet CIDR allocation.
+
+Compares the per-allocation cost of rebuilding the used address space on
+every call, as next_available_cidr does, with a CidrAllocator that is
+seeded once. Run with ``python -m benchmarks.cidr``.
+"""
+import time
+import random
+import argparse
+import netaddr
+from utils import CidrAllocator
+
+ADDRESS_SPACE = "10.0.0.0/8"
+SUBNET_SIZES = [16, 32, 64, 256]
+
+
+def rebuild_allocate(available: [str], used: [str], size: int = 16):
+    """The allocation strategy CidrAllocator replaces, kept as the baseline."""
+    available_ip_set = netaddr.IPSet(available) - netaddr.IPSet(used)
+    prefix = 32 - (size - 1).bit_length()
+    for block in available_ip_set.iter_cidrs():
+        if block.prefixlen <= prefix:
+            return str(next(block.subnet(prefix, 1)))
+    return None
+
+
+def timed(f, repeat: int) -> float:
+    """Mean wall time of ``f`` in microseconds."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def run(subnets: int, repeat: int, seed: int = 0) -> dict[str, float]:
+    rng = random.Random(seed)
+    allocator = CidrAllocator([ADDRESS_SPACE])
+    used = allocator.allocate_many([rng.choice(SUBNET_SIZES) for _ in range(subnets)])
+
+    results = {
+        "seed": timed(lambda: CidrAllocator([ADDRESS_SPACE], used), 1),
+        "rebuild_allocate": timed(lambda: rebuild_allocate([ADDRESS_SPACE], used), min(repeat, 20)),
+    }
+
+    blocks = []
+    results["allocate"] = timed(lambda: blocks.append(allocator.allocate(rng.choice(SUBNET_SIZES))), repeat)
+    rng.shuffle(blocks)
+    results["free"] = timed(lambda: allocator.free(blocks.pop()), repeat)
+    batch = [rng.choice(SUBNET_SIZES) for _ in range(100)]
+    results["allocate_many_100"] = timed(lambda: allocator.allocate_many(batch), max(repeat // 100, 1))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subnets", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"{'subnets':>8} {'operation':>18} {'mean (us)':>12}")
+    for subnets in args.subnets:
+        for operation, mean in run(subnets, args.repeat).items():
+            print(f"{subnets:>8} {operation:>18} {mean:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
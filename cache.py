@@ -0,0 +1,143 @@
+import time
+import threading
+import singleflight
+from functools import wraps
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+DEFAULT_TTL = 60.0
+DEFAULT_MAX_SIZE = 10000
+__all__ = ["TTLCache", "attributes", "cached"]
+
+
+class TTLCache:
+    """
+    Thread-safe cache of resource attributes. Entries are keyed by the
+    resource they describe and the attribute name, expire ``ttl`` seconds
+    after they were loaded, and the least recently used entry is evicted
+    once the cache holds ``max_size`` entries. A load that was invalidated
+    or overwritten while in flight returns its value without caching it.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, max_size: int = DEFAULT_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[(Hashable, str), (float, Any)] = OrderedDict()
+        self._attributes: dict[Hashable, set[str]] = {}
+        # Changes to the entries being loaded since their load started
+        self._generations: dict[(Hashable, str), int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._loads = singleflight.Group()
+
+    def _remove(self, key: (Hashable, str)):
+        del self._entries[key]
+        owner, attribute = key
+        self._attributes[owner].discard(attribute)
+        if not self._attributes[owner]:
+            del self._attributes[owner]
+
+    def get(self, owner: Hashable, attribute: str, loader: Callable[[], Any]) -> Any:
+        """
+        Return the cached attribute of a resource, calling ``loader`` to load
+        it when it is missing or expired.
+        """
+        key = (owner, attribute)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        def load() -> Any:
+            with self._lock:
+                self._generations[key] = 0
+            try:
+                value = loader()
+            except BaseException:
+                with self._lock:
+                    del self._generations[key]
+                raise
+            with self._lock:
+                if self._generations.pop(key) == 0:
+                    self._put(key, value)
+            return value
+
+        return self._loads.do(key, load)
+
+    def contains(self, owner: Hashable, attribute: str) -> bool:
+        """Whether the attribute of a resource is cached and has not expired."""
+        with self._lock:
+            entry = self._entries.get((owner, attribute))
+            return entry is not None and entry[0] > time.monotonic()
+
+    def put(self, owner: Hashable, attribute: str, value: Any):
+        key = (owner, attribute)
+        with self._lock:
+            self._bump(key)
+            self._put(key, value)
+
+    def _put(self, key: (Hashable, str), value: Any):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._attributes.setdefault(key[0], set()).add(key[1])
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _bump(self, key: (Hashable, str)):
+        if key in self._generations:
+            self._generations[key] += 1
+
+    def invalidate(self, owner: Hashable, attribute: Optional[str] = None):
+        """
+        Drop one cached attribute of a resource, or all of them, including
+        the ones being loaded.
+        """
+        with self._lock:
+            attributes = [attribute] if attribute is not None else \
+                list(self._attributes.get(owner, ())) + [key[1] for key in self._generations if key[0] == owner]
+            for name in attributes:
+                self._bump((owner, name))
+                if (owner, name) in self._entries:
+                    self._remove((owner, name))
+
+    def clear(self):
+        with self._lock:
+            for key in self._generations:
+                self._generations[key] += 1
+            self._entries.clear()
+            self._attributes.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self._loads.shared,
+                "size": len(self._entries),
+            }
+
+
+attributes = TTLCache()
+
+
+def cached(owner: Callable[[Any], Hashable], cache: Optional[TTLCache] = None):
+    """
+    Cache the result of an argument-less method in the shared attribute
+    cache. ``owner`` maps the wrapper to the ID of the resource it wraps.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self):
+            return (cache or attributes).get(owner(self), f.__name__, lambda: f(self))
+
+        return wrapper
+
+    return decorator
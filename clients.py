@@ -0,0 +1,305 @@
+import os
+import boto3
+import logging
+import threading
+import contextvars
+import botocore.config
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, Optional
+
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+DEFAULT_RETRY_MODE = "standard"
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_MAX_WORKERS = 32
+logger = logging.getLogger(__name__)
+# Opt-in states of the regions a deployment can use
+ENABLED_REGION_STATES = ["opt-in-not-required", "opted-in"]
+__all__ = ["ClientRegistry", "registry", "AWSClient", "AWSResource", "AzureClient",
+           "region", "current_region", "regional", "map_concurrently"]
+
+# AWS region the running code works in, None for the configured default
+_region: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("invisinet_region", default=None)
+
+
+class ClientRegistry:
+    """
+    Creates cloud clients lazily on first use. boto3 sessions and resources
+    are not thread-safe, so every thread gets its own session, clients and
+    resources, each with its own connection pool. AWS clients are created
+    per region, for the region the calling code runs in. Azure management
+    clients are thread-safe and shared by all threads.
+
+    Concurrent requests run on the registry's executor, whose long-lived
+    threads keep their sessions and clients from one call to the next.
+    """
+
+    def __init__(self):
+        self.max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+        self.retry_mode = DEFAULT_RETRY_MODE
+        self.max_attempts = DEFAULT_MAX_ATTEMPTS
+        self.max_workers = DEFAULT_MAX_WORKERS
+        self.region_name: Optional[str] = None
+        self.regions: Optional[list[str]] = None
+        self._enabled_regions: Optional[list[str]] = None
+        self._local = threading.local()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._azure_credential = None
+        self._azure_clients: dict[type, Any] = {}
+        self._session_hooks: [Callable[[boto3.Session], None]] = []
+        self._azure_policies = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def configure(self, max_pool_connections: Optional[int] = None,
+                  retry_mode: Optional[str] = None,
+                  max_attempts: Optional[int] = None,
+                  region_name: Optional[str] = None,
+                  regions: Optional[list[str]] = None,
+                  max_workers: Optional[int] = None):
+        """
+        Change the client configuration. Clients created before the change are
+        dropped and recreated on their next use. ``regions`` restricts the
+        regions deployments are looked for in, all enabled regions by default.
+        ``max_workers`` bounds the threads of the executor.
+        """
+        with self._lock:
+            if max_workers is not None and max_workers != self.max_workers:
+                self.max_workers = max_workers
+                if self._executor is not None:
+                    # Calls in flight finish on the previous executor
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+            if max_pool_connections is not None:
+                self.max_pool_connections = max_pool_connections
+            if retry_mode is not None:
+                self.retry_mode = retry_mode
+            if max_attempts is not None:
+                self.max_attempts = max_attempts
+            if region_name is not None:
+                self.region_name = region_name
+            if regions is not None:
+                self.regions = list(regions)
+            self._enabled_regions = None
+            self._generation += 1
+            self._azure_clients.clear()
+
+    def add_session_hook(self, hook: Callable[[boto3.Session], None]):
+        """
+        Register a function called with every boto3 session the registry
+        creates, for example to subscribe to botocore events.
+        """
+        with self._lock:
+            self._session_hooks.append(hook)
+            self._generation += 1
+
+    def add_azure_policy(self, policy, async_policy=None):
+        """
+        Add an Azure pipeline policy, run on every attempt of every request
+        issued by the Azure clients the registry creates. Policies that are
+        not SansIO policies need an ``async_policy`` counterpart for the
+        asynchronous clients.
+        """
+        with self._lock:
+            self._azure_policies.append((policy, async_policy or policy))
+            self._azure_clients.clear()
+
+    @property
+    def azure_policies(self) -> list:
+        return [policy for policy, _ in self._azure_policies]
+
+    @property
+    def azure_async_policies(self) -> list:
+        return [policy for _, policy in self._azure_policies]
+
+    @property
+    def botocore_config(self) -> botocore.config.Config:
+        return botocore.config.Config(
+            max_pool_connections=self.max_pool_connections,
+            retries={"mode": self.retry_mode, "max_attempts": self.max_attempts},
+        )
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """The bounded executor shared by every concurrent request of the process."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="invisinet-worker")
+            return self._executor
+
+    def _thread_state(self) -> dict:
+        state = getattr(self._local, "state", None)
+        if state is None or state["generation"] != self._generation:
+            session = boto3.Session(region_name=self.region_name)
+            for hook in self._session_hooks:
+                hook(session)
+            state = {"generation": self._generation, "session": session,
+                     "clients": {}, "resources": {}}
+            self._local.state = state
+        return state
+
+    def session(self) -> boto3.Session:
+        return self._thread_state()["session"]
+
+    def client(self, service: str):
+        clients = self._thread_state()["clients"]
+        key = (service, _region.get())
+        if key not in clients:
+            clients[key] = self.session().client(service, region_name=key[1], config=self.botocore_config)
+        return clients[key]
+
+    def resource(self, service: str):
+        resources = self._thread_state()["resources"]
+        key = (service, _region.get())
+        if key not in resources:
+            resources[key] = self.session().resource(service, region_name=key[1], config=self.botocore_config)
+        return resources[key]
+
+    def enabled_regions(self) -> [str]:
+        """The configured regions, or every region enabled for the account, described once."""
+        if self.regions is not None:
+            return list(self.regions)
+        if self._enabled_regions is None:
+            response = self.client("ec2").describe_regions(
+                Filters=[{"Name": "opt-in-status", "Values": ENABLED_REGION_STATES}]
+            )
+            self._enabled_regions = sorted(entry["RegionName"] for entry in response["Regions"])
+        return list(self._enabled_regions)
+
+    @property
+    def azure_subscription_id(self) -> str:
+        return os.environ["AZURE_SUBSCRIPTION_ID"]
+
+    @property
+    def azure_credential(self):
+        with self._lock:
+            if self._azure_credential is None:
+                from azure.identity import AzureCliCredential
+                self._azure_credential = AzureCliCredential()
+            return self._azure_credential
+
+    def azure_client(self, client_cls: type):
+        credential = self.azure_credential
+        with self._lock:
+            if client_cls not in self._azure_clients:
+                import requests.adapters
+                from azure.core.pipeline.transport import RequestsTransport
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.max_pool_connections)
+                session.mount("https://", adapter)
+                self._azure_clients[client_cls] = client_cls(
+                    credential,
+                    self.azure_subscription_id,
+                    transport=RequestsTransport(session=session, session_owner=False),
+                    retry_total=self.max_attempts,
+                    per_retry_policies=self.azure_policies,
+                )
+            return self._azure_clients[client_cls]
+
+
+registry = ClientRegistry()
+
+
+class AWSClient:
+    """Class attribute resolving to the calling thread's boto3 client."""
+
+    def __init__(self, service: str):
+        self.service = service
+
+    def __get__(self, obj, owner):
+        return registry.client(self.service)
+
+
+class AWSResource:
+    """Class attribute resolving to the calling thread's boto3 resource."""
+
+    def __init__(self, service: str):
+        self.service = service
+
+    def __get__(self, obj, owner):
+        return registry.resource(self.service)
+
+
+class AzureClient:
+    """Class attribute resolving to the shared Azure management client."""
+
+    def __init__(self, client_cls: type):
+        self.client_cls = client_cls
+
+    def __get__(self, obj, owner):
+        return registry.azure_client(self.client_cls)
+
+
+def current_region() -> Optional[str]:
+    """The AWS region the running code works in."""
+    return _region.get() or registry.region_name or registry.session().region_name
+
+
+class region:
+    """
+    Run the AWS requests issued inside this block in another region. None
+    keeps the current region.
+    """
+
+    def __init__(self, name: Optional[str]):
+        self.name = name
+        self._token = None
+
+    def __enter__(self):
+        if self.name is not None:
+            self._token = _region.set(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if self._token is not None:
+            _region.reset(self._token)
+            self._token = None
+
+
+def map_concurrently(f: Callable[[Any], Any], items: Iterable, max_concurrency: int) -> list:
+    """
+    Call ``f`` with every item, at most ``max_concurrency`` at once, on the
+    registry's executor, and return the results in order. Every call runs in
+    a copy of the caller's context. The calling thread works through the
+    items as well, so that calls nested in the items of another call make
+    progress even when every thread of the executor is busy. The first
+    error stops the items not started yet, and is raised once the started
+    ones finished.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    context = contextvars.copy_context()
+    remaining = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                index = next(remaining, None) if not errors else None
+            if index is None:
+                return
+            try:
+                results[index] = context.copy().run(f, items[index])
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    helpers = [registry.executor.submit(work) for _ in range(min(len(items), max_concurrency) - 1)]
+    work()
+    # Helpers the executor did not start yet have nothing left to do
+    wait([helper for helper in helpers if not helper.cancel()])
+    if errors:
+        raise errors[0]
+    return results
+
+
+def regional(f: Callable) -> Callable:
+    """Run a method of a resource wrapper in the region of the resource, given by its ``region``."""
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with region(self.region):
+            return f(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,147 @@
+import time
+import attrs
+import clients
+import logging
+import itertools
+import threading
+import contextvars
+import transactions.context
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Optional
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+
+DEFAULT_MAX_JOBS = 32
+logger = logging.getLogger(__name__)
+__all__ = ["JobCancelled", "Job", "JobManager", "manager", "checkpoint", "JobCancelPolicy"]
+
+_job: contextvars.ContextVar[Optional["Job"]] = contextvars.ContextVar("invisinet_job", default=None)
+
+
+class JobCancelled(Exception):
+    """A background job was cancelled while it was running."""
+
+
+@attrs.define(eq=False)
+class Job:
+    id: int
+    command: str
+    future: Optional[Future] = None
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    cancel_requested: bool = False
+    interrupted: bool = False
+    reported: bool = False
+
+    @property
+    def state(self) -> str:
+        if not self.future.done():
+            return "running" if self.started is not None else "pending"
+        if self.future.cancelled() or isinstance(self.future.exception(), JobCancelled):
+            return "cancelled"
+        return "failed" if self.future.exception() is not None else "done"
+
+    @property
+    def seconds(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished if self.finished is not None else time.monotonic()) - self.started
+
+
+class JobManager:
+    """
+    Runs commands in the background on a thread pool, each in a copy of the
+    context it was submitted from, but outside of its transaction: every job
+    records its own transactions. Pending jobs are cancelled outright, and
+    running ones cooperatively: a cancelled job raises JobCancelled from its
+    next provider request, and the requests it makes afterwards to clean up,
+    such as rolling back its transaction, go through.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_JOBS):
+        self.max_workers = max_workers
+        self._jobs: dict[int, Job] = {}
+        self._ids = itertools.count(1)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def submit(self, command: str, f: Callable[[], Any]) -> Job:
+        context = contextvars.copy_context()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="invisinet-job")
+            job = Job(next(self._ids), command)
+            self._jobs[job.id] = job
+            job.future = self._executor.submit(context.run, self._run, job, f)
+        return job
+
+    @staticmethod
+    def _run(job: Job, f: Callable[[], Any]) -> Any:
+        job.started = time.monotonic()
+        _job.set(job)
+        transactions.context.activate(transactions.context.SingleActionContext())
+        try:
+            return f()
+        finally:
+            job.finished = time.monotonic()
+
+    def get(self, job_id: int) -> Job:
+        with self._lock:
+            if job_id not in self._jobs:
+                raise ValueError(f"No job {job_id}")
+            return self._jobs[job_id]
+
+    def jobs(self) -> [Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: int) -> Job:
+        job = self.get(job_id)
+        job.cancel_requested = True
+        if job.future.cancel():
+            logger.info(f"Job {job.id} cancelled before it started")
+        return job
+
+    def wait(self, job_ids: Optional[list[int]] = None, timeout: Optional[float] = None) -> [Job]:
+        """Wait for the given jobs, all of them but the calling one by default, returning them."""
+        jobs = [self.get(job_id) for job_id in job_ids] if job_ids else \
+            [job for job in self.jobs() if job is not _job.get()]
+        wait([job.future for job in jobs], timeout)
+        return jobs
+
+    def finished(self) -> [Job]:
+        """The jobs that finished since the last call, so that each is reported once."""
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.future.done() and not job.reported]
+            for job in jobs:
+                job.reported = True
+        return jobs
+
+
+manager = JobManager()
+
+
+def checkpoint():
+    """Raise JobCancelled in a running job that was cancelled, once."""
+    job = _job.get()
+    if job is not None and job.cancel_requested and not job.interrupted:
+        job.interrupted = True
+        raise JobCancelled(f"Job {job.id} cancelled")
+
+
+def _before_call(**kwargs):
+    checkpoint()
+
+
+def _check_session(session):
+    session.events.register("before-call", _before_call)
+
+
+class JobCancelPolicy(SansIOHTTPPolicy):
+    """Azure pipeline policy interrupting a cancelled job before its next request."""
+
+    def on_request(self, request):
+        checkpoint()
+
+
+clients.registry.add_session_hook(_check_session)
+clients.registry.add_azure_policy(JobCancelPolicy())
@@ -0,0 +1,358 @@
+import time
+import bisect
+import asyncio
+import inspect
+import clients
+import threading
+import contextvars
+from functools import wraps
+from urllib.parse import urlparse
+from typing import Callable, Optional
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+# Error codes with which AWS and Azure reject requests over the rate limit
+THROTTLE_ERROR_CODES = frozenset({
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottledException",
+    "TooManyRequestsException", "RequestLimitExceeded", "RequestLimitExceededException",
+    "SlowDown", "EC2ThrottledException", "PriorRequestNotComplete", "TooManyRequests",
+})
+UNATTRIBUTED = "none"
+__all__ = ["Histogram", "MetricsRegistry", "registry", "operation", "current_operation",
+           "instrument", "propagate", "AzureMetricsPolicy"]
+
+_operation: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("invisinet_operation", default=None)
+
+
+class Histogram:
+    """Cumulative latency histogram with fixed bucket upper bounds, in seconds."""
+
+    def __init__(self, buckets: (float,) = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> [(str, int)]:
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        total, result = 0, []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile."""
+        rank, total = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """
+    Provider request metrics attributed to the Invisinet operation that
+    issued them. Calls are keyed by (operation, provider, service, call).
+    """
+
+    def __init__(self, buckets: (float,) = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls: dict[(str, str, str, str), int] = {}
+            self.errors: dict[(str, str, str, str), int] = {}
+            self.throttles: dict[(str, str, str, str), int] = {}
+            self.latencies: dict[(str, str, str, str), Histogram] = {}
+            self.operations: dict[(str, str), Histogram] = {}
+
+    def record_call(self, provider: str, service: str, call: str, duration: float,
+                    error: bool = False, throttled: bool = False):
+        key = (current_operation() or UNATTRIBUTED, provider, service, call)
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            if error:
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if throttled:
+                self.throttles[key] = self.throttles.get(key, 0) + 1
+            if key not in self.latencies:
+                self.latencies[key] = Histogram(self.buckets)
+            self.latencies[key].observe(duration)
+
+    def record_operation(self, name: str, provider: str, duration: float):
+        key = (name, provider)
+        with self._lock:
+            if key not in self.operations:
+                self.operations[key] = Histogram(self.buckets)
+            self.operations[key].observe(duration)
+
+    def summary(self) -> [dict]:
+        """Per-operation totals, slowest operations first."""
+        totals = {}
+
+        def entry(name: str, provider: str) -> dict:
+            return totals.setdefault((name, provider), {
+                "operation": name, "provider": provider, "count": 0, "seconds": 0.0,
+                "calls": 0, "call_seconds": 0.0, "errors": 0, "throttles": 0,
+            })
+
+        with self._lock:
+            for (name, provider), histogram in self.operations.items():
+                entry(name, provider).update(count=histogram.count, seconds=histogram.sum)
+            for (name, provider, _, _), histogram in self.latencies.items():
+                entry(name, provider)["calls"] += histogram.count
+                entry(name, provider)["call_seconds"] += histogram.sum
+            for (name, provider, _, _), count in self.errors.items():
+                entry(name, provider)["errors"] += count
+            for (name, provider, _, _), count in self.throttles.items():
+                entry(name, provider)["throttles"] += count
+        return sorted(totals.values(), key=lambda e: -max(e["seconds"], e["call_seconds"]))
+
+    def calls_by_operation(self, name: str) -> [((str, str, str), int, Histogram)]:
+        with self._lock:
+            return sorted(((key[1:], self.calls[key], self.latencies[key])
+                           for key in self.calls if key[0] == name),
+                          key=lambda item: -item[2].sum)
+
+    def latency(self, provider: str, service: str, call: str) -> Histogram:
+        """Latency histogram of a provider request over every operation that issued it."""
+        merged = Histogram(self.buckets)
+        with self._lock:
+            for key, histogram in self.latencies.items():
+                if key[1:] == (provider, service, call):
+                    merged.counts = [total + count for total, count in zip(merged.counts, histogram.counts)]
+                    merged.sum += histogram.sum
+                    merged.count += histogram.count
+        return merged
+
+    def mean_latency(self, provider: str, service: str, call: str) -> Optional[float]:
+        """Mean latency of a provider request over every operation that issued it."""
+        histogram = self.latency(provider, service, call)
+        return histogram.sum / histogram.count if histogram.count else None
+
+    def idle_time(self, name: str, provider: str) -> Optional[float]:
+        """
+        Mean time an operation spends outside of provider requests, such as
+        waiting for resources to become ready, or None if it never ran.
+        """
+        with self._lock:
+            histogram = self.operations.get((name, provider))
+            if histogram is None or histogram.count == 0:
+                return None
+            call_seconds = sum(latency.sum for key, latency in self.latencies.items()
+                               if key[:2] == (name, provider))
+            return max(0.0, (histogram.sum - call_seconds) / histogram.count)
+
+    def export(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+
+        def labels(**values) -> str:
+            return ",".join(f'{name}="{_escape(value)}"' for name, value in values.items())
+
+        def counter(metric: str, description: str, values: dict):
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for (name, provider, service, call), count in sorted(values.items()):
+                lines.append(f"{metric}{{{labels(operation=name, provider=provider, service=service, call=call)}}}"
+                             f" {count}")
+
+        def histogram(metric: str, description: str, values: dict, label_names: (str,)):
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} histogram")
+            for key, value in sorted(values.items()):
+                label_text = labels(**dict(zip(label_names, key)))
+                for bound, count in value.cumulative():
+                    lines.append(f'{metric}_bucket{{{label_text},le="{bound}"}} {count}')
+                lines.append(f"{metric}_sum{{{label_text}}} {value.sum}")
+                lines.append(f"{metric}_count{{{label_text}}} {value.count}")
+
+        with self._lock:
+            counter("invisinet_api_calls_total", "Provider API requests.", self.calls)
+            counter("invisinet_api_errors_total", "Provider API requests that failed.", self.errors)
+            counter("invisinet_api_throttles_total", "Provider API requests rejected by rate limiting.",
+                    self.throttles)
+            histogram("invisinet_api_call_duration_seconds", "Provider API request latency.",
+                      self.latencies, ("operation", "provider", "service", "call"))
+            histogram("invisinet_operation_duration_seconds", "Invisinet operation latency.",
+                      self.operations, ("operation", "provider"))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        with open(path, "w") as f:
+            f.write(self.export())
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+registry = MetricsRegistry()
+
+
+def current_operation() -> Optional[str]:
+    return _operation.get()
+
+
+class operation:
+    """
+    Attribute the provider requests issued inside this block to the named
+    Invisinet operation. Nested operations keep the outermost name.
+    """
+
+    def __init__(self, name: str, provider: str = UNATTRIBUTED):
+        self.name = name
+        self.provider = provider
+        self._token = None
+
+    def __enter__(self):
+        if _operation.get() is None:
+            self._token = _operation.set(self.name)
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self._token is not None:
+            registry.record_operation(self.name, self.provider, time.perf_counter() - self._start)
+            _operation.reset(self._token)
+            self._token = None
+
+
+def instrument(provider: str, name: Optional[str] = None):
+    """
+    Decorator running a method, coroutine method or generator method as an
+    Invisinet operation. Generators are attributed the requests issued while
+    producing items, and their duration excludes the time the consumer
+    spends between items.
+    """
+    def decorator(f):
+        operation_name = name or f.__name__
+
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def wrapper(*args, **kwargs):
+                with operation(operation_name, provider):
+                    return await f(*args, **kwargs)
+        elif inspect.isgeneratorfunction(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                generator = f(*args, **kwargs)
+                outermost = _operation.get() is None
+                duration = 0.0
+                try:
+                    while True:
+                        token = _operation.set(operation_name) if outermost else None
+                        start = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        finally:
+                            duration += time.perf_counter() - start
+                            if token is not None:
+                                _operation.reset(token)
+                        yield item
+                finally:
+                    generator.close()
+                    if outermost:
+                        registry.record_operation(operation_name, provider, duration)
+        else:
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with operation(operation_name, provider):
+                    return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def propagate(f: Callable) -> Callable:
+    """
+    Bind ``f`` to the caller's context, so that work handed to a thread pool
+    is attributed to the operation that submitted it.
+    """
+    context = contextvars.copy_context()
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(f, *args, **kwargs)
+
+    return wrapper
+
+
+def _before_call(model, context: dict, **kwargs):
+    context["invisinet_call"] = (model.service_model.service_name, model.name, time.perf_counter())
+
+
+def _after_call(http_response, parsed: dict, context: dict, **kwargs):
+    call = context.pop("invisinet_call", None)
+    if call is None:
+        return
+    service, name, start = call
+    code = parsed.get("Error", {}).get("Code") if isinstance(parsed, dict) else None
+    registry.record_call("aws", service, name, time.perf_counter() - start,
+                         error=http_response is None or http_response.status_code >= 400,
+                         throttled=code in THROTTLE_ERROR_CODES)
+
+
+def _after_call_error(context: dict, **kwargs):
+    call = context.pop("invisinet_call", None)
+    if call is not None:
+        service, name, start = call
+        registry.record_call("aws", service, name, time.perf_counter() - start, error=True)
+
+
+def _instrument_session(session):
+    session.events.register("before-call", _before_call)
+    session.events.register("after-call", _after_call)
+    session.events.register("after-call-error", _after_call_error)
+
+
+def _azure_call(method: str, url: str) -> (str, str):
+    """Name an ARM request after its provider and the last resource type in its path."""
+    segments = [segment for segment in urlparse(url).path.split("/") if segment]
+    service, resource_type = "arm", "resourceGroups" if "resourceGroups" in segments else "subscriptions"
+    if "providers" in segments:
+        index = len(segments) - 1 - segments[::-1].index("providers")
+        if index + 1 < len(segments):
+            service = segments[index + 1]
+        types = segments[index + 2::2]
+        if types:
+            resource_type = types[-1]
+    return service, f"{method} {resource_type}"
+
+
+class AzureMetricsPolicy(SansIOHTTPPolicy):
+    """Azure pipeline policy recording every request attempt, including retries."""
+
+    def on_request(self, request):
+        request.context["invisinet_start"] = time.perf_counter()
+
+    def on_response(self, request, response):
+        start = request.context.pop("invisinet_start", None)
+        if start is None:
+            return
+        status = response.http_response.status_code
+        service, call = _azure_call(request.http_request.method, request.http_request.url)
+        registry.record_call("azure", service, call, time.perf_counter() - start,
+                             error=status >= 400, throttled=status == 429)
+
+    def on_exception(self, request):
+        start = request.context.pop("invisinet_start", None)
+        if start is not None:
+            service, call = _azure_call(request.http_request.method, request.http_request.url)
+            registry.record_call("azure", service, call, time.perf_counter() - start, error=True)
+
+
+clients.registry.add_session_hook(_instrument_session)
+clients.registry.add_azure_policy(AzureMetricsPolicy())
@@ -0,0 +1,118 @@
+import attrs
+import netaddr
+from typing import Iterable
+
+INBOUND = "inbound"
+OUTBOUND = "outbound"
+ALL_PROTOCOLS = "all"
+MIN_PORT = 0
+MAX_PORT = 65535
+# ICMP type or code matching every type or code
+ANY_ICMP = -1
+__all__ = ["Permit", "INBOUND", "OUTBOUND", "ALL_PROTOCOLS", "ANY_ICMP", "compile", "diff"]
+
+
+@attrs.define(frozen=True, order=True)
+class Permit:
+    """
+    Traffic allowed to or from an endpoint: the remote addresses in ``cidr``,
+    over ``protocol`` and on the ports from ``from_port`` to ``to_port``,
+    both included. Ports are ignored by protocols without them. ICMP permits
+    can be narrowed to an ``icmp_type`` and an ``icmp_code`` of that type.
+    """
+    direction: str = attrs.field(validator=attrs.validators.in_({INBOUND, OUTBOUND}))
+    protocol: str = attrs.field(converter=str.lower)
+    cidr: str = attrs.field(converter=lambda cidr: str(netaddr.IPNetwork(cidr).cidr))
+    from_port: int = MIN_PORT
+    to_port: int = MAX_PORT
+    icmp_type: int = ANY_ICMP
+    icmp_code: int = ANY_ICMP
+
+    def __attrs_post_init__(self):
+        if self.protocol not in ("tcp", "udp"):
+            # Protocols without ports match regardless of the ports given
+            object.__setattr__(self, "from_port", MIN_PORT)
+            object.__setattr__(self, "to_port", MAX_PORT)
+        if self.protocol != "icmp":
+            object.__setattr__(self, "icmp_type", ANY_ICMP)
+            object.__setattr__(self, "icmp_code", ANY_ICMP)
+        if not MIN_PORT <= self.from_port <= self.to_port <= MAX_PORT:
+            raise ValueError(f"Invalid port range {self.from_port}-{self.to_port}")
+        if self.icmp_type == ANY_ICMP and self.icmp_code != ANY_ICMP:
+            raise ValueError(f"ICMP code {self.icmp_code} given without an ICMP type")
+
+
+
+def _merge_ranges(ranges: [(int, int)]) -> [(int, int)]:
+    """Merge overlapping and adjacent port ranges."""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _covers(ranges: [(int, int)], covered: [(int, int)]) -> bool:
+    return all(any(first <= covered_first and covered_last <= last for first, last in ranges)
+               for covered_first, covered_last in covered)
+
+
+def _icmp_covers(wider: Permit, narrower: Permit) -> bool:
+    """Whether an ICMP permit allows every message another one allows, to a block within its own."""
+    return wider.direction == narrower.direction \
+        and wider.icmp_type in (ANY_ICMP, narrower.icmp_type) and wider.icmp_code in (ANY_ICMP, narrower.icmp_code) \
+        and netaddr.IPNetwork(narrower.cidr) in netaddr.IPNetwork(wider.cidr)
+
+
+def _compile_group(group: dict[netaddr.IPNetwork, list]) -> dict[netaddr.IPNetwork, list]:
+    """One pass of compile over the port ranges allowed to every CIDR."""
+    group = {cidr: _merge_ranges(ranges) for cidr, ranges in group.items()}
+    # Visiting larger blocks first, a block is dropped when a kept block contains it
+    kept: dict[netaddr.IPNetwork, list] = {}
+    for cidr in sorted(group, key=lambda cidr: (cidr.prefixlen, cidr.first)):
+        if not any(cidr in other and _covers(ranges, group[cidr]) for other, ranges in kept.items()):
+            kept[cidr] = group[cidr]
+
+    by_ranges: dict[tuple, list] = {}
+    for cidr, ranges in kept.items():
+        by_ranges.setdefault(tuple(ranges), []).append(cidr)
+    compiled: dict[netaddr.IPNetwork, list] = {}
+    for ranges, cidrs in by_ranges.items():
+        for cidr in netaddr.cidr_merge(cidrs):
+            compiled.setdefault(cidr, []).extend(ranges)
+    return compiled
+
+
+def compile(permits: Iterable[Permit]) -> [Permit]:
+    """
+    The smallest equivalent permit list: the port ranges of every CIDR are
+    merged, CIDRs within a larger one allowing at least the same ports are
+    dropped, and the CIDRs allowing the same ports are aggregated, until
+    nothing can be merged anymore. ICMP permits within one allowing every
+    type, or every code of their type, are dropped as well.
+    """
+    groups: dict[(str, str, int, int), dict[netaddr.IPNetwork, list]] = {}
+    for permit in permits:
+        group = groups.setdefault((permit.direction, permit.protocol, permit.icmp_type, permit.icmp_code), {})
+        group.setdefault(netaddr.IPNetwork(permit.cidr), []).append((permit.from_port, permit.to_port))
+
+    compiled = []
+    for (direction, protocol, icmp_type, icmp_code), group in groups.items():
+        while True:
+            merged = _compile_group(group)
+            if merged == {cidr: _merge_ranges(ranges) for cidr, ranges in group.items()}:
+                break
+            group = merged
+        compiled += [Permit(direction, protocol, str(cidr), first, last, icmp_type, icmp_code)
+                     for cidr, ranges in merged.items() for first, last in ranges]
+    icmp = [permit for permit in compiled if permit.protocol == "icmp"]
+    return sorted(permit for permit in compiled
+                  if not any(other != permit and _icmp_covers(other, permit) for other in icmp))
+
+
+def diff(current: Iterable[Permit], desired: Iterable[Permit]) -> ([Permit], [Permit]):
+    """The permits to add and the ones to remove to go from ``current`` to ``desired``."""
+    current, desired = set(current), set(desired)
+    return sorted(desired - current), sorted(current - desired)
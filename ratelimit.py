@@ -0,0 +1,257 @@
+import time
+import asyncio
+import clients
+import logging
+import metrics
+import threading
+import email.utils
+from urllib.parse import urlparse
+from typing import Optional
+from azure.core.pipeline.policies import HTTPPolicy, AsyncHTTPPolicy
+
+# Request token buckets of every API family, as (requests refilled per second,
+# bucket size). EC2 buckets follow its documented request throttling, ELBv2
+# publishes none, and ARM buckets are those of write requests, the stricter.
+DEFAULT_RATES = {
+    "ec2-describe": (20.0, 100),
+    "ec2-mutate": (5.0, 200),
+    "elbv2": (10.0, 40),
+    "arm-network": (10.0, 200),
+    "arm-compute": (10.0, 200),
+}
+DEFAULT_MAX_CONCURRENCY = 32
+# Requests in flight gain one per window of successful requests, and halve on throttling
+ADDITIVE_INCREASE = 1.0
+MULTIPLICATIVE_DECREASE = 0.5
+# Throttles answered within this many seconds of a decrease do not decrease again
+DECREASE_COOLDOWN = 1.0
+# Longest Retry-After honored, in seconds
+MAX_RETRY_AFTER = 60.0
+# Interval at which requests waiting for a slot check again, unless woken up by a release
+SLOT_POLL_INTERVAL = 0.05
+logger = logging.getLogger(__name__)
+__all__ = ["Limiter", "RateLimiterRegistry", "registry", "aws_family", "azure_family",
+           "AzureRateLimitPolicy", "AsyncAzureRateLimitPolicy"]
+
+
+class Limiter:
+    """
+    Admission control for the requests to one API family: a token bucket
+    bounding their rate, and a limit on the requests in flight that grows
+    additively while requests succeed and shrinks multiplicatively when the
+    provider throttles. A Retry-After from the provider holds every request
+    back until it elapses.
+    """
+
+    def __init__(self, rate: float, burst: int, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        if rate <= 0 or burst < 1 or max_concurrency < 1:
+            raise ValueError(f"Invalid limits: rate {rate}, burst {burst}, max_concurrency {max_concurrency}")
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.throttles = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = float("-inf")
+        self._condition = threading.Condition()
+
+    def _admit(self) -> float:
+        """Take a slot and a token, or return how long to wait before trying again."""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self.in_flight >= int(self.concurrency):
+            return SLOT_POLL_INTERVAL
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        self._tokens -= 1
+        self.in_flight += 1
+        return 0.0
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                delay = self._admit()
+                if delay == 0.0:
+                    return
+                self._condition.wait(delay)
+
+    async def acquire_async(self):
+        while True:
+            with self._condition:
+                delay = self._admit()
+            if delay == 0.0:
+                return
+            await asyncio.sleep(delay)
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None):
+        """Give back the slot of a finished request, adjusting the limits to its outcome."""
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttles += 1
+                if now - self._last_decrease >= DECREASE_COOLDOWN:
+                    self.concurrency = max(1.0, self.concurrency * MULTIPLICATIVE_DECREASE)
+                    self._tokens = 0.0
+                    self._last_decrease = now
+                    logger.info(f"Throttled, allowing {int(self.concurrency)} requests in flight")
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + ADDITIVE_INCREASE / self.concurrency)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, now + min(retry_after, MAX_RETRY_AFTER))
+            self._condition.notify_all()
+
+
+class RateLimiterRegistry:
+    """
+    Limiters by API family and scope. AWS throttles per account and region,
+    so AWS families are scoped by region, and ARM throttles per subscription.
+    """
+
+    def __init__(self):
+        self.rates: dict[str, (float, int)] = dict(DEFAULT_RATES)
+        self.max_concurrency = DEFAULT_MAX_CONCURRENCY
+        self._limiters: dict[(str, Optional[str]), Limiter] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, family: str, rate: Optional[float] = None, burst: Optional[int] = None):
+        """Change the token bucket of a family, replacing its limiters."""
+        with self._lock:
+            if family not in self.rates:
+                raise ValueError(f"Unknown API family {family}")
+            current_rate, current_burst = self.rates[family]
+            self.rates[family] = (rate if rate is not None else current_rate,
+                                  burst if burst is not None else current_burst)
+            for key in [key for key in self._limiters if key[0] == family]:
+                del self._limiters[key]
+
+    def limiter(self, family: str, scope: Optional[str] = None) -> Limiter:
+        with self._lock:
+            key = (family, scope)
+            if key not in self._limiters:
+                rate, burst = self.rates[family]
+                self._limiters[key] = Limiter(rate, burst, self.max_concurrency)
+            return self._limiters[key]
+
+    def limiters(self) -> dict[(str, Optional[str]), Limiter]:
+        with self._lock:
+            return dict(self._limiters)
+
+
+registry = RateLimiterRegistry()
+
+
+def aws_family(service_id: str, operation: str) -> Optional[str]:
+    """The API family of an AWS request, None for the services that are not limited."""
+    if service_id == "ec2":
+        return "ec2-describe" if operation.startswith(("Describe", "Get", "List")) else "ec2-mutate"
+    if service_id == "elastic-load-balancing-v2":
+        return "elbv2"
+    return None
+
+
+def azure_family(url: str) -> Optional[str]:
+    """The API family of an ARM request, None for the providers that are not limited."""
+    path = urlparse(url).path.lower()
+    if "/providers/microsoft.network/" in path:
+        return "arm-network"
+    if "/providers/microsoft.compute/" in path:
+        return "arm-compute"
+    return None
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _request_created(request, operation_name: str, event_name: str, **kwargs):
+    # Emitted for every attempt, including retries
+    family = aws_family(event_name.split(".")[1], operation_name)
+    if family is None:
+        return
+    limiter = registry.limiter(family, request.context.get("client_region"))
+    limiter.acquire()
+    request.context["invisinet_limiter"] = limiter
+
+
+def _response_received(context: dict, response_dict: Optional[dict], parsed_response, **kwargs):
+    limiter = context.pop("invisinet_limiter", None)
+    if limiter is None:
+        return
+    code = parsed_response.get("Error", {}).get("Code") if isinstance(parsed_response, dict) else None
+    throttled = code in metrics.THROTTLE_ERROR_CODES
+    retry_after = _retry_after(response_dict["headers"].get("Retry-After")) \
+        if throttled and response_dict is not None else None
+    limiter.release(throttled, retry_after)
+
+
+def _limit_session(session):
+    session.events.register("request-created", _request_created)
+    session.events.register("response-received", _response_received)
+
+
+def _azure_limiter(request) -> Optional[Limiter]:
+    family = azure_family(request.http_request.url)
+    return registry.limiter(family) if family is not None else None
+
+
+def _azure_outcome(response) -> (bool, Optional[float]):
+    # Only throttled responses hold requests back, accepted ones use Retry-After to pace polling
+    status = response.http_response.status_code
+    throttled = status == 429
+    retry_after = _retry_after(response.http_response.headers.get("Retry-After")) if status in (429, 503) else None
+    return throttled, retry_after
+
+
+class AzureRateLimitPolicy(HTTPPolicy):
+    """Azure pipeline policy admitting every attempt of every request through the limiter of its family."""
+
+    def send(self, request):
+        limiter = _azure_limiter(request)
+        if limiter is None:
+            return self.next.send(request)
+        limiter.acquire()
+        throttled, retry_after = False, None
+        try:
+            response = self.next.send(request)
+            throttled, retry_after = _azure_outcome(response)
+            return response
+        finally:
+            limiter.release(throttled, retry_after)
+
+
+class AsyncAzureRateLimitPolicy(AsyncHTTPPolicy):
+    """AzureRateLimitPolicy for the asynchronous clients, waiting without blocking the event loop."""
+
+    async def send(self, request):
+        limiter = _azure_limiter(request)
+        if limiter is None:
+            return await self.next.send(request)
+        await limiter.acquire_async()
+        throttled, retry_after = False, None
+        try:
+            response = await self.next.send(request)
+            throttled, retry_after = _azure_outcome(response)
+            return response
+        finally:
+            limiter.release(throttled, retry_after)
+
+
+clients.registry.add_session_hook(_limit_session)
+clients.registry.add_azure_policy(AzureRateLimitPolicy(), AsyncAzureRateLimitPolicy())
@@ -0,0 +1,67 @@
+import attrs
+from typing import Callable, Optional
+
+CREATE = "create"
+REPLACE = "replace"
+DELETE = "delete"
+__all__ = ["RouteOp", "CREATE", "REPLACE", "DELETE", "diff", "invert", "middlebox_routes"]
+
+
+@attrs.define(frozen=True)
+class RouteOp:
+    """
+    A change to one route of a route table. ``target`` is the next hop the
+    route has after the change and ``previous`` the one it had before, either
+    is None when the route does not exist on that side of the change.
+    ``region`` is the region of the table, where route tables are regional.
+    """
+    action: str
+    table: str
+    destination: str
+    target: Optional[str] = None
+    previous: Optional[str] = None
+    region: Optional[str] = None
+
+
+def diff(table: str, current: dict[str, str], desired: dict[str, str],
+         owned: Callable[[str], bool] = lambda target: False, region: Optional[str] = None) -> [RouteOp]:
+    """
+    The smallest set of operations turning the ``current`` routes of a table
+    into the ``desired`` ones, both mapping a destination to its next hop.
+    Routes that are not desired are only deleted when their next hop is
+    ``owned``, other routes of the table are left alone.
+    """
+    ops = []
+    for destination, target in desired.items():
+        previous = current.get(destination)
+        if previous is None:
+            ops.append(RouteOp(CREATE, table, destination, target, region=region))
+        elif previous != target:
+            ops.append(RouteOp(REPLACE, table, destination, target, previous, region))
+    for destination, previous in current.items():
+        if destination not in desired and owned(previous):
+            ops.append(RouteOp(DELETE, table, destination, None, previous, region))
+    return ops
+
+
+def invert(ops: [RouteOp]) -> [RouteOp]:
+    """The operations undoing ``ops``, in the order they must be applied."""
+    inverse = {CREATE: DELETE, REPLACE: REPLACE, DELETE: CREATE}
+    return [RouteOp(inverse[op.action], op.table, op.destination, op.previous, op.target, op.region)
+            for op in reversed(ops)]
+
+
+def middlebox_routes(pairs: [(str, str, str, str)], middlebox: str) -> dict[str, dict[str, str]]:
+    """
+    Routes sending the traffic of every pair of endpoints through the
+    middlebox. Each pair is given as (table, cidr) of both endpoints, and the
+    result maps every affected table to its desired routes. Traffic within
+    a subnet cannot be routed, pairs of endpoints sharing one are skipped.
+    """
+    desired = {}
+    for table, cidr, peer_table, peer_cidr in pairs:
+        if cidr == peer_cidr:
+            continue
+        desired.setdefault(table, {})[peer_cidr] = middlebox
+        desired.setdefault(peer_table, {})[cidr] = middlebox
+    return desired
@@ -1,7 +1,14 @@
 import cmd
+import sys
+import copy
+import jobs
 import logging
+import metrics
+import aws.pool
+import argparse
 import readline
 import traceback
+import transactions.context
 from aws import *
 from _api import *
 from typing import Optional
@@ -59,9 +66,141 @@ class InvisinetShell(cmd.Cmd):
     def do_annotate(self, arg):
         self.deployment.annotate(*parse(arg))
 
+    def do_stats(self, arg):
+        """
+        Show provider API calls and latency per operation.
+        stats [<operation>] | stats export <path> | stats reset
+        """
+        args = parse(arg)
+        if len(args) == 0:
+            print(f"{'operation':<20} {'provider':<8} {'count':>6} {'seconds':>9} {'calls':>7} "
+                  f"{'call s':>9} {'errors':>6} {'throttles':>9}")
+            for entry in metrics.registry.summary():
+                print(f"{entry['operation']:<20} {entry['provider']:<8} {entry['count']:>6} "
+                      f"{entry['seconds']:>9.3f} {entry['calls']:>7} {entry['call_seconds']:>9.3f} "
+                      f"{entry['errors']:>6} {entry['throttles']:>9}")
+        elif args[0] == "export":
+            metrics.registry.write_prometheus(args[1])
+            print(f"Metrics written to {args[1]}")
+        elif args[0] == "reset":
+            metrics.registry.reset()
+        else:
+            print(f"{'provider':<8} {'service':<12} {'call':<40} {'calls':>6} {'seconds':>9} {'p50':>7} {'p99':>7}")
+            for (provider, service, call), count, latency in metrics.registry.calls_by_operation(args[0]):
+                print(f"{provider:<8} {service:<12} {call:<40} {count:>6} {latency.sum:>9.3f} "
+                      f"{latency.quantile(0.5):>7g} {latency.quantile(0.99):>7g}")
+
+    def do_pools(self, arg):
+        """
+        Show warm pool hit rates, or size the pools of the current deployment.
+        pools | pools <eip size> <sip size> [<max idle seconds>]
+        """
+        args = parse(arg)
+        if len(args) == 0:
+            print(f"{'pool':<24} {'size':>5} {'ready':>6} {'hits':>6} {'misses':>7} {'hit rate':>9} "
+                  f"{'provisioned':>12} {'evicted':>8}")
+            for entry in aws.pool.maintainer.summary():
+                print(f"{entry['pool']:<24} {entry['size']:>5} {entry['ready']:>6} {entry['hits']:>6} "
+                      f"{entry['misses']:>7} {entry['hit_rate']:>9.1%} {entry['provisioned']:>12} "
+                      f"{entry['evicted']:>8}")
+        else:
+            self.deployment.configure_pools(*map(int, args[:2]), *map(float, args[2:]))
+
+    def do_source(self, arg):
+        """
+        Run the commands of a script, stopping at the first one that fails.
+        source <path>
+        """
+        self.source(parse(arg)[0])
+
+    def source(self, path: str) -> bool:
+        """
+        Run the commands of a script, one per line, skipping blank lines and
+        comments. Return whether a command asked to stop.
+        """
+        with open(path) as script:
+            for number, line in enumerate(script, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                print(f"{self.prompt}{line}")
+                try:
+                    if self.execute(line):
+                        return True
+                except Exception as e:
+                    raise RuntimeError(f"{path}:{number}: {line} failed") from e
+                self.report_jobs()
+        return False
+
+    def run_script(self, path: str) -> bool:
+        """
+        Run a script non-interactively and wait for the jobs it started.
+        Return whether the script and every job succeeded.
+        """
+        try:
+            self.source(path)
+        except Exception:
+            print(traceback.format_exc())
+            return False
+        finally:
+            jobs.manager.wait()
+            self.report_jobs()
+        return all(job.state == "done" for job in jobs.manager.jobs())
+
+    def execute(self, line: str) -> bool:
+        """
+        Run a command, raising its errors. Commands ending with & run in the
+        background, against a copy of the session: they keep the provider and
+        deployment selected when they started, and selecting another one from
+        the background leaves the session's unchanged. Background jobs run
+        outside of transactions, so they are refused while one is open.
+        """
+        line = line.strip()
+        if line.endswith("&"):
+            command = line[:-1].strip()
+            if isinstance(transactions.context.current(), transactions.context.MultiActionContext):
+                raise RuntimeError(f"Cannot run {command} in the background while a transaction or plan is open")
+            job = jobs.manager.submit(command, lambda: copy.copy(self).execute(command))
+            print(f"[{job.id}] {command}")
+            return False
+        return super().onecmd(line)
+
+    def do_jobs(self, arg):
+        """List the background jobs of the session."""
+        print(f"{'job':>4} {'state':<10} {'seconds':>9}  command")
+        for job in jobs.manager.jobs():
+            print(f"{job.id:>4} {job.state:<10} {job.seconds:>9.1f}  {job.command}")
+
+    def do_wait(self, arg):
+        """
+        Wait for background jobs to finish, all of them by default.
+        wait [<job> ...]
+        """
+        jobs.manager.wait([int(job_id) for job_id in parse(arg)])
+
+    def do_cancel(self, arg):
+        """
+        Cancel background jobs. Running jobs stop at their next provider request.
+        cancel <job> ...
+        """
+        for job_id in parse(arg):
+            job = jobs.manager.cancel(int(job_id))
+            print(f"[{job.id}] {'Cancelled' if job.state == 'cancelled' else 'Cancelling'}  {job.command}")
+
+    def report_jobs(self):
+        for job in jobs.manager.finished():
+            print(f"[{job.id}] {job.state.capitalize()}  {job.command}")
+            error = job.future.exception() if not job.future.cancelled() else None
+            if error is not None and not isinstance(error, jobs.JobCancelled):
+                print("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+    def postcmd(self, stop, line):
+        self.report_jobs()
+        return stop
+
     def onecmd(self, line):
         try:
-            return super().onecmd(line)
+            return self.execute(line)
         except Exception as e:
             print(traceback.format_exc())
             return False  # don't stop
@@ -72,5 +211,11 @@ def parse(arg):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Invisinet shell")
+    parser.add_argument("-f", dest="script", help="run the commands of a script and exit")
+    args = parser.parse_args()
     logging.basicConfig(level="INFO")
-    InvisinetShell().cmdloop()
+    if args.script is None:
+        InvisinetShell().cmdloop()
+    else:
+        sys.exit(0 if InvisinetShell().run_script(args.script) else 1)
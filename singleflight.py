@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import metrics
+import threading
+from functools import wraps
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+# Quantile of a request's latency past which a second, hedged request is sent
+HEDGE_QUANTILE = 0.95
+# Requests recorded before their latency is trusted to hedge them
+MIN_HEDGE_SAMPLES = 20
+MAX_HEDGE_WORKERS = 8
+logger = logging.getLogger(__name__)
+__all__ = ["Group", "AsyncGroup", "group", "async_group", "hedge_delay", "coalesced"]
+
+
+class Group:
+    """
+    Coalesces concurrent identical calls: while a call with a given key is in
+    flight, the callers with the same key wait for it and share its result,
+    or its exception, instead of making their own.
+
+    Calls given ``hedge_after`` run on a thread pool, and a second call is
+    made if the first one has not returned after that many seconds. The
+    first of them to succeed answers, and the other one is left to finish
+    in the background, so only idempotent reads should be hedged.
+    """
+
+    def __init__(self, max_hedge_workers: int = MAX_HEDGE_WORKERS):
+        self.max_hedge_workers = max_hedge_workers
+        self.calls = 0
+        self.shared = 0
+        self.hedged = 0
+        self._flights: dict[Hashable, Future] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, f: Callable[[], Any], hedge_after: Optional[float] = None) -> Any:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                self.calls += 1
+                flight = self._flights[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return flight.result()
+
+        try:
+            result = self._call(f, hedge_after)
+        except BaseException as err:
+            flight.set_exception(err)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    def _call(self, f: Callable[[], Any], hedge_after: Optional[float]) -> Any:
+        if hedge_after is None:
+            return f()
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_hedge_workers,
+                                                    thread_name_prefix="invisinet-hedge")
+        primary = self._executor.submit(metrics.propagate(f))
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        logger.info(f"No answer after {hedge_after:g}s, hedging")
+        self.hedged += 1
+        pending = {primary, self._executor.submit(metrics.propagate(f))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+        # Both failed
+        return primary.result()
+
+
+class AsyncGroup:
+    """
+    Group for coroutines, coalescing the calls awaited on the same event
+    loop. The slower of two hedged calls is cancelled.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self.hedged = 0
+        self._flights: dict[(asyncio.AbstractEventLoop, Hashable), asyncio.Future] = {}
+
+    async def do(self, key: Hashable, f: Callable[[], Awaitable], hedge_after: Optional[float] = None) -> Any:
+        key = (asyncio.get_running_loop(), key)
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.shared += 1
+            # A cancelled caller does not cancel the call the others wait for
+            return await asyncio.shield(flight)
+
+        self.calls += 1
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._call(f, hedge_after)
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as err:
+            flight.set_exception(err)
+            # Retrieved, so that a call nobody else waited for is not reported
+            flight.exception()
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            del self._flights[key]
+
+    async def _call(self, f: Callable[[], Awaitable], hedge_after: Optional[float]) -> Any:
+        if hedge_after is None:
+            return await f()
+
+        primary = asyncio.ensure_future(f())
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_after)
+            if done:
+                return primary.result()
+
+            logger.info(f"No answer after {hedge_after:g}s, hedging")
+            self.hedged += 1
+            pending = {primary, asyncio.ensure_future(f())}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    return succeeded[0].result()
+            # Both failed
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+group = Group()
+async_group = AsyncGroup()
+
+
+def hedge_delay(provider: str, service: str, call: str) -> Optional[float]:
+    """
+    The latency quantile past which a provider request is hedged, None
+    until enough of them were recorded.
+    """
+    histogram = metrics.registry.latency(provider, service, call)
+    if histogram.count < MIN_HEDGE_SAMPLES:
+        return None
+    delay = histogram.quantile(HEDGE_QUANTILE)
+    return delay if delay != float("inf") else None
+
+
+def coalesced(key: Callable[..., Hashable], hedge: Optional[tuple] = None):
+    """
+    Coalesce the concurrent calls of a function or coroutine that ``key``,
+    given the arguments of a call, maps to the same key. Calls are hedged
+    past the latency quantile of the ``hedge`` request, given as (provider,
+    service, call), once it is known.
+    """
+    def decorator(f):
+        name = f.__qualname__
+
+        def delay() -> Optional[float]:
+            return hedge_delay(*hedge) if hedge is not None else None
+
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def wrapper(*args, **kwargs):
+                return await async_group.do((name, key(*args, **kwargs)), lambda: f(*args, **kwargs), delay())
+        else:
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                return group.do((name, key(*args, **kwargs)), lambda: f(*args, **kwargs), delay())
+
+        return wrapper
+
+    return decorator
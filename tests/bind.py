@@ -0,0 +1,110 @@
+import unittest
+from unittest import mock
+import transactions
+import transactions.context
+from _api import EndpointIP, ServiceIP
+from transactions.actions import Action
+from aws.main import InvisinetAWS, MAX_TARGETS_PER_REQUEST
+from botocore.exceptions import ClientError
+
+
+class FakeEndpoint(EndpointIP):
+    name = subnet_id = public_ip = private_ip = None
+
+    def __init__(self, instance_id: str):
+        super().__init__()
+        self.instance_id = instance_id
+
+    @property
+    def endpoint_id(self) -> str:
+        return self.instance_id
+
+    def terminate(self):
+        pass
+
+
+class FakeService(ServiceIP):
+    name = subnet_id = endpoint_id = region = None
+    target_group_arn = ["target-group"]
+
+    def terminate(self):
+        pass
+
+
+class FakeELBClient:
+    """Target group rejecting the targets listed in ``invalid``."""
+
+    def __init__(self, invalid: frozenset = frozenset()):
+        self.invalid = invalid
+        self.targets = set()
+        self.requests = []
+
+    def _change(self, action: str, TargetGroupArn: str, Targets: [dict]):
+        ids = [target["Id"] for target in Targets]
+        self.requests.append((action, len(ids)))
+        if self.invalid.intersection(ids):
+            raise ClientError({"Error": {"Code": "InvalidTarget", "Message": "invalid"}}, action)
+        if action == "RegisterTargets":
+            self.targets.update(ids)
+        else:
+            self.targets.difference_update(ids)
+
+    def register_targets(self, **kwargs):
+        self._change("RegisterTargets", **kwargs)
+
+    def deregister_targets(self, **kwargs):
+        self._change("DeregisterTargets", **kwargs)
+
+
+@Action.register(undo_callback=lambda _: None)
+def fail():
+    raise RuntimeError("failed")
+
+
+class BindTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeELBClient(invalid=frozenset({"i-3"}))
+        patcher = mock.patch.object(InvisinetAWS, "_elb_client", self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.deployment = object.__new__(InvisinetAWS)
+        self.deployment._vpc = mock.Mock(deployment_id="test")
+        self.sip = FakeService()
+
+    def tearDown(self):
+        transactions.context.activate(transactions.context.SingleActionContext())
+
+    def test_targets_are_registered_in_batches(self):
+        self.client.invalid = frozenset()
+        eips = [FakeEndpoint(f"i-{i}") for i in range(MAX_TARGETS_PER_REQUEST + 10)]
+        result = self.deployment.bind(self.sip, eips)
+        self.assertTrue(result.ok)
+        self.assertEqual(self.client.requests, [("RegisterTargets", MAX_TARGETS_PER_REQUEST),
+                                                ("RegisterTargets", 10)])
+
+        result = self.deployment.unbind(self.sip, eips[0])
+        self.assertEqual(result.succeeded, [eips[0]])
+        self.assertNotIn("i-0", self.client.targets)
+
+    def test_failed_batches_report_every_target(self):
+        eips = [FakeEndpoint(f"i-{i}") for i in range(5)]
+        result = self.deployment.bind(self.sip, eips)
+        self.assertFalse(result.ok)
+        self.assertEqual([eip.endpoint_id for eip in result.succeeded], ["i-0", "i-1", "i-2", "i-4"])
+        self.assertEqual([(eip.endpoint_id, reason) for eip, reason in result.failed],
+                         [("i-3", "InvalidTarget: invalid")])
+        self.assertEqual(self.client.targets, {"i-0", "i-1", "i-2", "i-4"})
+
+    def test_rollback_unbinds_the_registered_targets(self):
+        self.client.targets = {"i-9"}
+        transactions.begin()
+        bind = self.deployment.bind(self.sip, [FakeEndpoint(f"i-{i}") for i in range(5)])
+        unbind = self.deployment.unbind(self.sip, FakeEndpoint("i-9"))
+        fail(depends_on=[bind, unbind])
+        self.assertIsNone(transactions.commit())
+        self.assertEqual(self.client.targets, {"i-9"})
+
+
+if __name__ == '__main__':
+    unittest.main()
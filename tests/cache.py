@@ -0,0 +1,82 @@
+import time
+import unittest
+import threading
+from cache import TTLCache, cached
+
+
+wrapper_cache = TTLCache(ttl=60)
+
+
+class Wrapper:
+    def __init__(self, resource_id):
+        self.resource_id = resource_id
+        self.loads = 0
+
+    @property
+    @cached(lambda self: self.resource_id, cache=wrapper_cache)
+    def name(self):
+        self.loads += 1
+        return f"name-{self.resource_id}"
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        wrapper = Wrapper("a")
+        self.assertEqual(wrapper.name, "name-a")
+        self.assertEqual(wrapper.name, "name-a")
+        self.assertEqual(wrapper.loads, 1)
+        self.assertEqual(wrapper_cache.stats(), {"hits": 1, "misses": 1, "evictions": 0, "coalesced": 0, "size": 1})
+
+    def test_entries_expire(self):
+        cache = TTLCache(ttl=0.05)
+        cache.put("a", "name", 1)
+        self.assertEqual(cache.get("a", "name", lambda: 2), 1)
+        time.sleep(0.06)
+        self.assertEqual(cache.get("a", "name", lambda: 2), 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = TTLCache(max_size=2)
+        cache.put("a", "name", 1)
+        cache.put("b", "name", 2)
+        cache.get("a", "name", lambda: None)
+        cache.put("c", "name", 3)
+        self.assertEqual(cache.get("b", "name", lambda: "reloaded"), "reloaded")
+        self.assertEqual(cache.stats()["evictions"], 2)
+
+    def test_invalidate_drops_every_attribute_of_a_resource(self):
+        cache = TTLCache()
+        cache.put("a", "name", 1)
+        cache.put("a", "tags", {})
+        cache.put("b", "name", 2)
+        cache.invalidate("a")
+        self.assertEqual(cache.stats()["size"], 1)
+        cache.invalidate("b", "name")
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_loads_invalidated_in_flight_are_not_cached(self):
+        cache, started, release = TTLCache(), threading.Event(), threading.Event()
+
+        def load():
+            started.set()
+            release.wait()
+            return "stale"
+
+        for invalidate in (lambda: cache.invalidate("a", "name"), lambda: cache.invalidate("a"),
+                           lambda: cache.put("a", "name", "fresh")):
+            started.clear()
+            release.clear()
+            cache.invalidate("a")
+            thread = threading.Thread(target=cache.get, args=("a", "name", load))
+            thread.start()
+            started.wait()
+            invalidate()
+            release.set()
+            thread.join()
+            self.assertNotEqual(cache.get("a", "name", lambda: "reloaded"), "stale")
+        self.assertEqual(cache.get("a", "name", lambda: "reloaded"), "fresh")
+        self.assertEqual(cache._generations, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import threading
+import clients
+from unittest import mock
+from clients import ClientRegistry
+
+
+class ClientRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ClientRegistry()
+        self.registry.configure(region_name="us-east-1")
+
+    def test_clients_are_created_once_per_thread(self):
+        client = self.registry.client("ec2")
+        self.assertIs(self.registry.client("ec2"), client)
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.registry.client("ec2")))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], client)
+
+    def test_configure_recreates_clients(self):
+        client = self.registry.client("ec2")
+        self.registry.configure(max_pool_connections=4, retry_mode="adaptive")
+        recreated = self.registry.client("ec2")
+        self.assertIsNot(recreated, client)
+        self.assertEqual(recreated.meta.config.max_pool_connections, 4)
+        self.assertEqual(recreated.meta.config.retries["mode"], "adaptive")
+
+    def test_session_hooks_see_new_sessions(self):
+        sessions = []
+        self.registry.add_session_hook(sessions.append)
+        self.assertIs(self.registry.session(), sessions[0])
+
+    def test_clients_are_created_per_region(self):
+        client = self.registry.client("ec2")
+        with clients.region("eu-west-1"):
+            regional = self.registry.client("ec2")
+            self.assertIs(self.registry.client("ec2"), regional)
+            with clients.region(None):
+                self.assertIs(self.registry.client("ec2"), regional)
+        self.assertIs(self.registry.client("ec2"), client)
+        self.assertEqual(client.meta.region_name, "us-east-1")
+        self.assertEqual(regional.meta.region_name, "eu-west-1")
+
+        self.registry.configure(regions=["us-east-1", "eu-west-1"])
+        self.assertEqual(self.registry.enabled_regions(), ["us-east-1", "eu-west-1"])
+
+    def test_regional_methods_run_in_their_region(self):
+        class Wrapper:
+            region = "ap-southeast-2"
+
+            @clients.regional
+            def current(self):
+                return clients.current_region()
+
+        with mock.patch.object(clients, "registry", self.registry):
+            self.assertEqual(Wrapper().current(), "ap-southeast-2")
+            self.assertEqual(clients.current_region(), "us-east-1")
+
+    def test_concurrent_calls_reuse_the_executor_threads(self):
+        self.registry.configure(max_workers=4)
+        with mock.patch.object(clients, "registry", self.registry):
+            sessions = set()
+            for _ in range(3):
+                sessions.update(map(id, clients.map_concurrently(lambda _: self.registry.session(), range(8), 4)))
+            # The executor's threads and the calling thread
+            self.assertLessEqual(len(sessions), 5)
+
+            # Calls nested in every thread of the executor still make progress
+            nested = clients.map_concurrently(
+                lambda i: sum(clients.map_concurrently(lambda j: i * j, range(3), 4)), range(8), 8)
+            self.assertEqual(nested, [3 * i for i in range(8)])
+
+            with clients.region("eu-west-1"):
+                self.assertEqual(clients.map_concurrently(lambda _: clients.current_region(), range(2), 2),
+                                 ["eu-west-1"] * 2)
+            with self.assertRaises(ZeroDivisionError):
+                clients.map_concurrently(lambda i: 1 / i, range(4), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
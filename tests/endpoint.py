@@ -0,0 +1,74 @@
+import os
+import asyncio
+import unittest
+from unittest import mock
+import clients
+import metrics
+import aws.aio
+import aws.tags
+import aws.main
+import transactions
+import transactions.context
+
+
+class EndpointTest(unittest.TestCase):
+
+    def test_bulk_requests_are_rolled_back_together(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        registry.add_session_hook(metrics._instrument_session)
+        with moto.mock_ec2(), mock.patch.object(clients, "registry", registry), \
+                mock.patch.object(aws.main.InvisinetAWS, "_images", {}), \
+                mock.patch.object(aws.main.InvisinetAWS, "_key_pairs", {}):
+            image_id = registry.client("ec2").describe_images()["Images"][0]["ImageId"]
+            with mock.patch.object(aws.main.InvisinetAWS, "image_id", image_id):
+                deployment = aws.main.InvisinetAWS()
+                transactions.begin()
+                self.addCleanup(transactions.context.activate, transactions.context.SingleActionContext())
+                eips = deployment.request_eip("web", count=3)
+                deployment.request_sip("front", depends_on=[eips])
+                vpc_id = deployment._vpc.vpc_id
+
+                metrics.registry.reset()
+                # No load balancer can be created outside of moto's elbv2 mock
+                self.assertIsNone(transactions.commit())
+                calls = {call[1:]: count for call, count in metrics.registry.calls.items()}
+                self.assertEqual(calls[("aws", "ec2", "TerminateInstances")], 1)
+                self.assertEqual(calls[("aws", "ec2", "DeleteSubnet")], 3)
+
+                ec2 = registry.client("ec2")
+                states = [instance["State"]["Name"] for reservation in ec2.describe_instances()["Reservations"]
+                          for instance in reservation["Instances"]]
+                self.assertEqual(states, ["terminated"] * 3)
+                subnets = ec2.describe_subnets(Filters=[{"Name": "vpc-id", "Values": [vpc_id]},
+                                                        {"Name": "tag:Name", "Values": ["invisinet-eip-subnet-*"]}])
+                self.assertEqual(subnets["Subnets"], [])
+
+    def test_async_requests_tag_the_deployment(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        with moto.mock_ec2(), mock.patch.object(clients, "registry", registry), \
+                mock.patch.object(aws.main.InvisinetAWS, "_images", {}), \
+                mock.patch.object(aws.main.InvisinetAWS, "_key_pairs", {}):
+            image_id = registry.client("ec2").describe_images()["Images"][0]["ImageId"]
+            with mock.patch.object(aws.main.InvisinetAWS, "image_id", image_id):
+                async def request_eip():
+                    deployment = await aws.aio.AsyncInvisinetAWS.create()
+                    try:
+                        return deployment.deployment_id, await deployment.request_eip("web")
+                    finally:
+                        await deployment.close()
+
+                deployment_id, eip = asyncio.run(request_eip())
+                tags = aws.tags.describe([eip.endpoint_id], refresh=True)[eip.endpoint_id]
+                self.assertEqual(tags["DeploymentID"], deployment_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+from unittest import mock
+import clients
+import aws.tags
+import aws.inventory
+
+ACCOUNT = "arn:aws:ec2:us-east-1:123456789012"
+LB_ARN = "arn:aws:elasticloadbalancing:us-east-1:123456789012:loadbalancer/net/lb/0123"
+
+
+def mapping(arn: str, **tags) -> dict:
+    return {"ResourceARN": arn, "Tags": [{"Key": key, "Value": value}
+                                         for key, value in {"InvisinetsDeployment": "true", **tags}.items()]}
+
+
+class FakeTaggingClient:
+
+    def __init__(self, pages: [list]):
+        self.pages = pages
+        self.requests = []
+
+    def get_paginator(self, name: str):
+        def paginate(**kwargs):
+            self.requests.append(kwargs)
+            return [{"ResourceTagMappingList": page} for page in self.pages]
+        return mock.Mock(paginate=paginate)
+
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        aws.tags.index.clear()
+
+    def test_sweep_groups_resources_by_deployment(self):
+        client = FakeTaggingClient([
+            [
+                mapping(f"{ACCOUNT}:vpc/vpc-a", DeploymentID="AbCde", Name="invisinet-vpc-abcde"),
+                mapping(f"{ACCOUNT}:subnet/subnet-a", DeploymentID="abcde", AssociatedRouteTableID="rtb-a"),
+                mapping(f"{ACCOUNT}:route-table/rtb-a", DeploymentID="abcde"),
+            ],
+            [
+                mapping(f"{ACCOUNT}:instance/i-a", DeploymentID="abcde"),
+                mapping(LB_ARN, DeploymentID="fghij"),
+                mapping(f"{ACCOUNT}:vpc/vpc-f", DeploymentID="fghij"),
+                # Created before resources were tagged with their deployment
+                mapping(f"{ACCOUNT}:subnet/subnet-old"),
+            ],
+        ])
+        with mock.patch.object(clients.registry, "client", lambda service: client):
+            deployments = aws.inventory.sweep()
+
+        self.assertEqual(set(deployments), {"abcde", "fghij", None})
+        abcde = deployments["abcde"]
+        self.assertEqual((abcde.vpc_id, abcde.subnets, abcde.route_tables, abcde.instances),
+                         ("vpc-a", ["subnet-a"], ["rtb-a"], ["i-a"]))
+        self.assertEqual(deployments["fghij"].load_balancers, [LB_ARN])
+        self.assertEqual(deployments[None].subnets, ["subnet-old"])
+        self.assertEqual(len(client.requests), 1)
+        self.assertIs(aws.inventory.cached(clients.current_region()), deployments)
+
+        # The tag index now answers lookups by tag
+        self.assertEqual(aws.tags.index.find("AssociatedRouteTableID", "rtb-a", prefix="subnet-"), ["subnet-a"])
+        with mock.patch.object(clients.registry, "client", lambda service: client):
+            self.assertEqual(aws.inventory.sweep("ABCDE").keys(), deployments.keys())
+        self.assertIn({"Key": "DeploymentID", "Values": ["abcde"]}, client.requests[-1]["TagFilters"])
+
+
+if __name__ == '__main__':
+    unittest.main()
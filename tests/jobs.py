@@ -0,0 +1,119 @@
+import io
+import os
+import tempfile
+import unittest
+import threading
+import jobs
+import shell
+import transactions
+import transactions.context
+from unittest import mock
+from contextlib import redirect_stdout
+from jobs import JobCancelled, JobManager
+from transactions.actions import ResourceAction
+
+
+@ResourceAction.register()
+def request_eip(name: str) -> str:
+    return name
+
+
+class JobManagerTest(unittest.TestCase):
+
+    def test_jobs_run_in_the_background(self):
+        manager, release = JobManager(max_workers=2), threading.Event()
+        job = manager.submit("request_eip", lambda: release.wait() and "eip")
+        self.assertEqual(job.state, "running" if job.started is not None else "pending")
+        release.set()
+        self.assertEqual(manager.wait(), [job])
+        self.assertEqual((job.state, job.future.result()), ("done", "eip"))
+        self.assertEqual(manager.finished(), [job])
+        self.assertEqual(manager.finished(), [])
+
+        failed = manager.submit("bind", lambda: 1 / 0)
+        manager.wait([failed.id])
+        self.assertEqual(failed.state, "failed")
+        with self.assertRaises(ValueError):
+            manager.get(3)
+
+    def test_cancelled_jobs_stop_at_their_next_request(self):
+        manager, started, release, requests = JobManager(max_workers=1), threading.Event(), threading.Event(), []
+
+        def provision():
+            started.set()
+            release.wait()
+            jobs.checkpoint()
+            requests.append("RunInstances")
+
+        def rollback():
+            try:
+                provision()
+            finally:
+                # Clean-up requests of a cancelled job go through
+                jobs.checkpoint()
+                requests.append("TerminateInstances")
+
+        running = manager.submit("request_eip", rollback)
+        pending = manager.submit("request_sip", provision)
+        started.wait()
+        manager.cancel(running.id)
+        manager.cancel(pending.id)
+        release.set()
+        manager.wait()
+        self.assertIsInstance(running.future.exception(), JobCancelled)
+        self.assertEqual((running.state, pending.state), ("cancelled", "cancelled"))
+        self.assertEqual(requests, ["TerminateInstances"])
+        # Outside of jobs, checkpoints never raise
+        jobs.checkpoint()
+
+    def test_jobs_record_their_own_transactions(self):
+        manager = JobManager()
+        transactions.begin()
+        self.addCleanup(transactions.context.activate, transactions.context.SingleActionContext())
+        queued = request_eip("queued")
+        job = manager.submit("request_eip background", lambda: request_eip("background"))
+        self.assertEqual(job.future.result(), "background")
+        self.assertEqual(len(transactions.commit()), 1)
+        self.assertEqual(queued.result(), "queued")
+
+
+class ShellTest(unittest.TestCase):
+
+    def script(self, *lines) -> str:
+        with tempfile.NamedTemporaryFile("w", suffix=".inv", delete=False) as script:
+            script.write("\n".join(lines))
+        self.addCleanup(os.remove, script.name)
+        return script.name
+
+    def test_scripts_run_commands_and_wait_for_their_jobs(self):
+        session, output = shell.InvisinetShell(), io.StringIO()
+        calls = []
+        with mock.patch.object(jobs, "manager", JobManager()), \
+                mock.patch.object(shell.InvisinetShell, "do_request_eip", lambda self, arg: calls.append(arg)), \
+                redirect_stdout(output):
+            path = self.script("# Two endpoints", "", "request_eip web-0 &", "request_eip web-1 &", "jobs")
+            self.assertTrue(session.run_script(path))
+            self.assertEqual(sorted(calls), ["web-0", "web-1"])
+            self.assertEqual([job.state for job in jobs.manager.jobs()], ["done", "done"])
+
+            # The session has no deployment to bind with
+            path = self.script("bind a b", "request_eip web-2")
+            self.assertFalse(session.run_script(path))
+            self.assertNotIn("web-2", calls)
+        self.assertIn("[1] Done  request_eip web-0", output.getvalue())
+        self.assertIn(f"{path}:1: bind a b failed", output.getvalue())
+
+    def test_background_commands_are_refused_in_a_transaction(self):
+        session = shell.InvisinetShell()
+        with mock.patch.object(jobs, "manager", JobManager()):
+            transactions.begin()
+            try:
+                with self.assertRaisesRegex(RuntimeError, "transaction or plan is open"):
+                    session.execute("request_eip web-0 &")
+            finally:
+                transactions.context.activate(transactions.context.SingleActionContext())
+            self.assertEqual(jobs.manager.jobs(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
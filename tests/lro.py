@@ -0,0 +1,81 @@
+import os
+import time
+import unittest
+import threading
+from unittest import mock
+from azure.core.polling import LROPoller, NoPolling
+
+os.environ.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+import clients
+from azu.lro import LROGroup, LROGroupError
+
+
+def begin_create(name: str, delay: float = 0.0, fail: bool = False) -> LROPoller:
+    time.sleep(delay)
+    if fail:
+        raise RuntimeError(f"{name} failed")
+    return LROPoller(None, name, lambda response: f"{response}-created", NoPolling())
+
+
+class LROGroupTest(unittest.TestCase):
+
+    def test_operations_run_concurrently(self):
+        start = time.monotonic()
+        with LROGroup() as group:
+            futures = [group.submit(begin_create, f"route-{i}", delay=0.2) for i in range(4)]
+            plain = group.submit(lambda: "loaded")
+        self.assertLess(time.monotonic() - start, 0.6)
+        self.assertEqual([future.result() for future in futures], [f"route-{i}-created" for i in range(4)])
+        self.assertEqual(plain.result(), "loaded")
+
+    def test_failures_are_aggregated_and_pending_work_cancelled(self):
+        started = threading.Event()
+        group = LROGroup(max_workers=2)
+        group.submit(begin_create, "nic", fail=True)
+        group.submit(begin_create, "subnet", fail=True)
+        group.submit(started.set)
+
+        with self.assertRaises(LROGroupError) as raised:
+            group.wait()
+        group.close()
+        self.assertEqual(sorted(str(error) for _, error in raised.exception.errors),
+                         ["nic failed", "subnet failed"])
+        self.assertEqual(len(raised.exception.cancelled) + started.is_set(), 1)
+
+    def test_wait_returns_results_in_submission_order(self):
+        with LROGroup() as group:
+            group.submit(begin_create, "slow", delay=0.1)
+            group.submit(begin_create, "fast")
+            self.assertEqual(group.wait(), ["slow-created", "fast-created"])
+
+    def test_timeouts_are_reported(self):
+        group = LROGroup()
+        group.submit(time.sleep, 0.5)
+        with self.assertRaises(LROGroupError) as raised:
+            group.wait(timeout=0.05)
+        group.close()
+        self.assertIsInstance(raised.exception.errors[0][1], TimeoutError)
+
+    def test_nested_groups_share_the_registry_executor(self):
+        registry = clients.ClientRegistry()
+        registry.configure(max_workers=1)
+        threads = set()
+
+        def inner(i: int) -> [str]:
+            with LROGroup() as group:
+                for j in range(2):
+                    group.submit(lambda name: threads.add(threading.current_thread().name) or name, f"{i}-{j}")
+            return group.wait()
+
+        with mock.patch.object(clients, "registry", registry):
+            with LROGroup() as group:
+                for i in range(3):
+                    group.submit(inner, i)
+        self.assertEqual(group.wait(), [[f"{i}-0", f"{i}-1"] for i in range(3)])
+        self.assertTrue(all(name == threading.current_thread().name or name.startswith("invisinet-worker")
+                            for name in threads))
+        registry.executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import asyncio
+import unittest
+import metrics
+import clients
+from concurrent.futures import ThreadPoolExecutor
+
+
+@metrics.instrument("test")
+def provision(executor: ThreadPoolExecutor):
+    metrics.registry.record_call("test", "ec2", "CreateSubnet", 0.02)
+    executor.submit(metrics.propagate(metrics.registry.record_call), "test", "ec2", "RunInstances", 0.3).result()
+
+
+@metrics.instrument("test")
+async def bind():
+    metrics.registry.record_call("test", "elbv2", "RegisterTargets", 0.01, error=True, throttled=True)
+
+
+@metrics.instrument("test")
+def list_pages(pages: int):
+    for page in range(pages):
+        metrics.registry.record_call("test", "ec2", "DescribeInstances", 0.01)
+        yield page
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+
+    def test_calls_are_attributed_across_threads(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            provision(executor)
+        metrics.registry.record_call("test", "ec2", "DescribeVpcs", 0.01)
+
+        calls = {call[1:]: count for call, count, _ in metrics.registry.calls_by_operation("provision")}
+        self.assertEqual(calls, {("ec2", "CreateSubnet"): 1, ("ec2", "RunInstances"): 1})
+        self.assertEqual(metrics.registry.calls[("none", "test", "ec2", "DescribeVpcs")], 1)
+        self.assertEqual(metrics.registry.operations[("provision", "test")].count, 1)
+
+    def test_coroutines_and_nested_operations(self):
+        asyncio.run(bind())
+        with metrics.operation("outer", "test"):
+            provision(ThreadPoolExecutor(max_workers=1))
+
+        summary = {entry["operation"]: entry for entry in metrics.registry.summary()}
+        self.assertEqual(summary["bind"]["errors"], 1)
+        self.assertEqual(summary["bind"]["throttles"], 1)
+        self.assertEqual(summary["outer"]["calls"], 2)
+        self.assertNotIn("provision", summary)
+
+    def test_generators_are_attributed_while_producing_items(self):
+        for _ in list_pages(3):
+            metrics.registry.record_call("test", "ec2", "DescribeVpcs", 0.01)
+        self.assertEqual(metrics.registry.calls[("list_pages", "test", "ec2", "DescribeInstances")], 3)
+        self.assertEqual(metrics.registry.calls[("none", "test", "ec2", "DescribeVpcs")], 3)
+        self.assertEqual(metrics.registry.operations[("list_pages", "test")].count, 1)
+
+        # Abandoned generators are closed and still recorded once
+        next(list_pages(3))
+        self.assertEqual(metrics.registry.operations[("list_pages", "test")].count, 2)
+
+    def test_prometheus_export(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            provision(executor)
+        text = metrics.registry.export()
+        self.assertIn('invisinet_api_calls_total{operation="provision",provider="test",service="ec2",'
+                      'call="RunInstances"} 1', text)
+        self.assertIn('invisinet_api_call_duration_seconds_bucket{operation="provision",provider="test",'
+                      'service="ec2",call="RunInstances",le="0.5"} 1', text)
+        self.assertIn('invisinet_operation_duration_seconds_count{operation="provision",provider="test"} 1', text)
+
+    def test_botocore_calls_are_recorded(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        registry.add_session_hook(metrics._instrument_session)
+        with moto.mock_ec2(), metrics.operation("list_deployments", "aws"):
+            registry.client("ec2").describe_vpcs()
+        self.assertEqual(metrics.registry.calls[("list_deployments", "aws", "ec2", "DescribeVpcs")], 1)
+
+    def test_azure_calls_are_named_after_resource_types(self):
+        url = ("https://management.azure.com/subscriptions/s/resourceGroups/g/providers/Microsoft.Network/"
+               "virtualNetworks/v/subnets/a?api-version=2020-06-01")
+        self.assertEqual(metrics._azure_call("PUT", url), ("Microsoft.Network", "PUT subnets"))
+
+
+if __name__ == '__main__':
+    unittest.main()
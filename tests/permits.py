@@ -0,0 +1,202 @@
+import os
+import unittest
+from unittest import mock
+import permits
+from permits import Permit, INBOUND, OUTBOUND
+
+os.environ.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+from aws.main import InvisinetAWS
+from azu.resource import AzureResourceMixin
+from azure_utils import create_security_rule
+
+
+class CompileTest(unittest.TestCase):
+
+    def test_overlapping_and_adjacent_ranges_are_merged(self):
+        compiled = permits.compile([
+            Permit(INBOUND, "TCP", "10.0.0.0/25", 80, 80),
+            Permit(INBOUND, "tcp", "10.0.0.128/25", 80, 80),
+            Permit(INBOUND, "tcp", "10.0.0.0/24", 81, 90),
+            Permit(INBOUND, "tcp", "10.0.0.0/24", 85, 443),
+            # Within the /24 and its ports
+            Permit(INBOUND, "tcp", "10.0.0.7", 100, 200),
+            Permit(INBOUND, "udp", "10.0.0.7/32", 53, 53),
+            Permit(OUTBOUND, "icmp", "0.0.0.0/0", 8, 8),
+        ])
+        self.assertEqual(compiled, [
+            Permit(INBOUND, "tcp", "10.0.0.0/24", 80, 443),
+            Permit(INBOUND, "udp", "10.0.0.7/32", 53, 53),
+            Permit(OUTBOUND, "icmp", "0.0.0.0/0"),
+        ])
+
+    def test_blocks_with_different_ports_are_kept(self):
+        compiled = permits.compile([
+            Permit(INBOUND, "tcp", "10.0.0.0/24", 80, 80),
+            Permit(INBOUND, "tcp", "10.0.0.0/28", 22, 22),
+            Permit(INBOUND, "tcp", "10.0.1.0/24", 22, 22),
+        ])
+        self.assertEqual(compiled, [
+            Permit(INBOUND, "tcp", "10.0.0.0/24", 80, 80),
+            Permit(INBOUND, "tcp", "10.0.0.0/28", 22, 22),
+            Permit(INBOUND, "tcp", "10.0.1.0/24", 22, 22),
+        ])
+        with self.assertRaises(ValueError):
+            Permit(INBOUND, "tcp", "10.0.0.0/24", 90, 80)
+
+    def test_icmp_types_are_kept_apart(self):
+        compiled = permits.compile([
+            Permit(INBOUND, "icmp", "10.0.0.0/24", icmp_type=8, icmp_code=0),
+            Permit(INBOUND, "icmp", "10.0.0.0/16", icmp_type=8),
+            Permit(INBOUND, "icmp", "10.0.0.0/24", icmp_type=3, icmp_code=4),
+            Permit(OUTBOUND, "icmp", "10.0.0.0/24", icmp_type=3),
+            Permit(OUTBOUND, "icmp", "0.0.0.0/0"),
+        ])
+        self.assertEqual(compiled, [
+            Permit(INBOUND, "icmp", "10.0.0.0/16", icmp_type=8),
+            Permit(INBOUND, "icmp", "10.0.0.0/24", icmp_type=3, icmp_code=4),
+            Permit(OUTBOUND, "icmp", "0.0.0.0/0"),
+        ])
+        with self.assertRaises(ValueError):
+            Permit(INBOUND, "icmp", "10.0.0.0/24", icmp_code=4)
+
+
+class FakeEC2Client:
+
+    def __init__(self, rules: [dict]):
+        self.rules = rules
+        self.calls = []
+
+    def get_paginator(self, name: str):
+        return mock.Mock(paginate=lambda **kwargs: [{"SecurityGroupRules": self.rules}])
+
+    def __getattr__(self, name: str):
+        return lambda **kwargs: self.calls.append((name, kwargs))
+
+
+class AWSPermitListTest(unittest.TestCase):
+
+    def test_only_differing_rules_are_changed(self):
+        client = FakeEC2Client([
+            {"SecurityGroupRuleId": "sgr-keep", "IsEgress": False, "IpProtocol": "tcp",
+             "FromPort": 22, "ToPort": 22, "CidrIpv4": "10.0.0.0/24"},
+            {"SecurityGroupRuleId": "sgr-old", "IsEgress": False, "IpProtocol": "tcp",
+             "FromPort": 8080, "ToPort": 8080, "CidrIpv4": "10.0.0.0/24"},
+            {"SecurityGroupRuleId": "sgr-stale", "IsEgress": False, "IpProtocol": "udp",
+             "FromPort": 53, "ToPort": 53, "CidrIpv4": "10.0.0.0/24"},
+            {"SecurityGroupRuleId": "sgr-group", "IsEgress": False, "IpProtocol": "-1",
+             "ReferencedGroupInfo": {"GroupId": "sg-1"}},
+            {"SecurityGroupRuleId": "sgr-egress", "IsEgress": True, "IpProtocol": "-1", "CidrIpv4": "0.0.0.0/0"},
+        ])
+        deployment = object.__new__(InvisinetAWS)
+        with mock.patch.object(InvisinetAWS, "_ec2_client", client):
+            added, removed = deployment.set_permit_list("sg-1", [
+                Permit(INBOUND, "tcp", "10.0.0.0/24", 22, 22),
+                Permit(INBOUND, "tcp", "10.0.0.0/25", 443, 443),
+                Permit(INBOUND, "tcp", "10.0.0.128/25", 443, 443),
+            ], directions={INBOUND})
+
+        self.assertEqual(added, [Permit(INBOUND, "tcp", "10.0.0.0/24", 443, 443)])
+        self.assertEqual(len(removed), 2)
+        self.assertEqual(client.calls, [
+            ("revoke_security_group_ingress", {"GroupId": "sg-1", "SecurityGroupRuleIds": ["sgr-stale"]}),
+            ("modify_security_group_rules", {"GroupId": "sg-1", "SecurityGroupRules": [{
+                "SecurityGroupRuleId": "sgr-old",
+                "SecurityGroupRule": {"IpProtocol": "tcp", "CidrIpv4": "10.0.0.0/24", "FromPort": 443, "ToPort": 443},
+            }]}),
+        ])
+
+    def test_icmp_types_are_kept(self):
+        client = FakeEC2Client([
+            {"SecurityGroupRuleId": "sgr-ping", "IsEgress": False, "IpProtocol": "icmp",
+             "FromPort": 8, "ToPort": -1, "CidrIpv4": "10.0.0.0/24"},
+        ])
+        deployment = object.__new__(InvisinetAWS)
+        with mock.patch.object(InvisinetAWS, "_ec2_client", client):
+            ping = Permit(INBOUND, "icmp", "10.0.0.0/24", icmp_type=8)
+            self.assertEqual(deployment.set_permit_list("sg-1", [ping]), ([], []))
+            deployment.set_permit_list("sg-1", [Permit(INBOUND, "icmp", "10.0.0.0/24", icmp_type=0)])
+        self.assertEqual(client.calls, [
+            ("modify_security_group_rules", {"GroupId": "sg-1", "SecurityGroupRules": [{
+                "SecurityGroupRuleId": "sgr-ping",
+                "SecurityGroupRule": {"IpProtocol": "icmp", "CidrIpv4": "10.0.0.0/24", "FromPort": 0, "ToPort": -1},
+            }]}),
+        ])
+
+    def test_empty_list_revokes_every_rule(self):
+        client = FakeEC2Client([
+            {"SecurityGroupRuleId": "sgr-ssh", "IsEgress": False, "IpProtocol": "tcp",
+             "FromPort": 22, "ToPort": 22, "CidrIpv4": "10.0.0.0/24"},
+            {"SecurityGroupRuleId": "sgr-group", "IsEgress": False, "IpProtocol": "-1",
+             "ReferencedGroupInfo": {"GroupId": "sg-1"}},
+            {"SecurityGroupRuleId": "sgr-egress", "IsEgress": True, "IpProtocol": "-1", "CidrIpv4": "0.0.0.0/0"},
+        ])
+        deployment = object.__new__(InvisinetAWS)
+        with mock.patch.object(InvisinetAWS, "_ec2_client", client):
+            added, removed = deployment.set_permit_list("sg-1", [])
+
+        self.assertEqual((added, len(removed)), ([], 2))
+        self.assertEqual(sorted(client.calls), [
+            ("revoke_security_group_egress", {"GroupId": "sg-1", "SecurityGroupRuleIds": ["sgr-egress"]}),
+            ("revoke_security_group_ingress", {"GroupId": "sg-1", "SecurityGroupRuleIds": ["sgr-ssh"]}),
+        ])
+
+
+class AzurePermitListTest(unittest.TestCase):
+
+    def test_permits_share_rules_and_unrelated_rules_are_kept(self):
+        manual = create_security_rule("ssh", "Inbound", "Tcp", dest_ports=["22"], source_addresses=["1.2.3.4"])
+        manual.priority = 150
+        permit_list = [
+            Permit(INBOUND, "tcp", "10.0.0.0/24", 80, 80),
+            Permit(INBOUND, "tcp", "10.0.2.0/24", 80, 80),
+            Permit(INBOUND, "udp", "10.0.2.0/24", 53, 54),
+        ]
+        rules = AzureResourceMixin.permit_security_rules([manual], permit_list)
+        self.assertEqual([(rule.name, rule.priority) for rule in rules], [
+            ("ssh", 150),
+            ("invisinet-permit-Inbound-Tcp-80", 151),
+            ("invisinet-permit-Inbound-Udp-53-54", 152),
+        ])
+        self.assertEqual(rules[1].source_address_prefixes, ["10.0.0.0/24", "10.0.2.0/24"])
+
+        self.assertIsNone(AzureResourceMixin.permit_security_rules(rules, permit_list))
+        rules = AzureResourceMixin.permit_security_rules(rules, permit_list[:2])
+        self.assertEqual([rule.name for rule in rules], ["ssh", "invisinet-permit-Inbound-Tcp-80"])
+
+    def test_priorities_of_replaced_rules_are_reused(self):
+        deny = create_security_rule("DENY_ALL-inbound", "Inbound", "*")
+        deny.priority = 4096
+        rules = AzureResourceMixin.permit_security_rules([deny], [Permit(INBOUND, "tcp", "10.0.0.0/24", 80, 80)])
+        self.assertEqual([(rule.name, rule.priority) for rule in rules], [
+            ("DENY_ALL-inbound", 4096),
+            ("invisinet-permit-Inbound-Tcp-80", 100),
+        ])
+
+        for port in range(81, 100):
+            rules = AzureResourceMixin.permit_security_rules(rules, [Permit(INBOUND, "tcp", "10.0.0.0/24", port, port)])
+        self.assertEqual([rule.priority for rule in rules], [4096, 100])
+
+        manual = create_security_rule("ssh", "Inbound", "Tcp", dest_ports=["22"], source_addresses=["1.2.3.4"])
+        manual.priority = 4095
+        rules = AzureResourceMixin.permit_security_rules([deny, manual], [
+            Permit(INBOUND, "tcp", "10.0.0.0/24", 80, 80),
+            Permit(INBOUND, "udp", "10.0.0.0/24", 53, 53),
+        ])
+        self.assertEqual([rule.priority for rule in rules], [4096, 4095, 100, 101])
+        with self.assertRaises(ValueError):
+            AzureResourceMixin.permit_security_rules([], [Permit(INBOUND, "icmp", "10.0.0.0/24", icmp_type=8)])
+
+    def test_empty_list_drops_every_permit_rule(self):
+        manual = create_security_rule("ssh", "Inbound", "Tcp", dest_ports=["22"], source_addresses=["1.2.3.4"])
+        manual.priority = 150
+        rules = AzureResourceMixin.permit_security_rules([manual], [
+            Permit(INBOUND, "tcp", "10.0.0.0/24", 80, 80),
+            Permit(OUTBOUND, "udp", "10.0.0.0/24", 53, 53),
+        ])
+        self.assertEqual(len(rules), 3)
+        rules = AzureResourceMixin.permit_security_rules(rules, [])
+        self.assertEqual([rule.name for rule in rules], ["ssh"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import time
+import unittest
+import threading
+import clients
+import metrics
+import aws.pool
+import aws.main
+from unittest import mock
+from aws.pool import WarmPool, PoolMaintainer
+
+
+class FakeProvider:
+
+    def __init__(self):
+        self.created = 0
+        self.destroyed = []
+        self.lock = threading.Lock()
+
+    def provision(self, count: int) -> [str]:
+        with self.lock:
+            resources = [f"resource-{self.created + i}" for i in range(count)]
+            self.created += count
+        return resources
+
+    def destroy(self, resource: str):
+        self.destroyed.append(resource)
+
+
+class WarmPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = FakeProvider()
+        self.pool = WarmPool("test/eip", self.provider.provision, self.provider.destroy, size=3)
+
+    def test_resources_are_handed_out_oldest_first_and_refilled(self):
+        self.pool.maintain()
+        self.assertEqual(len(self.pool), 3)
+        self.assertEqual(self.pool.acquire_many(2), ["resource-0", "resource-1"])
+        self.assertEqual(self.pool.acquire_many(2), ["resource-2"])
+        self.assertIsNone(self.pool.acquire())
+
+        self.pool.maintain()
+        self.assertEqual(self.pool.acquire(), "resource-3")
+        self.assertEqual((self.pool.stats.hits, self.pool.stats.misses), (4, 2))
+        self.assertAlmostEqual(self.pool.stats.hit_rate, 4 / 6)
+
+    def test_idle_and_surplus_resources_are_evicted(self):
+        self.pool.maintain()
+        self.pool.max_idle = 0.05
+        time.sleep(0.1)
+        self.pool.maintain()
+        self.assertEqual(self.provider.destroyed, ["resource-0", "resource-1", "resource-2"])
+        self.assertEqual(self.pool.acquire(), "resource-3")
+
+        self.pool.max_idle = 60
+        self.pool.size = 1
+        self.pool.maintain()
+        self.assertEqual(self.provider.destroyed[-1], "resource-5")
+        self.assertEqual(self.pool.stats.evicted, 4)
+
+        self.pool.drain()
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.provider.destroyed[-1], "resource-4")
+
+    def test_maintainer_refills_in_the_background(self):
+        maintainer = PoolMaintainer(interval=0.05)
+        maintainer.register(self.pool)
+        deadline = time.monotonic() + 5
+        while len(self.pool) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.pool), 3)
+        self.assertEqual(maintainer.summary()[0]["ready"], 3)
+        maintainer.unregister(self.pool)
+
+    def test_prepare_runs_before_resources_are_handed_out(self):
+        prepared = []
+        self.pool.prepare = prepared.extend
+        self.pool.maintain()
+        self.assertEqual(self.pool.acquire_many(2), prepared)
+
+        self.pool.prepare = lambda resources: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            self.pool.acquire()
+        self.assertEqual(self.provider.destroyed, ["resource-2"])
+
+    def test_pooled_instances_are_not_active(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        registry.add_session_hook(metrics._instrument_session)
+        with moto.mock_ec2(), mock.patch.object(clients, "registry", registry), \
+                mock.patch.object(aws.pool, "maintainer", PoolMaintainer()), \
+                mock.patch.object(aws.main.InvisinetAWS, "_images", {}), \
+                mock.patch.object(aws.main.InvisinetAWS, "_key_pairs", {}):
+            image_id = registry.client("ec2").describe_images()["Images"][0]["ImageId"]
+            with mock.patch.object(aws.main.InvisinetAWS, "image_id", image_id):
+                deployment = aws.main.InvisinetAWS()
+                deployment.configure_pools(eip_size=2)
+                pool = deployment._pool("eip")
+
+                def refilled():
+                    deadline = time.monotonic() + 30
+                    while pool.stats.provisioned < pool.stats.hits + 2 and time.monotonic() < deadline:
+                        time.sleep(0.05)
+                    self.assertEqual(len(pool), 2)
+
+                refilled()
+                self.assertEqual(list(deployment.active_eip()), [])
+
+                eip = deployment.request_eip("web")
+                self.assertFalse(eip.pooled)
+                refilled()
+                self.assertEqual([instance.endpoint_id for instance in deployment.active_eip()],
+                                 [eip.endpoint_id])
+                deployment.drain_pools()
+
+
+if __name__ == '__main__':
+    unittest.main()
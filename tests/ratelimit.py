@@ -0,0 +1,128 @@
+import os
+import time
+import asyncio
+import unittest
+import clients
+import ratelimit
+from types import SimpleNamespace
+from unittest import mock
+from ratelimit import Limiter, RateLimiterRegistry
+
+SUBSCRIPTION = "/subscriptions/00000000/resourceGroups/invisinet"
+
+
+class FakePolicy:
+
+    def __init__(self, status_code: int, headers: dict = None):
+        self.response = SimpleNamespace(http_response=SimpleNamespace(status_code=status_code, headers=headers or {}))
+
+    def send(self, request):
+        return self.response
+
+
+class AsyncFakePolicy(FakePolicy):
+
+    async def send(self, request):
+        return self.response
+
+
+def azure_request(path: str):
+    return SimpleNamespace(http_request=SimpleNamespace(url=f"https://management.azure.com{SUBSCRIPTION}{path}"))
+
+
+class LimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = RateLimiterRegistry()
+        patcher = mock.patch.object(ratelimit, "registry", self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_beyond_the_burst_are_paced(self):
+        limiter = Limiter(rate=50.0, burst=2)
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.acquire()
+            limiter.release()
+        # The last two requests wait for a token each
+        self.assertGreaterEqual(time.monotonic() - start, 0.03)
+
+    def test_concurrency_decreases_on_throttles_and_recovers(self):
+        limiter = Limiter(rate=1000.0, burst=100, max_concurrency=8)
+        for _ in range(3):
+            limiter.acquire()
+        limiter.release(throttled=True)
+        # Throttles answered for requests already in flight do not decrease again
+        limiter.release(throttled=True)
+        self.assertEqual((limiter.concurrency, limiter.throttles, limiter.in_flight), (4.0, 2, 1))
+
+        limiter.release()
+        for _ in range(8):
+            limiter.acquire()
+            limiter.release()
+        self.assertGreater(limiter.concurrency, 5.0)
+        self.assertLessEqual(limiter.concurrency, 8.0)
+
+    def test_retry_after_holds_requests_back(self):
+        limiter = Limiter(rate=1000.0, burst=100)
+        limiter.acquire()
+        limiter.release(retry_after=0.1)
+        start = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(ratelimit._retry_after("2"), 2.0)
+        self.assertIsNone(ratelimit._retry_after("soon"))
+
+    def test_boto3_requests_go_through_the_limiters(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        registry.add_session_hook(ratelimit._limit_session)
+        with moto.mock_ec2(), moto.mock_sts():
+            ec2 = registry.client("ec2")
+            ec2.create_vpc(CidrBlock="10.0.0.0/16")
+            ec2.describe_vpcs()
+            registry.client("sts").get_caller_identity()
+
+        limiters = self.registry.limiters()
+        self.assertEqual(set(limiters), {("ec2-mutate", "us-east-1"), ("ec2-describe", "us-east-1")})
+        self.assertTrue(all(limiter.in_flight == 0 for limiter in limiters.values()))
+
+        limiter = self.registry.limiter("ec2-mutate", "us-east-1")
+        context = {"invisinet_limiter": limiter}
+        limiter.acquire()
+        ratelimit._response_received(context, {"headers": {"Retry-After": "0"}},
+                                     {"Error": {"Code": "RequestLimitExceeded"}})
+        self.assertEqual((limiter.throttles, limiter.in_flight, context), (1, 0, {}))
+
+    def test_azure_requests_go_through_the_limiters(self):
+        policy = ratelimit.AzureRateLimitPolicy()
+        policy.next = FakePolicy(429, {"Retry-After": "0"})
+        policy.send(azure_request("/providers/Microsoft.Network/virtualNetworks/vnet"))
+        policy.next = FakePolicy(200)
+        policy.send(azure_request("/providers/Microsoft.Resources/deployments/d"))
+
+        async_policy = ratelimit.AsyncAzureRateLimitPolicy()
+        async_policy.next = AsyncFakePolicy(202, {"Retry-After": "10"})
+        asyncio.run(async_policy.send(azure_request("/providers/Microsoft.Compute/virtualMachines/vm")))
+
+        network, compute = self.registry.limiter("arm-network"), self.registry.limiter("arm-compute")
+        self.assertEqual(set(self.registry.limiters()), {("arm-network", None), ("arm-compute", None)})
+        self.assertEqual((network.throttles, network.in_flight), (1, 0))
+        # Accepted requests are not held back by the polling interval
+        self.assertEqual((compute.throttles, compute.in_flight, compute._blocked_until), (0, 0, 0.0))
+
+    def test_configure_replaces_limiters(self):
+        limiter = self.registry.limiter("elbv2", "us-east-1")
+        self.registry.configure("elbv2", rate=2.0)
+        replaced = self.registry.limiter("elbv2", "us-east-1")
+        self.assertIsNot(replaced, limiter)
+        self.assertEqual((replaced.rate, replaced.burst), (2.0, limiter.burst))
+        with self.assertRaises(ValueError):
+            self.registry.configure("s3", rate=2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import unittest
+from unittest import mock
+import clients
+import metrics
+import permits
+import aws.tags
+import aws.main
+import aws.reconcile
+from aws.reconcile import AnnotationSpec, DeploymentSpec, EndpointSpec, ServiceSpec
+
+
+class ReconcileTest(unittest.TestCase):
+
+    def test_spec_is_validated(self):
+        spec = DeploymentSpec(endpoints=[EndpointSpec("a"), EndpointSpec("b", region="eu-west-1")],
+                              services=[ServiceSpec("front", targets=["b"])])
+        with self.assertRaisesRegex(ValueError, "different regions"):
+            spec.validate("us-east-1")
+        spec.services[0].targets = ["c"]
+        with self.assertRaisesRegex(ValueError, "unknown endpoint"):
+            spec.validate("us-east-1")
+        spec = DeploymentSpec(endpoints=[EndpointSpec("a")], annotations=[AnnotationSpec("a", "a", "mb")])
+        with self.assertRaisesRegex(ValueError, "unknown endpoint mb"):
+            spec.validate("us-east-1")
+
+    def test_digests_follow_the_spec(self):
+        ssh = permits.Permit(permits.INBOUND, "tcp", "0.0.0.0/0", 22, 22)
+        self.assertEqual(EndpointSpec("a", permit_list=[ssh, ssh]).digest(), EndpointSpec("b", permit_list=[ssh]).digest())
+        self.assertNotEqual(EndpointSpec("a").digest(), EndpointSpec("a", permit_list=[]).digest())
+        self.assertEqual(ServiceSpec("s", targets=["a", "b"]).digest(), ServiceSpec("s", targets=["b", "a"]).digest())
+
+    def test_only_the_delta_is_applied(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        registry.add_session_hook(metrics._instrument_session)
+        with moto.mock_ec2(), moto.mock_elbv2(), mock.patch.object(clients, "registry", registry), \
+                mock.patch.object(aws.main.InvisinetAWS, "_images", {}), \
+                mock.patch.object(aws.main.InvisinetAWS, "_key_pairs", {}):
+            image_id = registry.client("ec2").describe_images()["Images"][0]["ImageId"]
+            with mock.patch.object(aws.main.InvisinetAWS, "image_id", image_id):
+                deployment = aws.main.InvisinetAWS()
+                spec = DeploymentSpec(
+                    endpoints=[EndpointSpec(f"web-{i}", tags={"team": "x"}) for i in range(4)] + [EndpointSpec("mb")],
+                    services=[ServiceSpec("front", targets=["web-0", "web-1"])],
+                    annotations=[AnnotationSpec("web-2", "web-3", "mb")],
+                )
+                changes = aws.reconcile.reconcile(deployment, spec)
+                self.assertEqual(len(changes.created), 6)
+                self.assertTrue(changes.annotated)
+
+                metrics.registry.reset()
+                self.assertFalse(aws.reconcile.reconcile(deployment, spec))
+                # Listing the instances, the load balancers and their tags
+                self.assertEqual(sum(metrics.registry.calls.values()), 4)
+
+                spec.services[0].targets = ["web-0", "web-2"]
+                spec.endpoints[3].tags = {"team": "y"}
+                spec.endpoints.pop(1)
+                spec.prune = True
+                changes = aws.reconcile.reconcile(deployment, spec)
+                self.assertEqual((changes.updated, changes.deleted), (["web-3", "front"], ["web-1"]))
+
+                sip = next(iter(deployment.active_sip()))
+                self.assertEqual(sorted(aws.tags.index.get(target)["Name"] for target in sip.targets()),
+                                 ["web-0", "web-2"])
+                self.assertEqual(sorted(endpoint.name for endpoint in deployment.active_eip()),
+                                 ["mb", "web-0", "web-2", "web-3"])
+                self.assertFalse(aws.reconcile.reconcile(deployment, spec))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+from unittest import mock
+import clients
+import routes
+from routes import RouteOp, CREATE, REPLACE, DELETE
+from aws.main import InvisinetAWS
+
+
+class RoutesTest(unittest.TestCase):
+
+    def test_diff_is_minimal(self):
+        current = {"10.0.1.0/28": "i-mb", "10.0.2.0/28": "i-old", "10.0.3.0/28": "i-mb", "0.0.0.0/0": "igw-1"}
+        desired = {"10.0.1.0/28": "i-mb", "10.0.2.0/28": "i-mb", "10.0.4.0/28": "i-mb"}
+        self.assertEqual(routes.diff("rtb-1", current, desired), [
+            RouteOp(REPLACE, "rtb-1", "10.0.2.0/28", "i-mb", "i-old"),
+            RouteOp(CREATE, "rtb-1", "10.0.4.0/28", "i-mb"),
+        ])
+        # Only routes through owned next hops are deleted
+        pruned = routes.diff("rtb-1", current, desired, owned=lambda target: target == "i-mb")
+        self.assertEqual(pruned[-1], RouteOp(DELETE, "rtb-1", "10.0.3.0/28", None, "i-mb"))
+        self.assertEqual(len(pruned), 3)
+        self.assertEqual(routes.diff("rtb-1", desired, desired), [])
+
+    def test_invert_undoes_in_reverse_order(self):
+        ops = [
+            RouteOp(CREATE, "rtb-1", "10.0.1.0/28", "i-mb"),
+            RouteOp(REPLACE, "rtb-1", "10.0.2.0/28", "i-mb", "i-old"),
+            RouteOp(DELETE, "rtb-2", "10.0.3.0/28", None, "i-mb"),
+        ]
+        self.assertEqual(routes.invert(ops), [
+            RouteOp(CREATE, "rtb-2", "10.0.3.0/28", "i-mb"),
+            RouteOp(REPLACE, "rtb-1", "10.0.2.0/28", "i-old", "i-mb"),
+            RouteOp(DELETE, "rtb-1", "10.0.1.0/28", None, "i-mb"),
+        ])
+
+    def test_middlebox_routes_cover_both_directions(self):
+        desired = routes.middlebox_routes([
+            ("rtb-a", "10.0.1.0/28", "rtb-b", "10.0.2.0/28"),
+            ("rtb-a", "10.0.1.0/28", "rtb-c", "10.0.3.0/28"),
+            ("rtb-a", "10.0.1.0/28", "rtb-a", "10.0.1.0/28"),
+        ], "i-mb")
+        self.assertEqual(desired, {
+            "rtb-a": {"10.0.2.0/28": "i-mb", "10.0.3.0/28": "i-mb"},
+            "rtb-b": {"10.0.1.0/28": "i-mb"},
+            "rtb-c": {"10.0.1.0/28": "i-mb"},
+        })
+
+    def test_changes_are_undone_in_the_region_of_their_table(self):
+        ops = routes.diff("rtb-1", {"10.0.2.0/28": "i-old"}, {"10.0.1.0/28": "i-mb", "10.0.2.0/28": "i-mb"},
+                          region="eu-west-1")
+        inverse = routes.invert(ops)
+        self.assertEqual({op.region for op in inverse}, {"eu-west-1"})
+
+        calls = []
+        client = mock.Mock()
+        client.delete_route.side_effect = lambda **kwargs: calls.append(("delete", clients.current_region()))
+        client.replace_route.side_effect = lambda **kwargs: calls.append(("replace", clients.current_region()))
+        with mock.patch.object(InvisinetAWS, "_ec2_client", client):
+            InvisinetAWS._apply_route_ops(inverse)
+        self.assertEqual(calls, [("replace", "eu-west-1"), ("delete", "eu-west-1")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import time
+import asyncio
+import unittest
+import threading
+import clients
+import metrics
+import singleflight
+from unittest import mock
+from cache import TTLCache
+from singleflight import AsyncGroup, Group
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SingleflightTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+
+    def wait_for_followers(self, group, followers: int):
+        while group.shared < followers:
+            time.sleep(0.001)
+
+    def test_concurrent_calls_share_one_call(self):
+        group, release, calls = Group(), threading.Event(), []
+
+        def describe():
+            calls.append(1)
+            release.wait()
+            return {"Vpcs": []}
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = [executor.submit(group.do, "vpc", describe) for _ in range(4)]
+            self.wait_for_followers(group, 3)
+            release.set()
+            self.assertTrue(all(result.result() == {"Vpcs": []} for result in results))
+        self.assertEqual((len(calls), group.calls, group.shared), (1, 1, 3))
+
+        # Calls that are not concurrent are not coalesced
+        group.do("vpc", describe)
+        self.assertEqual(len(calls), 2)
+
+    def test_errors_are_shared(self):
+        group, release = Group(), threading.Event()
+
+        def describe():
+            release.wait()
+            raise ValueError("throttled")
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = [executor.submit(group.do, "vpc", describe) for _ in range(2)]
+            self.wait_for_followers(group, 1)
+            release.set()
+            for result in results:
+                self.assertRaises(ValueError, result.result)
+
+    def test_slow_calls_are_hedged(self):
+        group, calls = Group(), []
+
+        def describe():
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return "primary"
+            return "hedge"
+
+        start = time.monotonic()
+        self.assertEqual(group.do("vpc", describe, hedge_after=0.05), "hedge")
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(group.hedged, 1)
+        self.assertEqual(group.do("vpc", lambda: "fast", hedge_after=0.05), "fast")
+        self.assertEqual(group.hedged, 1)
+
+    def test_coroutines_are_coalesced_and_hedged(self):
+        group, calls, cancelled = AsyncGroup(), [], []
+
+        async def get_nic():
+            calls.append(1)
+            try:
+                await asyncio.sleep(0.5 if len(calls) == 1 else 0.01)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+            return len(calls)
+
+        async def main():
+            return await asyncio.gather(*[group.do("nic", get_nic, hedge_after=0.05) for _ in range(3)])
+
+        self.assertEqual(asyncio.run(main()), [2, 2, 2])
+        self.assertEqual((group.calls, group.shared, group.hedged, len(cancelled)), (1, 2, 1, 1))
+
+    def test_hedge_delay_follows_recorded_latency(self):
+        self.assertIsNone(singleflight.hedge_delay("aws", "ec2", "DescribeVpcs"))
+        for _ in range(singleflight.MIN_HEDGE_SAMPLES - 1):
+            metrics.registry.record_call("aws", "ec2", "DescribeVpcs", 0.02)
+        metrics.registry.record_call("aws", "ec2", "DescribeVpcs", 0.2)
+        self.assertEqual(singleflight.hedge_delay("aws", "ec2", "DescribeVpcs"), 0.025)
+
+    def test_concurrent_cache_misses_load_once(self):
+        cache, release, loads = TTLCache(), threading.Event(), []
+
+        def load():
+            loads.append(1)
+            release.wait()
+            return "tg-arn"
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = [executor.submit(cache.get, "lb", "target_group_arn", load) for _ in range(3)]
+            self.wait_for_followers(cache._loads, 2)
+            release.set()
+            self.assertEqual([result.result() for result in results], ["tg-arn"] * 3)
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(cache.stats()["coalesced"], 2)
+
+    def test_hedged_vpc_loads_are_bound_to_the_calling_thread(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        import aws.vpc
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        with moto.mock_ec2(), mock.patch.object(clients, "registry", registry), \
+                mock.patch.object(singleflight, "hedge_delay", lambda *call: 0.0):
+            vpc_id = aws.vpc.VPC.create("fghij").vpc_id
+            vpc = aws.vpc.VPC.load("fghij")
+            self.assertEqual(vpc.vpc_id, vpc_id)
+            self.assertIs(vpc.vpc.meta.client, registry.resource("ec2").meta.client)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import unittest
+from unittest import mock
+import clients
+import aws.subnet
+from aws.vpc import VPC
+from aws.subnet import Subnet
+from botocore.exceptions import ClientError
+
+
+class FlakyClient:
+    """The calling thread's EC2 client, failing the given call after it succeeded ``after`` times."""
+
+    def __init__(self, call: str, after: int):
+        self.call = call
+        self.after = after
+
+    def __getattr__(self, name: str):
+        method = getattr(clients.registry.client("ec2"), name)
+        if name != self.call:
+            return method
+
+        def call(**kwargs):
+            if self.after == 0:
+                raise ClientError({"Error": {"Code": "RequestLimitExceeded", "Message": "slow down"}}, name)
+            self.after -= 1
+            return method(**kwargs)
+
+        return call
+
+
+class SubnetTest(unittest.TestCase):
+
+    def test_failed_creations_leave_nothing_behind(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        with moto.mock_ec2(), mock.patch.object(clients, "registry", registry), \
+                mock.patch.object(aws.subnet, "MAX_CONCURRENT_REQUESTS", 1):
+            vpc = VPC.create("klmno")
+            ec2 = registry.client("ec2")
+            filters = [{"Name": "vpc-id", "Values": [vpc.vpc_id]}]
+            route_tables = len(ec2.describe_route_tables(Filters=filters)["RouteTables"])
+            free = vpc.allocator.free_addresses
+
+            for call in ("create_route_table", "create_subnet", "associate_route_table"):
+                with mock.patch.object(Subnet, "_client", FlakyClient(call, after=1)):
+                    with self.assertRaises(ClientError):
+                        Subnet.create_many(["a", "b", "c"], vpc)
+                created = ec2.describe_subnets(Filters=filters)["Subnets"]
+                self.assertEqual(len(created), 1)
+                route_tables += 1
+                self.assertEqual(len(ec2.describe_route_tables(Filters=filters)["RouteTables"]), route_tables)
+                self.assertEqual(vpc.allocator.free_addresses, free - 16)
+                Subnet.load(created[0]["SubnetId"]).deallocate()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import unittest
+from unittest import mock
+import clients
+import aws.tags
+from aws.tags import TagChanges
+
+LB_ARN = "arn:aws:elasticloadbalancing:us-east-1:123456789012:loadbalancer/net/lb-{}/0123"
+
+
+class FakeClient:
+
+    def __init__(self, tags: dict[str, dict[str, str]]):
+        self.tags = tags
+        self.calls = []
+
+    def get_paginator(self, name: str):
+        def paginate(Filters):
+            self.calls.append(("paginate", Filters[0]["Values"]))
+            return [{"Tags": [{"ResourceId": resource_id, "Key": key, "Value": value}
+                              for resource_id in Filters[0]["Values"]
+                              for key, value in self.tags.get(resource_id, {}).items()]}]
+        return mock.Mock(paginate=paginate)
+
+    def describe_tags(self, ResourceArns):
+        self.calls.append(("describe_tags", ResourceArns))
+        return {"TagDescriptions": [{"ResourceArn": arn, "Tags": [{"Key": key, "Value": value}
+                                                                   for key, value in self.tags[arn].items()]}
+                                    for arn in ResourceArns]}
+
+    def __getattr__(self, name: str):
+        return lambda **kwargs: self.calls.append((name, kwargs.get("Resources", kwargs.get("ResourceArns"))))
+
+
+class TagsTest(unittest.TestCase):
+
+    def setUp(self):
+        aws.tags.index.clear()
+
+    def test_plan_only_changes_differing_tags(self):
+        current = {
+            "i-1": {"Name": "a", "team": "x", "stale": "1"},
+            "i-2": {"Name": "b", "team": "y"},
+        }
+        desired = {"i-1": {"team": "x"}, "i-2": {"team": "x", "env": "prod"}}
+        self.assertEqual(aws.tags.plan(current, desired), TagChanges(
+            added={"i-2": {"team": "x", "env": "prod"}},
+            removed={"i-1": ["stale"]},
+        ))
+        self.assertEqual(aws.tags.plan(current, desired, replace=False).removed, {})
+        self.assertFalse(aws.tags.plan(current, {"i-1": current["i-1"]}))
+
+    def test_reconcile_batches_resources_and_updates_index(self):
+        instances = [f"i-{i}" for i in range(1500)]
+        arns = [LB_ARN.format(i) for i in range(30)]
+        client = FakeClient({**{instance: {"Name": instance, "old": "1"} for instance in instances},
+                             **{arn: {"Name": arn} for arn in arns}})
+        with mock.patch.object(clients.registry, "client", lambda service: client):
+            changes = aws.tags.reconcile({resource: {"team": "x"} for resource in instances + arns})
+
+        self.assertEqual(len(changes.added), 1530)
+        self.assertEqual(len(changes.removed), 1500)
+        self.assertEqual([(name, len(resources)) for name, resources in client.calls],
+                         [("paginate", 200)] * 7 + [("paginate", 100), ("describe_tags", 20), ("describe_tags", 10),
+                          ("create_tags", 1000), ("create_tags", 500), ("add_tags", 20), ("add_tags", 10),
+                          ("delete_tags", 1000), ("delete_tags", 500)])
+        self.assertEqual(aws.tags.index.get("i-3"), {"Name": "i-3", "team": "x"})
+        self.assertEqual(aws.tags.index.find("Name", "i-3", prefix="i-"), ["i-3"])
+        self.assertEqual(len(aws.tags.index.find("team", "x", prefix="arn:")), 30)
+
+        # Everything is known locally now, so nothing is described or changed again
+        client.calls.clear()
+        with mock.patch.object(clients.registry, "client", lambda service: client):
+            self.assertFalse(aws.tags.reconcile({resource: {"team": "x"} for resource in instances + arns}))
+        self.assertEqual(client.calls, [])
+
+    def test_reconcile_against_moto(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        with moto.mock_ec2(), mock.patch.object(clients, "registry", registry):
+            ec2 = registry.client("ec2")
+            vpc_ids = [ec2.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"] for _ in range(3)]
+            ec2.create_tags(Resources=vpc_ids, Tags=[{"Key": "stale", "Value": "1"}])
+            aws.tags.reconcile({vpc_id: {"DeploymentID": vpc_id[-5:]} for vpc_id in vpc_ids})
+
+            described = ec2.describe_tags(Filters=[{"Name": "resource-id", "Values": vpc_ids}])["Tags"]
+            self.assertEqual(sorted((tag["ResourceId"], tag["Key"]) for tag in described),
+                             [(vpc_id, "DeploymentID") for vpc_id in sorted(vpc_ids)])
+            self.assertEqual(aws.tags.index.find("DeploymentID", vpc_ids[1][-5:], prefix="vpc-"), [vpc_ids[1]])
+
+    def test_vpcs_of_other_regions_stay_indexed(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        import moto
+        import aws.vpc
+        registry = clients.ClientRegistry()
+        registry.configure(region_name="us-east-1")
+        with moto.mock_ec2(), mock.patch.object(clients, "registry", registry):
+            primary = aws.vpc.VPC.create("abcde")
+            with clients.region("eu-west-1"):
+                self.assertIsNone(aws.vpc.VPC.load("abcde"))
+                secondary = aws.vpc.VPC.create("abcde")
+                self.assertEqual(aws.vpc.VPC.load("abcde").vpc_id, secondary.vpc_id)
+            self.assertEqual(aws.tags.index.find("DeploymentID", "abcde", prefix="vpc-", region="us-east-1"),
+                             [primary.vpc_id])
+            self.assertEqual(aws.vpc.VPC.load("abcde").vpc_id, primary.vpc_id)
+
+            aws.tags.index.remove(primary.vpc_id, "eu-west-1")
+            self.assertIn(primary.vpc_id, aws.tags.index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,356 @@
+import os
+import sys
+import json
+import time
+import uuid
+import tempfile
+import logging
+import unittest
+import threading
+import subprocess
+import clients
+import transactions
+import metrics
+import transactions.plan
+import transactions.context
+import transactions.journal
+from unittest import mock
+from transactions.actions import Action, ResourceAction
+
+
+class FakeResource:
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+
+    def terminate(self):
+        self.log.append(("terminate", self.name))
+
+
+class FakeDeployment:
+    def __init__(self, delay=0.0, fail_on=None):
+        self.delay = delay
+        self.fail_on = fail_on
+        self.log = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def _enter(self, name):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        if name == self.fail_on:
+            raise RuntimeError(f"{name} failed")
+
+    @ResourceAction.register()
+    def request_eip(self, name):
+        transactions.journal.record("fake", "resource", name)
+        self._enter(name)
+        self.log.append(("create", name))
+        return FakeResource(name, self.log)
+
+    @Action.register(undo_callback=lambda result: result[2].append(("unbind",) + result[:2]))
+    def bind(self, sip, eip):
+        self._enter(f"bind-{sip.name}-{eip.name}")
+        self.log.append(("bind", sip.name, eip.name))
+        return sip.name, eip.name, self.log
+
+
+class MultiActionContextTest(unittest.TestCase):
+
+    def tearDown(self):
+        transactions.context.activate(transactions.context.SingleActionContext())
+
+    def test_single_action_context_runs_inplace(self):
+        deployment = FakeDeployment()
+        eip = deployment.request_eip("eip")
+        self.assertIsInstance(eip, FakeResource)
+
+    def test_independent_actions_run_concurrently(self):
+        deployment = FakeDeployment(delay=0.2)
+        transactions.begin(max_workers=4)
+        handles = [deployment.request_eip(f"eip-{i}") for i in range(4)]
+
+        start = time.monotonic()
+        results = transactions.commit()
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(deployment.max_running, 4)
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual([h.result().name for h in handles], [f"eip-{i}" for i in range(4)])
+
+    def test_handles_resolve_into_dependent_actions(self):
+        deployment = FakeDeployment(delay=0.05)
+        transactions.begin()
+        sip = deployment.request_eip("sip")
+        eips = [deployment.request_eip(f"eip-{i}") for i in range(3)]
+        binds = [deployment.bind(sip, eip) for eip in eips]
+
+        self.assertIsNotNone(transactions.commit())
+        for handle, eip in zip(binds, eips):
+            self.assertEqual(handle.result()[:2], ("sip", eip.result().name))
+        bind_positions = [i for i, entry in enumerate(deployment.log) if entry[0] == "bind"]
+        create_positions = [i for i, entry in enumerate(deployment.log) if entry[0] == "create"]
+        self.assertLess(max(create_positions), min(bind_positions))
+
+    def test_failure_rolls_back_in_reverse_topological_order(self):
+        deployment = FakeDeployment(fail_on="eip-fail")
+        transactions.begin()
+        sip = deployment.request_eip("sip")
+        eip = deployment.request_eip("eip")
+        bind = deployment.bind(sip, eip)
+        deployment.request_eip("eip-fail", depends_on=[bind])
+
+        self.assertIsNone(transactions.commit())
+        log = deployment.log
+        self.assertIn(("unbind", "sip", "eip"), log)
+        unbind = log.index(("unbind", "sip", "eip"))
+        self.assertLess(unbind, log.index(("terminate", "sip")))
+        self.assertLess(unbind, log.index(("terminate", "eip")))
+
+    def test_foreign_handle_is_rejected(self):
+        deployment = FakeDeployment()
+        transactions.begin()
+        sip = deployment.request_eip("sip")
+        transactions.begin()
+        with self.assertRaises(ValueError):
+            deployment.bind(sip, sip)
+
+    def test_other_threads_are_not_captured(self):
+        deployment = FakeDeployment()
+        transactions.begin()
+        queued = deployment.request_eip("queued")
+
+        created = []
+        thread = threading.Thread(target=lambda: created.append(deployment.request_eip("concurrent")))
+        thread.start()
+        thread.join()
+        self.assertIsInstance(created[0], FakeResource)
+
+        self.assertEqual(len(transactions.commit()), 1)
+        self.assertEqual(queued.result().name, "queued")
+
+    def test_nested_transaction_resumes_the_outer_one(self):
+        deployment = FakeDeployment()
+        transactions.begin()
+        outer = transactions.context.current()
+        queued = deployment.request_eip("outer")
+        transactions.begin()
+        deployment.request_eip("inner")
+
+        self.assertEqual(len(transactions.commit()), 1)
+        self.assertIs(transactions.context.current(), outer)
+        self.assertEqual(len(transactions.commit()), 1)
+        self.assertEqual(queued.result().name, "outer")
+        self.assertIsInstance(transactions.context.current(), transactions.context.SingleActionContext)
+
+    def test_nested_commits_do_not_wait_for_the_executor(self):
+        deployment = FakeDeployment(delay=0.05)
+
+        @Action.register(undo_callback=lambda result: None)
+        def provision(prefix):
+            transactions.begin()
+            handles = [deployment.request_eip(f"{prefix}-{i}") for i in range(2)]
+            transactions.commit()
+            return [handle.result().name for handle in handles]
+
+        registry = clients.ClientRegistry()
+        registry.configure(max_workers=1)
+        self.addCleanup(registry.executor.shutdown)
+        with mock.patch.object(clients, "registry", registry):
+            transactions.begin()
+            handles = [provision(prefix) for prefix in ("a", "b", "c")]
+            self.assertEqual(len(transactions.commit()), 3)
+        self.assertEqual([handle.result() for handle in handles],
+                         [[f"{prefix}-0", f"{prefix}-1"] for prefix in ("a", "b", "c")])
+
+
+class DryRunDeployment(FakeDeployment):
+    dryrun = True
+
+    def __init__(self):
+        super().__init__()
+        self.plan = transactions.plan.Plan()
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        planner = transactions.plan.planner
+        planner.register(FakeDeployment.request_eip, "fake", lambda deployment, name: transactions.plan.Estimate(
+            calls={("fake", "ec2", "RunInstances"): 1}, quota={("region", "instances"): 1}, idle=10.0))
+        planner.register(FakeDeployment.bind, "fake", lambda deployment, sip, eip: transactions.plan.Estimate(
+            calls={("fake", "elbv2", "RegisterTargets"): 1}))
+
+    def tearDown(self):
+        metrics.registry.reset()
+        for f in (FakeDeployment.request_eip, FakeDeployment.bind):
+            transactions.plan.planner.models.pop(f.__qualname__, None)
+        transactions.context.activate(transactions.context.SingleActionContext())
+
+    def test_dry_run_is_estimated_offline_and_applied_later(self):
+        deployment = DryRunDeployment()
+        sip = deployment.request_eip("sip")
+        eip = deployment.request_eip("eip")
+        bind = deployment.bind(sip, eip)
+        self.assertEqual(deployment.log, [])
+
+        with metrics.operation("bind", "fake"):
+            metrics.registry.record_call("fake", "elbv2", "RegisterTargets", 2.0)
+        estimate = deployment.plan.estimate(usage={("region", "instances"): 3}, limits={"instances": 4})
+        self.assertEqual([step.name for step in estimate.steps],
+                         ["FakeDeployment.request_eip"] * 2 + ["FakeDeployment.bind"])
+        # Both instances are created at once, then targets are registered at the recorded latency
+        self.assertEqual([step.start for step in estimate.steps], [0.0, 0.0, 10.25])
+        self.assertAlmostEqual(estimate.seconds, 12.25)
+        self.assertEqual(estimate.calls, {("fake", "ec2", "RunInstances"): 2, ("fake", "elbv2", "RegisterTargets"): 1})
+        self.assertEqual(estimate.quotas, [transactions.plan.QuotaImpact("region", "instances", 3, 2, 4)])
+        self.assertTrue(estimate.quotas[0].exceeded)
+
+        self.assertIsNotNone(deployment.plan.apply())
+        self.assertEqual(bind.result()[:2], ("sip", "eip"))
+        self.assertEqual([entry[0] for entry in deployment.log], ["create", "create", "bind"])
+
+    def test_transaction_is_turned_into_a_plan(self):
+        deployment = FakeDeployment()
+        transactions.begin()
+        eip = deployment.request_eip("eip")
+        plan = transactions.plan.end()
+        self.assertIsInstance(transactions.context.current(), transactions.context.SingleActionContext)
+        self.assertEqual(len(plan.estimate().steps), 1)
+        self.assertEqual(deployment.log, [])
+
+        plan.apply()
+        self.assertEqual(eip.result().name, "eip")
+        with self.assertRaises(RuntimeError):
+            transactions.plan.end()
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "journal.jsonl")
+        self.destroyed = []
+        self.journals = []
+        transactions.journal.register_destroyer("fake", "resource", self.destroyed.append)
+
+    def tearDown(self):
+        transactions.context.activate(transactions.context.SingleActionContext())
+        for journal in self.journals:
+            journal.close()
+        self.directory.cleanup()
+
+    def open_journal(self, **kwargs) -> transactions.journal.Journal:
+        journal = transactions.journal.Journal(self.path, fsync=False, **kwargs)
+        self.journals.append(journal)
+        return journal
+
+    def test_committed_transactions_are_closed(self):
+        journal = self.open_journal()
+        deployment = FakeDeployment()
+        transactions.begin(journal=journal)
+        deployment.bind(deployment.request_eip("sip"), deployment.request_eip("eip"))
+        self.assertIsNotNone(transactions.commit())
+
+        with open(self.path) as f:
+            types = [json.loads(line)["type"] for line in f]
+        self.assertEqual(types.count("resource"), 2)
+        self.assertEqual(types[-1], "end")
+        self.assertEqual(self.open_journal().open_transactions(), [])
+
+    def test_rollback_deletes_resources_of_failed_actions(self):
+        journal = self.open_journal()
+        deployment = FakeDeployment(fail_on="eip-fail")
+        transactions.begin(journal=journal)
+        eip = deployment.request_eip("eip")
+        deployment.request_eip("eip-fail", depends_on=[eip])
+
+        self.assertIsNone(transactions.commit())
+        self.assertIn(("terminate", "eip"), deployment.log)
+        self.assertEqual(self.destroyed, ["eip-fail"])
+        self.assertEqual(journal.open_transactions(), [])
+
+    def test_interrupted_transactions_are_recovered(self):
+        journal = self.open_journal()
+        txn, action_id = uuid.uuid4(), uuid.uuid4()
+        journal.begin(txn, {action_id: "request_eip"})
+        journal.intent(txn, action_id, "request_eip")
+        for name in ["subnet", "instance"]:
+            journal.resource(txn, action_id, "fake", "resource", name)
+        # The transaction is still run by this process until its journal is closed
+        self.assertEqual(self.open_journal().recover(), [])
+        journal.close()
+
+        restarted = self.open_journal()
+        self.assertEqual(restarted.open_transactions(), [str(txn)])
+        self.assertEqual(restarted.recover(), [str(txn)])
+        self.assertEqual(self.destroyed, ["instance", "subnet"])
+        self.assertEqual(self.open_journal().open_transactions(), [])
+
+    def test_transactions_of_live_processes_are_not_recovered(self):
+        process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        txn, action_id = uuid.uuid4(), uuid.uuid4()
+        owner = transactions.journal._owner(process.pid)
+        with open(self.path, "w") as f:
+            for entry in [{"type": "intent", "txn": str(txn), "action": str(action_id), "name": "request_eip",
+                           "owner": owner},
+                          {"type": "resource", "txn": str(txn), "action": str(action_id),
+                           "provider": "fake", "kind": "resource", "id": "instance"}]:
+                f.write(json.dumps(entry) + "\n")
+
+        self.assertEqual(self.open_journal().recover(), [])
+        self.assertEqual(transactions.journal.recover(self.path), [])
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"type": "intent", "txn": str(txn), "action": str(action_id),
+                                "name": "request_eip", "owner": {**owner, "host": "elsewhere"}}) + "\n")
+        self.assertEqual(self.open_journal().recover(), [])
+        self.assertEqual(self.destroyed, [])
+
+        process.kill()
+        process.wait()
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"type": "intent", "txn": str(txn), "action": str(action_id),
+                                "name": "request_eip", "owner": owner}) + "\n")
+        self.assertEqual(self.open_journal().recover(), [str(txn)])
+        self.assertEqual(self.destroyed, ["instance"])
+
+    def test_compaction_keeps_the_records_of_other_processes(self):
+        first, second = self.open_journal(), self.open_journal(compact_every=1)
+        running, finished, action_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        first.intent(running, action_id, "request_eip")
+        second.begin(finished, {})
+        second.end(finished, "committed")
+        first.resource(running, action_id, "fake", "resource", "instance")
+
+        with open(self.path) as f:
+            self.assertEqual([json.loads(line)["type"] for line in f], ["intent", "resource"])
+        self.assertEqual(second.open_transactions(), [str(running)])
+        first.close()
+        self.assertEqual(transactions.journal.recover(self.path), [str(running)])
+        self.assertEqual(self.destroyed, ["instance"])
+
+    def test_compaction_drops_finished_transactions(self):
+        journal = self.open_journal(compact_every=2)
+        deployment = FakeDeployment()
+        for _ in range(2):
+            transactions.begin(journal=journal)
+            deployment.request_eip("eip")
+            transactions.commit()
+        journal.begin(uuid.uuid4(), {})
+
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="INFO")
+    unittest.main()
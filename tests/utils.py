@@ -0,0 +1,67 @@
+import random
+import netaddr
+import unittest
+from utils import CidrAllocator, next_available_cidr
+
+
+class CidrAllocatorTest(unittest.TestCase):
+
+    def test_allocates_lowest_block_first(self):
+        allocator = CidrAllocator(["10.10.0.0/16"])
+        self.assertEqual(allocator.allocate(16), "10.10.0.0/28")
+        self.assertEqual(allocator.allocate(16), "10.10.0.16/28")
+        self.assertEqual(allocator.allocate(256), "10.10.1.0/24")
+
+    def test_seeded_blocks_are_skipped_and_can_be_freed(self):
+        allocator = CidrAllocator(["10.10.0.0/24"], ["10.10.0.0/28", "10.10.0.32/28"])
+        self.assertEqual(allocator.allocate(16), "10.10.0.16/28")
+        self.assertEqual(allocator.allocate(16), "10.10.0.48/28")
+
+        allocator.free("10.10.0.0/28")
+        self.assertEqual(allocator.allocate(16), "10.10.0.0/28")
+        with self.assertRaises(ValueError):
+            allocator.free("10.10.0.128/28")
+
+    def test_free_merges_buddies(self):
+        allocator = CidrAllocator(["10.10.0.0/24"])
+        blocks = [allocator.allocate(16) for _ in range(16)]
+        self.assertIsNone(allocator.allocate(16))
+
+        for block in blocks:
+            allocator.free(block)
+        self.assertEqual(allocator.free_addresses, 256)
+        self.assertEqual(allocator.allocate(256), "10.10.0.0/24")
+
+    def test_allocate_many_is_all_or_nothing(self):
+        allocator = CidrAllocator(["10.10.0.0/24"])
+        blocks = allocator.allocate_many([16, 128, 16])
+        self.assertEqual(blocks, ["10.10.0.128/28", "10.10.0.0/25", "10.10.0.144/28"])
+
+        self.assertIsNone(allocator.allocate_many([64, 64]))
+        self.assertEqual(allocator.free_addresses, 256 - 160)
+
+    def test_blocks_never_overlap(self):
+        rng = random.Random(0)
+        allocator = CidrAllocator(["10.0.0.0/20"])
+        allocated = []
+        for _ in range(2000):
+            if allocated and rng.random() < 0.4:
+                allocator.free(allocated.pop(rng.randrange(len(allocated))))
+            else:
+                block = allocator.allocate(rng.choice([16, 32, 64, 256]))
+                if block is not None:
+                    allocated.append(block)
+
+        space = netaddr.IPSet()
+        for block in allocated:
+            self.assertFalse(space & netaddr.IPSet([block]))
+            space.add(block)
+        self.assertEqual(allocator.free_addresses + space.size, 4096)
+
+    def test_next_available_cidr(self):
+        self.assertEqual(next_available_cidr(["10.10.0.0/16"], ["10.10.0.0/28"]), "10.10.0.16/28")
+        self.assertIsNone(next_available_cidr(["10.10.0.0/28"], ["10.10.0.0/28"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
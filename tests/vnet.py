@@ -0,0 +1,112 @@
+import os
+import copy
+import unittest
+from unittest import mock
+import azure.core.exceptions
+import azure.mgmt.network.models
+from azure.core.polling import LROPoller, NoPolling
+
+os.environ.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+import clients
+from azu.vnet import VirtualNet
+
+
+def done(result) -> LROPoller:
+    return LROPoller(None, result, lambda response: response, NoPolling())
+
+
+class FakeNetworkClient:
+    """Network client keeping a single VirtualNet in memory."""
+
+    def __init__(self, fail_update: bool = False, conflicts: int = 0):
+        self.vnet = azure.mgmt.network.models.VirtualNetwork(
+            id="/vnets/invisinet-vnet-test",
+            address_space=azure.mgmt.network.models.AddressSpace(address_prefixes=["10.0.0.0/16"]),
+            subnets=[azure.mgmt.network.models.Subnet(name="existing", address_prefix="10.0.0.0/28")],
+        )
+        # Read-only attributes, only ever set by the service
+        self.vnet.name = "invisinet-vnet-test"
+        self.vnet.etag = "0"
+        self.fail_update = fail_update
+        # Updates made by another process between a read and the next update
+        self.conflicts = conflicts
+        self.updates = 0
+        self.route_tables = mock.Mock()
+        self.route_tables.begin_create_or_update.side_effect = lambda group, name, parameters: done(
+            azure.mgmt.network.models.RouteTable(id=f"/routeTables/{name}"))
+        self.subnets = mock.Mock()
+        self.subnets.list.side_effect = lambda group, vnet: list(self.vnet.subnets)
+        self.virtual_networks = mock.Mock()
+        self.virtual_networks.get.side_effect = lambda group, name: copy.deepcopy(self.vnet)
+        self.virtual_networks.begin_create_or_update.side_effect = self.update
+
+    def update(self, group: str, name: str, vnet: azure.mgmt.network.models.VirtualNetwork,
+               headers: dict) -> LROPoller:
+        self.updates += 1
+        if self.fail_update:
+            raise azure.core.exceptions.HttpResponseError("update failed")
+        if self.conflicts:
+            self.conflicts -= 1
+            self.vnet.subnets.append(azure.mgmt.network.models.Subnet(name=f"other-{self.conflicts}",
+                                                                      address_prefix="10.0.1.0/28"))
+            self.vnet.etag = str(int(self.vnet.etag) + 1)
+        if headers["If-Match"] != self.vnet.etag:
+            error = azure.core.exceptions.HttpResponseError("precondition failed")
+            error.status_code = 412
+            raise error
+        for subnet in vnet.subnets:
+            subnet.id = subnet.id or f"{vnet.id}/subnets/{subnet.name}"
+        vnet.etag = str(int(vnet.etag) + 1)
+        self.vnet = vnet
+        return done(vnet)
+
+
+class CreateSubnetsTest(unittest.TestCase):
+
+    def setUp(self):
+        VirtualNet._allocators.clear()
+
+    def create_subnets(self, network_client: FakeNetworkClient, names: [str]) -> [azure.mgmt.network.models.Subnet]:
+        with mock.patch.object(clients.registry, "azure_client", lambda client_cls: network_client):
+            return VirtualNet(network_client.vnet).create_subnets(names)
+
+    def test_subnets_are_added_in_one_update(self):
+        network_client = FakeNetworkClient()
+        subnets = self.create_subnets(network_client, [f"subnet-{i}" for i in range(5)])
+
+        self.assertEqual([subnet.name for subnet in subnets], [f"subnet-{i}" for i in range(5)])
+        self.assertEqual(len({subnet.address_prefix for subnet in subnets} | {"10.0.0.0/28"}), 6)
+        self.assertEqual([subnet.route_table.id for subnet in subnets],
+                         [f"/routeTables/subnet-{i}-route-table" for i in range(5)])
+        self.assertEqual(network_client.updates, 1)
+        self.assertEqual(network_client.route_tables.begin_create_or_update.call_count, 5)
+        # The existing subnet is kept, and the subnets are listed only once to seed the allocator
+        self.assertEqual(len(network_client.vnet.subnets), 6)
+        self.assertEqual(network_client.subnets.list.call_count, 1)
+
+    def test_failed_update_frees_the_cidr_blocks(self):
+        network_client = FakeNetworkClient(fail_update=True)
+        with self.assertRaises(azure.core.exceptions.HttpResponseError):
+            self.create_subnets(network_client, ["subnet-a", "subnet-b"])
+
+        allocator = VirtualNet._allocators[network_client.vnet.id]
+        self.assertEqual(allocator.free_addresses, 2 ** 16 - 16)
+        deleted = sorted(call.args[1] for call in network_client.route_tables.begin_delete.call_args_list)
+        self.assertEqual(deleted, ["subnet-a-route-table", "subnet-b-route-table"])
+
+    def test_concurrent_updates_are_not_overwritten(self):
+        network_client = FakeNetworkClient(conflicts=1)
+        self.create_subnets(network_client, ["subnet-a", "subnet-b"])
+
+        self.assertEqual(network_client.updates, 2)
+        self.assertEqual(sorted(subnet.name for subnet in network_client.vnet.subnets),
+                         ["existing", "other-0", "subnet-a", "subnet-b"])
+
+    def test_no_names_make_no_calls(self):
+        network_client = FakeNetworkClient()
+        self.assertEqual(self.create_subnets(network_client, []), [])
+        self.assertEqual(network_client.updates, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import threading
+from aws.waiter import ResourceKind, WaiterService, WaiterError
+from botocore.exceptions import ClientError
+
+
+class FakeResources:
+    """Resources whose state advances by one step every time they are described."""
+
+    def __init__(self, steps: dict[str, [str]], throttle_first: int = 0):
+        self.steps = steps
+        self.throttle_first = throttle_first
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def describe(self, keys: [str]) -> dict[str, dict]:
+        with self.lock:
+            self.batches.append(list(keys))
+            if len(self.batches) <= self.throttle_first:
+                raise ClientError({"Error": {"Code": "RequestLimitExceeded"}}, "DescribeInstances")
+            descriptions = {}
+            for key in keys:
+                steps = self.steps.get(key)
+                if steps:
+                    descriptions[key] = {"State": steps.pop(0) if len(steps) > 1 else steps[0]}
+            return descriptions
+
+    def kind(self, **kwargs) -> ResourceKind:
+        return ResourceKind(describe=self.describe, state=lambda description: description["State"], **kwargs)
+
+
+class WaiterServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = WaiterService(min_interval=0.01, max_interval=0.05, timeout=5)
+
+    def test_waits_are_polled_in_batches(self):
+        resources = FakeResources({f"i-{n}": ["pending"] * (n % 3) + ["running"] for n in range(10)})
+        self.service.register_kind("instance", resources.kind(batch_size=4))
+
+        descriptions = self.service.wait("instance", [f"i-{n}" for n in range(10)], "running")
+        self.assertEqual([description["State"] for description in descriptions], ["running"] * 10)
+        # Every poll covers all pending resources in batches of at most four,
+        # resources that reached their state are not described again
+        self.assertEqual([len(batch) for batch in resources.batches[:3]], [4, 4, 2])
+        self.assertEqual(sorted(resources.batches[3] + resources.batches[4]),
+                         sorted(f"i-{n}" for n in range(10) if n % 3))
+        self.assertEqual(self.service.polls, 3)
+        self.assertEqual(self.service.pending(), {})
+
+    def test_failure_and_missing_states(self):
+        resources = FakeResources({"i-1": ["pending", "terminated"]})
+        self.service.register_kind("instance", resources.kind(
+            failure_states={"running": frozenset({"terminated"})}, missing_state="terminated"))
+
+        with self.assertRaises(WaiterError):
+            self.service.wait("instance", ["i-1"], "running")
+        self.assertEqual(self.service.wait("instance", ["i-gone"], "terminated"), [None])
+
+    def test_throttling_backs_off_and_timeouts_expire(self):
+        resources = FakeResources({"i-1": ["running"]}, throttle_first=2)
+        self.service.register_kind("instance", resources.kind())
+        self.assertEqual(self.service.wait("instance", ["i-1"], "running")[0]["State"], "running")
+        self.assertEqual(len(resources.batches), 3)
+
+        with self.assertRaises(TimeoutError):
+            self.service.wait("instance", ["i-never"], "running", timeout=0.1)
+
+    def test_unknown_kinds_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.service.submit("volume", "vol-1", "available")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,4 @@
+# The context module must be initialized before the actions module, which
+# refers back to it when registered functions are called.
+from transactions.context import begin, commit
+from transactions.journal import recover
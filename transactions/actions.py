@@ -1,43 +1,146 @@
+import uuid
 import attrs
-from typing import Callable
 import transactions.context
-from functools import wraps, partial
+from functools import wraps
+from typing import Any, Callable, Optional
+
+__all__ = ["Action", "ResourceAction", "ActionHandle"]
+
+
+@attrs.define(slots=True, eq=False)
+class ActionHandle:
+    """
+    Placeholder for the result of an action queued in a multi-action context.
+    Handles can be passed as arguments to later actions, which makes those
+    actions depend on the one that produces the handle.
+    """
+    action_id: uuid.UUID = attrs.field(factory=uuid.uuid4)
+    name: Optional[str] = None
+    done: bool = False
+    value: Any = None
+
+    def result(self) -> Any:
+        if not self.done:
+            raise RuntimeError(f"Action {self.name} ({self.action_id}) has not been executed")
+        return self.value
+
+    def __repr__(self):
+        return f"ActionHandle({self.name}, {self.action_id})"
+
+
+def _find_handles(value) -> [ActionHandle]:
+    """Collect every handle referenced by an argument, including nested containers."""
+    if isinstance(value, ActionHandle):
+        return [value]
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return [handle for item in value for handle in _find_handles(item)]
+    if isinstance(value, dict):
+        return [handle for item in value.values() for handle in _find_handles(item)]
+    return []
+
+
+def _resolve(value):
+    """Replace every handle in an argument with the result it stands for."""
+    if isinstance(value, ActionHandle):
+        return value.result()
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return type(value)(_resolve(item) for item in value)
+    if isinstance(value, dict):
+        return {key: _resolve(item) for key, item in value.items()}
+    return value
 
 
 @attrs.define(slots=True)
 class Action:
     undo: Callable
     f: Callable
+    args: tuple = ()
+    kwargs: dict = attrs.Factory(dict)
+    depends_on: [ActionHandle] = attrs.Factory(list)
+
+    @property
+    def name(self) -> str:
+        return getattr(self.f, "__qualname__", repr(self.f))
+
+    @property
+    def dependencies(self) -> [ActionHandle]:
+        """Explicit dependencies plus every handle found in the call arguments."""
+        handles = list(self.depends_on)
+        handles += _find_handles(self.args)
+        handles += _find_handles(self.kwargs)
+        unique = {}
+        for handle in handles:
+            unique.setdefault(handle.action_id, handle)
+        return list(unique.values())
+
+    def run(self) -> Any:
+        return self.f(*_resolve(self.args), **_resolve(self.kwargs))
 
     @classmethod
-    def register(cls, undo_callback: Callable):
+    def _decorate(cls, make_action: Callable):
         def decorator(f):
             @wraps(f)
-            def wrapper(*args, **kwargs):
-                action = cls(
-                    undo=undo_callback,
-                    f=partial(f, *args, **kwargs)
-                )
-                return transactions.context.current.add_action(action)
+            def wrapper(*args, depends_on: Optional[list[ActionHandle]] = None, **kwargs):
+                action = make_action(f, args, kwargs)
+                action.depends_on = list(depends_on or [])
+                # Calls on an object in dry-run mode are recorded into its plan
+                if args and getattr(args[0], "dryrun", False):
+                    return args[0].plan.add_action(action)
+                return transactions.context.current().add_action(action)
 
             return wrapper
 
+        return decorator
+
+    @classmethod
+    def register(cls, undo_callback: Callable):
+        """
+        Register a function as a transactional action. The undo callback is
+        invoked with the result of the function when the transaction rolls back.
+        """
+        return cls._decorate(lambda f, call_args, call_kwargs: cls(
+            undo=undo_callback, f=f, args=call_args, kwargs=call_kwargs
+        ))
+
+
+def _terminate(result):
+    """
+    Terminate a created resource, or every resource of a bulk request. The
+    resources of a type with a ``terminate_many`` class method are
+    terminated together.
+    """
+    if not isinstance(result, (list, tuple)):
+        result.terminate()
+        return
+
+    by_type: dict[type, list] = {}
+    for resource in result:
+        by_type.setdefault(type(resource), []).append(resource)
+    for resource_type, resources in by_type.items():
+        if hasattr(resource_type, "terminate_many"):
+            resource_type.terminate_many(resources)
+        else:
+            for resource in resources:
+                resource.terminate()
+
 
 @attrs.define(slots=True, init=False)
 class ResourceAction(Action):
 
-    def __init__(self, f: Callable):
+    def __init__(self, f: Callable, args: tuple = (), kwargs: Optional[dict] = None,
+                 depends_on: Optional[list[ActionHandle]] = None):
         self.f = f
-        self.undo = lambda r: r.terminate()
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.depends_on = list(depends_on or [])
+        self.undo = _terminate
 
     @classmethod
     def register(cls, **kwargs):
-        def decorator(f):
-            @wraps(f)
-            def wrapper(*args, **kwargs):
-                action = cls(
-                    f=partial(f, *args, **kwargs)
-                )
-                return transactions.context.current.add_action(action)
-
-            return wrapper
+        """
+        Register a function that creates a resource. Rolling back terminates
+        the resource returned by the function.
+        """
+        return cls._decorate(lambda f, call_args, call_kwargs: cls(
+            f=f, args=call_args, kwargs=call_kwargs
+        ))
@@ -1,10 +1,16 @@
 import uuid
+import clients
 import logging
+import metrics
+import threading
+import contextvars
+import transactions.journal
 from typing import Any, Optional
 from transactions.actions import *
 from abc import ABC, abstractmethod
 from collections import OrderedDict
 
+DEFAULT_MAX_WORKERS = 8
 logger = logging.getLogger(__name__)
 
 
@@ -23,39 +29,186 @@ class Context(ABC):
 
 
 class MultiActionContext(Context):
+    """
+    Queues actions and executes them as a dependency graph on commit. An
+    action depends on every handle passed to it as an argument and on the
+    handles listed in its ``depends_on``. Independent actions run
+    concurrently on the executor of the client registry, at most
+    ``max_workers`` at once. With a journal, the commit is logged as it
+    progresses so that it can be rolled back after a crash.
+    """
 
-    actions: OrderedDict[uuid.UUID, Action] = OrderedDict()
-    exec_stack: OrderedDict[uuid.UUID, (Action, Any)] = OrderedDict()
+    actions: OrderedDict[uuid.UUID, Action]
+    handles: dict[uuid.UUID, ActionHandle]
+    exec_stack: OrderedDict[uuid.UUID, (Action, Any)]
 
-    def add_action(self, action: Action) -> uuid.UUID:
-        action_id = uuid.uuid4()
-        self.actions[action_id] = action
-        return action_id
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS,
+                 journal: Optional[transactions.journal.Journal] = None):
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be positive, got {max_workers}")
+        self.max_workers = max_workers
+        self.journal = journal
+        self.txn_id = uuid.uuid4()
+        self.actions = OrderedDict()
+        self.handles = {}
+        self.exec_stack = OrderedDict()
+        self._dependencies: dict[uuid.UUID, set[uuid.UUID]] = {}
+        # Restores the context active when the transaction began, set by begin()
+        self.token: Optional[contextvars.Token] = None
+
+    def add_action(self, action: Action) -> ActionHandle:
+        dependencies = set()
+        for handle in action.dependencies:
+            if handle.action_id in self.handles:
+                dependencies.add(handle.action_id)
+            elif not handle.done:
+                raise ValueError(f"{action.name} depends on {handle}, "
+                                 f"which is not part of this transaction")
+
+        handle = ActionHandle(name=action.name)
+        self.actions[handle.action_id] = action
+        self.handles[handle.action_id] = handle
+        self._dependencies[handle.action_id] = dependencies
+        return handle
+
+    def _run_graph(self, nodes: [uuid.UUID], blockers: dict[uuid.UUID, set[uuid.UUID]],
+                   run, on_success, on_failure) -> bool:
+        """
+        Run ``run(node)`` for every node once all of its blockers finished
+        successfully. Stops scheduling new nodes after the first failure and
+        waits for the in-flight ones. Returns whether every node succeeded.
+
+        As with clients.map_concurrently, the calling thread runs ready nodes
+        along with the workers of the registry's executor, so that a graph
+        run from a node of another one makes progress even when every thread
+        of the executor is busy.
+        """
+        pending = {node: set(blockers[node]) for node in nodes}
+        unblocks: dict[uuid.UUID, [uuid.UUID]] = {node: [] for node in nodes}
+        for node, node_blockers in pending.items():
+            for blocker in node_blockers:
+                unblocks[blocker].append(node)
+
+        run = metrics.propagate(run)
+        condition = threading.Condition()
+        ready = [node for node in nodes if not pending[node]]
+        state = {"succeeded": True, "running": 0, "helpers": 0}
+
+        def start_helpers():
+            helpers = min(len(ready), self.max_workers - 1 - state["helpers"])
+            state["helpers"] += max(helpers, 0)
+            for _ in range(helpers):
+                clients.registry.executor.submit(work, False)
+
+        def work(caller: bool):
+            while True:
+                with condition:
+                    while not (ready and state["succeeded"]):
+                        # Helpers leave when nothing is ready, the caller once nothing can become ready
+                        if not caller or state["running"] == 0:
+                            if not caller:
+                                state["helpers"] -= 1
+                            return
+                        condition.wait()
+                    node = ready.pop(0)
+                    del pending[node]
+                    state["running"] += 1
+
+                try:
+                    result, error = run(node), None
+                except Exception as e:
+                    result, error = None, e
+
+                with condition:
+                    state["running"] -= 1
+                    if error is not None:
+                        state["succeeded"] = False
+                        on_failure(node, error)
+                    else:
+                        on_success(node, result)
+                        for unblocked in unblocks[node]:
+                            pending[unblocked].discard(node)
+                            if not pending[unblocked]:
+                                ready.append(unblocked)
+                        start_helpers()
+                    condition.notify_all()
+
+        with condition:
+            start_helpers()
+        work(True)
+        return state["succeeded"]
+
+    def _run(self, action_id: uuid.UUID) -> Any:
+        action = self.actions[action_id]
+        if self.journal is None:
+            return action.run()
+        self.journal.intent(self.txn_id, action_id, action.name)
+        with self.journal.activate(self.txn_id, action_id):
+            return action.run()
 
     def commit(self) -> Optional[dict[uuid.UUID, Any]]:
         self.exec_stack.clear()
-        for action_id, action in self.actions.items():
-            try:
-                result = action.f()
-                self.exec_stack[action_id] = (action, result)
-            except Exception as e:
-                logging.error(f"Failed to execute one of the actions: {e}")
-                logging.error(f"Rolling back previous executions, "
-                              f"current execution stack: {self.exec_stack.values()}")
-                self.rollback()
-                return None
+        if self.journal is not None:
+            self.journal.begin(self.txn_id, {action_id: action.name for action_id, action in self.actions.items()})
+
+        def on_success(action_id, result):
+            handle = self.handles[action_id]
+            handle.value = result
+            handle.done = True
+            self.exec_stack[action_id] = (self.actions[action_id], result)
+            if self.journal is not None:
+                self.journal.result(self.txn_id, action_id)
+
+        def on_failure(action_id, error):
+            logger.error(f"Failed to execute {self.actions[action_id].name}: {error}")
+
+        succeeded = self._run_graph(
+            list(self.actions.keys()),
+            self._dependencies,
+            self._run,
+            on_success,
+            on_failure
+        )
+        if not succeeded:
+            logger.error(f"Rolling back previous executions, "
+                         f"current execution stack: {list(self.exec_stack.values())}")
+            self.rollback()
+            return None
 
         self.actions.clear()
+        if self.journal is not None:
+            self.journal.end(self.txn_id, "committed")
         return {action_id: result for action_id, (_, result) in self.exec_stack.items()}
 
     def rollback(self):
-        for action_id, (action, result) in reversed(self.exec_stack.items()):
+        """
+        Undo every executed action in reverse topological order. An action is
+        undone only after all executed actions that depend on it were undone.
+        With a journal, resources left behind by failed actions are deleted
+        as well.
+        """
+        executed = list(self.exec_stack.keys())
+        blockers = {action_id: set() for action_id in executed}
+        for action_id in executed:
+            for dependency in self._dependencies.get(action_id, ()):
+                if dependency in blockers:
+                    blockers[dependency].add(action_id)
+
+        def undo(action_id):
+            action, result = self.exec_stack[action_id]
             try:
                 action.undo(result)
             except Exception as e:
-                logger.error(f"Failed to undo action: {e}")
+                logger.error(f"Failed to undo action {action.name}: {e}")
+            else:
+                if self.journal is not None:
+                    self.journal.undone(self.txn_id, action_id)
 
+        self._run_graph(executed, blockers, undo,
+                        lambda action_id, _: None, lambda action_id, _: None)
         self.exec_stack.clear()
+        if self.journal is not None:
+            self.journal.rollback(self.txn_id)
 
 
 class SingleActionContext(Context):
@@ -64,7 +217,7 @@ class SingleActionContext(Context):
         Single action context calls the underlying operation inplace, and
         does not trigger rollback if it fails.
         """
-        return action.f()
+        return action.run()
 
     def commit(self):
         raise NotImplementedError("Single-action context does not "
@@ -77,16 +230,61 @@ class SingleActionContext(Context):
                                   "Call begin() first to start a multi-action context")
 
 
-current = SingleActionContext()
+# The context recording the actions called by the running code. Threads start
+# with an empty context, so a transaction only records the calls of the thread
+# or job that began it, and of the work it hands over with metrics.propagate.
+_current: contextvars.ContextVar[Context] = contextvars.ContextVar("invisinet_transaction",
+                                                                   default=SingleActionContext())
+
+
+def current() -> Context:
+    return _current.get()
+
+
+def activate(context: Context) -> contextvars.Token:
+    """Make ``context`` record the actions called in the current context, until restore()."""
+    return _current.set(context)
+
+
+def restore(token: contextvars.Token):
+    _current.reset(token)
+
+
+def deactivate(context: Context):
+    """
+    Make the context that was active when ``context`` began active again, so
+    that ending a nested transaction resumes the outer one. Falls back to a
+    single-action context when ``context`` was not begun in this context.
+    """
+    token = getattr(context, "token", None)
+    if token is not None:
+        context.token = None
+        try:
+            restore(token)
+            return
+        except ValueError:
+            # Begun in another context, such as the one of another thread
+            pass
+    activate(SingleActionContext())
 
 
-def begin() -> None:
-    global current
-    current = MultiActionContext()
+def begin(max_workers: int = DEFAULT_MAX_WORKERS,
+          journal: Optional[transactions.journal.Journal] = None) -> None:
+    """
+    Start a multi-action transaction, journaled to ``journal`` or to the
+    journal set up with transactions.journal.configure().
+    """
+    context = MultiActionContext(max_workers=max_workers, journal=journal or transactions.journal.default)
+    context.token = activate(context)
 
 
 def commit() -> Optional[dict[uuid.UUID, Any]]:
-    global current
-    results = current.commit()
-    current = SingleActionContext()
-    return results
+    # Actions executed during the commit run in place, so nested calls to
+    # registered functions are not queued into the committing transaction
+    context = current()
+    token = activate(SingleActionContext())
+    try:
+        return context.commit()
+    finally:
+        restore(token)
+        deactivate(context)
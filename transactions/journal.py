@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import socket
+import clients
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+DEFAULT_COMPACT_EVERY = 64
+logger = logging.getLogger(__name__)
+__all__ = ["Journal", "configure", "default", "record", "register_destroyer", "recover"]
+
+# Journal, transaction and action the running code is executing on behalf of
+_active: contextvars.ContextVar[Optional[tuple]] = contextvars.ContextVar("invisinet_journal", default=None)
+# Functions deleting a resource by its ID, keyed by (provider, kind)
+_destroyers: dict[(str, str), Callable[[str], None]] = {}
+# Transactions this process is committing or rolling back, never recovered by it
+_running: set[str] = set()
+_running_lock = threading.Lock()
+
+
+def _start_time(pid: int) -> Optional[str]:
+    """
+    When a process started, in clock ticks since boot, telling it apart from
+    a later process reusing its ID. None where /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _owner(pid: int) -> dict:
+    return {"pid": pid, "host": socket.gethostname(), "started": _start_time(pid)}
+
+
+def _alive(owner: dict, txn: str) -> Optional[bool]:
+    """
+    Whether the process owning a transaction may still be running it, or
+    None when the process runs on another host and cannot be checked.
+    """
+    if owner["host"] != socket.gethostname():
+        return None
+    if owner["pid"] == os.getpid():
+        with _running_lock:
+            return txn in _running
+    try:
+        os.kill(owner["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    started = _start_time(owner["pid"])
+    return started is None or owner.get("started") is None or started == owner["started"]
+
+
+class Journal:
+    """
+    Append-only write-ahead log of multi-action transactions, one JSON record
+    per line. Records are written before an action runs, for every resource
+    the action creates, and when the action completes or is undone, so a
+    transaction interrupted by a crash can be rolled back from its own
+    records without scanning the account.
+
+    Records of finished transactions are dropped by compacting the file every
+    ``compact_every`` finished transactions. Transactions are recorded along
+    with the process running them, so that recovery leaves alone the ones
+    that are still running. Processes sharing the journal take turns with a
+    lock file, and read the records of the others before writing theirs.
+    """
+
+    def __init__(self, path: str, fsync: bool = True, compact_every: int = DEFAULT_COMPACT_EVERY):
+        self.path = path
+        self.fsync = fsync
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._open: dict[str, list[dict]] = {}
+        self._finished = 0
+        # Transactions begun through this journal
+        self._begun: set[str] = set()
+        # Position up to which the file was read, and the file it was read from
+        self._offset = 0
+        self._inode: Optional[int] = None
+        self._file = None
+        # Serializes the processes sharing the journal, the file itself being replaced by compaction
+        self._lock_file = open(f"{path}.lock", "a")
+        with self._locked():
+            pass
+
+    @contextmanager
+    def _locked(self):
+        """Hold the journal for this thread and process, with the records of other processes read in."""
+        with self._lock:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Read the records appended since the last read, from the start if the file was replaced."""
+        inode = os.stat(self.path).st_ino if os.path.exists(self.path) else None
+        if self._file is None or inode != self._inode:
+            # Compacted by another process, whose rewrite holds every open transaction
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, "a")
+            self._inode = os.fstat(self._file.fileno()).st_ino
+            self._open, self._offset = {}, 0
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        self._offset += len(data)
+        for line in data.splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave the last record half-written
+                logger.warning(f"Skipping a truncated record in {self.path}")
+                continue
+            self._apply(entry)
+
+    def _apply(self, entry: dict):
+        if entry["type"] == "end":
+            self._open.pop(entry["txn"], None)
+        else:
+            self._open.setdefault(entry["txn"], []).append(entry)
+
+    def _append(self, entry: dict):
+        entry["time"] = time.time()
+        line = json.dumps(entry, default=str) + "\n"
+        with self._locked():
+            self._apply(entry)
+            if entry["type"] == "end":
+                self._finished += 1
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._offset += len(line.encode())
+            if entry["type"] == "end" and self._finished >= self.compact_every:
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the journal with the records of open transactions only."""
+        temporary = f"{self.path}.compact"
+        with open(temporary, "w") as f:
+            for entries in self._open.values():
+                for entry in entries:
+                    f.write(json.dumps(entry, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(temporary, self.path)
+        self._file = open(self.path, "a")
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._offset = os.path.getsize(self.path)
+        self._finished = 0
+
+    def compact(self):
+        with self._locked():
+            self._compact()
+
+    def begin(self, txn: uuid.UUID, actions: dict[uuid.UUID, str]):
+        with _running_lock:
+            _running.add(str(txn))
+        self._begun.add(str(txn))
+        self._append({"type": "begin", "txn": str(txn), "owner": _owner(os.getpid()),
+                      "actions": {str(action_id): name for action_id, name in actions.items()}})
+
+    def intent(self, txn: uuid.UUID, action_id: uuid.UUID, name: str):
+        self._append({"type": "intent", "txn": str(txn), "action": str(action_id), "name": name,
+                      "owner": _owner(os.getpid())})
+
+    def resource(self, txn: uuid.UUID, action_id: uuid.UUID, provider: str, kind: str, resource_id: str,
+                 region: Optional[str] = None):
+        entry = {"type": "resource", "txn": str(txn), "action": str(action_id),
+                 "provider": provider, "kind": kind, "id": resource_id}
+        if region is not None:
+            entry["region"] = region
+        self._append(entry)
+
+    def result(self, txn: uuid.UUID, action_id: uuid.UUID):
+        self._append({"type": "result", "txn": str(txn), "action": str(action_id)})
+
+    def undone(self, txn: uuid.UUID, action_id: uuid.UUID):
+        self._append({"type": "undone", "txn": str(txn), "action": str(action_id)})
+
+    def end(self, txn: uuid.UUID, outcome: str):
+        self._append({"type": "end", "txn": str(txn), "outcome": outcome})
+        with _running_lock:
+            _running.discard(str(txn))
+
+    @contextmanager
+    def activate(self, txn: uuid.UUID, action_id: uuid.UUID):
+        """Attribute the resources recorded inside this block to an action."""
+        token = _active.set((self, txn, action_id))
+        try:
+            yield
+        finally:
+            _active.reset(token)
+
+    def open_transactions(self) -> [str]:
+        with self._locked():
+            return list(self._open.keys())
+
+    def owner(self, txn) -> Optional[dict]:
+        """The process that last recorded an entry of an open transaction, if known."""
+        with self._locked():
+            entries = self._open.get(str(txn), ())
+            return next((entry["owner"] for entry in reversed(entries) if "owner" in entry), None)
+
+    def rollback(self, txn) -> bool:
+        """
+        Delete every resource recorded by the transaction's actions that were
+        not undone, newest first, and mark the transaction as rolled back.
+        Returns False, leaving the transaction open for a later attempt, if
+        any resource could not be deleted.
+        """
+        txn = str(txn)
+        with self._locked():
+            entries = list(self._open.get(txn, ()))
+        undone = {entry["action"] for entry in entries if entry["type"] == "undone"}
+        resources = [entry for entry in entries
+                     if entry["type"] == "resource" and entry["action"] not in undone]
+
+        succeeded = True
+        for entry in reversed(resources):
+            destroy = _destroyers.get((entry["provider"], entry["kind"]))
+            if destroy is None:
+                logger.warning(f"No way to delete {entry['provider']} {entry['kind']} {entry['id']}, skipping")
+                continue
+            try:
+                logger.info(f"Deleting {entry['provider']} {entry['kind']} {entry['id']}...")
+                with clients.region(entry.get("region")):
+                    destroy(entry["id"])
+            except Exception as e:
+                logger.error(f"Failed to delete {entry['provider']} {entry['kind']} {entry['id']}: {e}")
+                succeeded = False
+
+        if succeeded:
+            self.end(txn, "rolled_back")
+        else:
+            # Left to recovery, even by this process
+            with _running_lock:
+                _running.discard(txn)
+        return succeeded
+
+    def recover(self, force: bool = False) -> [str]:
+        """
+        Roll back every transaction left open by a process that is gone.
+        Transactions of processes running on other hosts cannot be checked
+        and are only rolled back with ``force``.
+        """
+        recovered = []
+        for txn in self.open_transactions():
+            owner = self.owner(txn)
+            alive = _alive(owner, txn) if owner is not None else False
+            if alive is None and not force:
+                logger.warning(f"Skipping transaction {txn} of {owner['host']}, "
+                               f"which cannot be checked from here")
+                continue
+            if alive:
+                logger.info(f"Skipping transaction {txn}, still run by process {owner['pid']}")
+                continue
+            logger.info(f"Rolling back interrupted transaction {txn}...")
+            if self.rollback(txn):
+                recovered.append(txn)
+        return recovered
+
+    def close(self):
+        """Close the journal, leaving the transactions still open in it to recovery."""
+        with self._lock:
+            self._file.close()
+            self._lock_file.close()
+            with _running_lock:
+                _running.difference_update(self._begun)
+
+
+default: Optional[Journal] = None
+
+
+def configure(path: Optional[str], **kwargs) -> Optional[Journal]:
+    """Journal every transaction started from now on to ``path``, or stop journaling."""
+    global default
+    if default is not None:
+        default.close()
+    default = Journal(path, **kwargs) if path is not None else None
+    return default
+
+
+def record(provider: str, kind: str, resource_id: str):
+    """
+    Record a resource created by the running action, along with the AWS
+    region it was created in. Does nothing outside of a journaled transaction.
+    """
+    active = _active.get()
+    if active is not None:
+        journal, txn, action_id = active
+        region = clients.current_region() if provider == "aws" else None
+        journal.resource(txn, action_id, provider, kind, resource_id, region)
+
+
+def register_destroyer(provider: str, kind: str, destroy: Callable[[str], None]):
+    """
+    Register the function deleting a recorded resource by its ID during
+    recovery. It must succeed when the resource no longer exists.
+    """
+    _destroyers[(provider, kind)] = destroy
+
+
+def recover(path: Optional[str] = None, force: bool = False) -> [str]:
+    journal = Journal(path) if path is not None else default
+    if journal is None:
+        raise ValueError("No journal configured, call configure() or pass a path")
+    try:
+        return journal.recover(force)
+    finally:
+        if path is not None:
+            journal.close()
@@ -0,0 +1,256 @@
+import uuid
+import attrs
+import logging
+import metrics
+import transactions.context
+import transactions.journal
+from transactions.actions import Action, ActionHandle
+from typing import Any, Callable, Optional
+
+# Latency assumed for provider requests never recorded by the metrics registry, in seconds
+DEFAULT_CALL_LATENCY = 0.25
+logger = logging.getLogger(__name__)
+__all__ = ["Estimate", "CostModel", "Planner", "PlannedStep", "QuotaImpact", "PlanEstimate", "Plan",
+           "planner", "begin", "end"]
+
+
+@attrs.define
+class Estimate:
+    """
+    The provider requests one call of an operation issues, keyed by
+    (provider, service, call), and the quotas it consumes, keyed by
+    (scope, quota). ``results`` is the length of the list the call returns,
+    or None when it returns a single result.
+    """
+    calls: dict[(str, str, str), int] = attrs.Factory(dict)
+    quota: dict[(str, str), int] = attrs.Factory(dict)
+    results: Optional[int] = None
+    # Requests issued at once, dividing the time spent in requests
+    concurrency: int = 1
+    # Time spent outside of requests when the operation has no recorded profile
+    idle: float = 0.0
+
+
+@attrs.define
+class CostModel:
+    """
+    Estimates a call of an operation from its arguments. Handles of actions
+    planned earlier are replaced with placeholders, or lists of placeholders
+    for actions returning lists, so that only their number is known.
+    """
+    provider: str
+    operation: str
+    estimate: Callable[..., Estimate]
+
+
+class Planner:
+    """
+    Cost models of the transactional operations, keyed by the name of the
+    actions they are recorded as.
+    """
+
+    def __init__(self):
+        self.models: dict[str, CostModel] = {}
+
+    def register(self, f: Callable, provider: str, estimate: Callable[..., Estimate]):
+        self.models[f.__qualname__] = CostModel(provider, f.__name__, estimate)
+
+    def estimate(self, action: Action, args: tuple, kwargs: dict) -> Estimate:
+        model = self.models.get(action.name)
+        if model is None:
+            logger.warning(f"No cost model for {action.name}, assuming it issues no requests")
+            return Estimate()
+        return model.estimate(*args, **kwargs)
+
+    def seconds(self, action: Action, estimate: Estimate) -> float:
+        """
+        Wall time of a call from the recorded latency of its requests and the
+        recorded idle time of its operation, falling back to the model.
+        """
+        model = self.models.get(action.name)
+        requests = sum(count * (metrics.registry.mean_latency(*call) or DEFAULT_CALL_LATENCY)
+                       for call, count in estimate.calls.items())
+        idle = metrics.registry.idle_time(model.operation, model.provider) if model is not None else None
+        return requests / max(1, estimate.concurrency) + (idle if idle is not None else estimate.idle)
+
+
+planner = Planner()
+
+
+@attrs.define
+class PlannedStep:
+    """An action of a plan, starting ``start`` seconds after the plan is applied."""
+    action_id: uuid.UUID
+    name: str
+    depends_on: list[uuid.UUID]
+    calls: dict[(str, str, str), int]
+    quota: dict[(str, str), int]
+    start: float
+    seconds: float
+
+    @property
+    def end(self) -> float:
+        return self.start + self.seconds
+
+
+@attrs.define
+class QuotaImpact:
+    """
+    Use of a quota before and after a plan. ``used`` is None when the
+    inventory does not tell, and ``limit`` when the quota is not known.
+    """
+    scope: str
+    quota: str
+    used: Optional[int]
+    planned: int
+    limit: Optional[int] = None
+
+    @property
+    def exceeded(self) -> bool:
+        return self.limit is not None and (self.used or 0) + self.planned > self.limit
+
+
+@attrs.define
+class PlanEstimate:
+    steps: list[PlannedStep]
+    quotas: list[QuotaImpact]
+
+    @property
+    def calls(self) -> dict[(str, str, str), int]:
+        totals = {}
+        for step in self.steps:
+            for call, count in step.calls.items():
+                totals[call] = totals.get(call, 0) + count
+        return totals
+
+    @property
+    def seconds(self) -> float:
+        """Wall time of the plan, given by its longest chain of dependent actions."""
+        return max((step.end for step in self.steps), default=0.0)
+
+    def summary(self) -> str:
+        lines = [f"{len(self.steps)} actions, {sum(self.calls.values())} requests, "
+                 f"about {self.seconds:.1f}s"]
+        for step in self.steps:
+            requests = ", ".join(f"{service}.{call} x{count}"
+                                 for (_, service, call), count in sorted(step.calls.items()))
+            lines.append(f"  +{step.start:.1f}s {step.name} ({step.seconds:.1f}s): {requests or 'no requests'}")
+        for impact in self.quotas:
+            used = "?" if impact.used is None else impact.used
+            limit = "" if impact.limit is None else f"/{impact.limit}"
+            warning = " EXCEEDED" if impact.exceeded else ""
+            lines.append(f"  {impact.scope} {impact.quota}: {used} + {impact.planned}{limit}{warning}")
+        return "\n".join(lines)
+
+
+class _Pending:
+    """Placeholder for a result of an action that was planned but not applied."""
+
+    def __init__(self, handle: ActionHandle):
+        self.handle = handle
+
+    def __repr__(self):
+        return f"<pending {self.handle.name}>"
+
+
+class Plan(transactions.context.MultiActionContext):
+    """
+    A transaction recorded without touching the provider. Calls of registered
+    operations are queued with their arguments as they are made, estimated
+    offline, and executed later as recorded by apply(), which commits the
+    plan as a transaction.
+    """
+
+    @classmethod
+    def of(cls, context: transactions.context.MultiActionContext) -> "Plan":
+        """Turn the actions queued in a transaction into a plan, leaving the transaction empty."""
+        plan = cls(max_workers=context.max_workers, journal=context.journal)
+        plan.actions, context.actions = context.actions, plan.actions
+        plan.handles, context.handles = context.handles, plan.handles
+        plan._dependencies, context._dependencies = context._dependencies, plan._dependencies
+        return plan
+
+    def _placeholders(self, value, results: dict[uuid.UUID, Optional[int]]):
+        if isinstance(value, ActionHandle):
+            count = results.get(value.action_id)
+            return _Pending(value) if count is None else [_Pending(value)] * count
+        if isinstance(value, (tuple, list, set, frozenset)):
+            return type(value)(self._placeholders(item, results) for item in value)
+        if isinstance(value, dict):
+            return {key: self._placeholders(item, results) for key, item in value.items()}
+        return value
+
+    def estimate(self, usage: Optional[dict[(str, str), int]] = None,
+                 limits: Optional[dict[str, int]] = None) -> PlanEstimate:
+        """
+        Estimate the requests, wall time and quota use of the plan, given the
+        current ``usage`` of every (scope, quota) and the ``limits`` of every
+        quota. No provider request is issued.
+        """
+        usage, limits = usage or {}, limits or {}
+        steps: dict[uuid.UUID, PlannedStep] = {}
+        results: dict[uuid.UUID, Optional[int]] = {}
+        for action_id, action in self.actions.items():
+            estimate = planner.estimate(action, self._placeholders(action.args, results),
+                                        self._placeholders(action.kwargs, results))
+            results[action_id] = estimate.results
+            depends_on = sorted(self._dependencies[action_id], key=list(self.actions).index)
+            steps[action_id] = PlannedStep(
+                action_id=action_id,
+                name=action.name,
+                depends_on=depends_on,
+                calls=estimate.calls,
+                quota=estimate.quota,
+                start=max((steps[dependency].end for dependency in depends_on), default=0.0),
+                seconds=planner.seconds(action, estimate),
+            )
+
+        planned: dict[(str, str), int] = {}
+        for step in steps.values():
+            for key, count in step.quota.items():
+                planned[key] = planned.get(key, 0) + count
+        quotas = [QuotaImpact(scope, quota, usage.get((scope, quota)), count, limits.get(quota))
+                  for (scope, quota), count in sorted(planned.items())]
+        order = list(steps)
+        return PlanEstimate(sorted(steps.values(), key=lambda step: (step.start, order.index(step.action_id))),
+                            quotas)
+
+    def apply(self) -> Optional[dict[uuid.UUID, Any]]:
+        """
+        Execute the recorded actions as one transaction, rolled back if any of
+        them fails. Handles returned while planning receive the results.
+        """
+        token = transactions.context.activate(transactions.context.SingleActionContext())
+        try:
+            return self.commit()
+        finally:
+            transactions.context.restore(token)
+
+    def discard(self):
+        self.actions.clear()
+        self.handles.clear()
+        self._dependencies.clear()
+
+
+def begin(max_workers: int = transactions.context.DEFAULT_MAX_WORKERS,
+          journal: Optional[transactions.journal.Journal] = None) -> Plan:
+    """
+    Record the calls of registered operations into a plan instead of
+    executing them, until end() is called.
+    """
+    plan = Plan(max_workers=max_workers, journal=journal or transactions.journal.default)
+    plan.token = transactions.context.activate(plan)
+    return plan
+
+
+def end() -> Plan:
+    """
+    Stop recording and return the plan, to be estimated and applied later.
+    A transaction started with transactions.begin() is turned into a plan
+    instead of being committed.
+    """
+    context = transactions.context.current()
+    if not isinstance(context, transactions.context.MultiActionContext):
+        raise RuntimeError("No plan is being recorded, call transactions.plan.begin() first")
+    transactions.context.deactivate(context)
+    return context if isinstance(context, Plan) else Plan.of(context)
@@ -1,8 +1,10 @@
 import math
+import heapq
 import string
 import random
 import netaddr
-from typing import Optional
+import threading
+from typing import Optional, Iterable
 
 
 def random_hex(n):
@@ -10,11 +12,139 @@ def random_hex(n):
     return result.lower()
 
 
-def next_available_cidr(available: [str], used: [str], size: int = 16) -> Optional[str]:
-    available_ip_set = netaddr.IPSet(available) - netaddr.IPSet(used)
-    prefix = 32 - math.ceil(math.log2(size))
-    for block in available_ip_set.iter_cidrs():
-        if block.prefixlen <= prefix:
-            return str(next(block.subnet(prefix, 1)))
+def prefix_for_size(size: int) -> int:
+    """Prefix length of the smallest IPv4 block holding ``size`` addresses."""
+    return 32 - math.ceil(math.log2(size))
+
+
+class CidrAllocator:
+    """
+    Buddy allocator over IPv4 address space. Free blocks are kept in one
+    min-heap per prefix length, so allocating and freeing a block costs
+    O(log n), and a freed block is merged back with its buddy whenever the
+    buddy is free as well. Allocation is best-fit, lowest address first.
+
+    The allocator is seeded once with the address ranges it manages and the
+    blocks already in use, and is safe to share between threads.
+    """
+
+    def __init__(self, available: Iterable[str], used: Iterable[str] = ()):
+        self._free: dict[int, set[int]] = {prefix: set() for prefix in range(33)}
+        self._heaps: dict[int, [int]] = {prefix: [] for prefix in range(33)}
+        self._allocated: set[(int, int)] = set()
+        self._lock = threading.Lock()
+
+        available = [netaddr.IPNetwork(cidr) for cidr in available]
+        used = [netaddr.IPNetwork(cidr) for cidr in used]
+        free_space = netaddr.IPSet(available) - netaddr.IPSet(used)
+        for block in free_space.iter_cidrs():
+            self._push(block.first, block.prefixlen)
+
+        for block in used:
+            if any(network.first <= block.first and block.last <= network.last
+                   for network in available):
+                self._allocated.add((block.first, block.prefixlen))
+
+    def _push(self, first: int, prefix: int):
+        self._free[prefix].add(first)
+        heapq.heappush(self._heaps[prefix], first)
+
+    def _pop(self, prefix: int) -> Optional[int]:
+        # Heaps may hold blocks that were merged away, skip them lazily
+        heap, free = self._heaps[prefix], self._free[prefix]
+        while heap:
+            first = heapq.heappop(heap)
+            if first in free:
+                free.remove(first)
+                return first
+        return None
+
+    def _allocate(self, prefix: int) -> Optional[int]:
+        for candidate in range(prefix, -1, -1):
+            first = self._pop(candidate)
+            if first is not None:
+                break
+        else:
+            return None
+
+        # Split the block down to the requested size, keeping the lower half
+        while candidate < prefix:
+            candidate += 1
+            self._push(first + (1 << (32 - candidate)), candidate)
 
-    return None
+        self._allocated.add((first, prefix))
+        return first
+
+    def _release(self, first: int, prefix: int):
+        self._allocated.remove((first, prefix))
+        while prefix > 0:
+            buddy = first ^ (1 << (32 - prefix))
+            if buddy not in self._free[prefix]:
+                break
+            self._free[prefix].remove(buddy)
+            first = min(first, buddy)
+            prefix -= 1
+        self._push(first, prefix)
+
+    @staticmethod
+    def _format(first: int, prefix: int) -> str:
+        return f"{netaddr.IPAddress(first)}/{prefix}"
+
+    def allocate(self, size: int = 16) -> Optional[str]:
+        """
+        Allocate a block holding at least ``size`` addresses. Returns None
+        when no free block is large enough.
+        """
+        prefix = prefix_for_size(size)
+        with self._lock:
+            first = self._allocate(prefix)
+        return None if first is None else self._format(first, prefix)
+
+    def allocate_many(self, sizes: [int]) -> Optional[list[str]]:
+        """
+        Allocate one block per requested size, returned in the same order.
+        Either every block is allocated or none is, in which case None is
+        returned. Larger blocks are placed first to limit fragmentation.
+        """
+        prefixes = [prefix_for_size(size) for size in sizes]
+        order = sorted(range(len(prefixes)), key=lambda i: prefixes[i])
+        blocks = [None] * len(prefixes)
+        with self._lock:
+            for i in order:
+                first = self._allocate(prefixes[i])
+                if first is None:
+                    for j in order:
+                        if blocks[j] is not None:
+                            self._release(blocks[j], prefixes[j])
+                    return None
+                blocks[i] = first
+        return [self._format(first, prefix) for first, prefix in zip(blocks, prefixes)]
+
+    def free(self, cidr: str):
+        """
+        Return an allocated block, or a block the allocator was seeded with,
+        to the free space.
+        """
+        block = netaddr.IPNetwork(cidr)
+        with self._lock:
+            if (block.first, block.prefixlen) not in self._allocated:
+                raise ValueError(f"{cidr} was not allocated")
+            self._release(block.first, block.prefixlen)
+
+    def __contains__(self, cidr: str) -> bool:
+        block = netaddr.IPNetwork(cidr)
+        with self._lock:
+            return (block.first, block.prefixlen) in self._allocated
+
+    @property
+    def free_addresses(self) -> int:
+        with self._lock:
+            return sum(len(blocks) << (32 - prefix) for prefix, blocks in self._free.items())
+
+
+def next_available_cidr(available: [str], used: [str], size: int = 16) -> Optional[str]:
+    """
+    One-off allocation from a list of used blocks. Callers allocating
+    repeatedly from the same address space should keep a CidrAllocator.
+    """
+    return CidrAllocator(available, used).allocate(size)